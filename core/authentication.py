@@ -0,0 +1,48 @@
+from django.contrib.auth import get_user_model
+from django.utils.functional import cached_property
+from rest_framework.permissions import SAFE_METHODS
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.models import TokenUser
+
+# JWTAuthentication loads the user row from the database on every request, even though the token is already signed
+# and tells us who the user is. For requests that only read data we can build the user from the claims in the token
+# (see CustomerTokenObtainPairSerializer) and skip that query.
+# Writes still load the real user, so a deactivated user can't change anything with an old token.
+# NOTE: claims are a snapshot from login time and an access token lives for a day (ACCESS_TOKEN_LIFETIME). The
+# is_staff claim is only trusted to say no: when it says yes the user row is checked (one query, staff requests only),
+# so taking the staff rights away works at once. Other changes reach the user with the next token.
+
+
+class ClaimsUser(TokenUser):
+    """
+    A user built from the token claims. It has id, is_staff and customer_id, but it is not a User model instance:
+    it can't be saved and it has no email, first_name, etc.
+    """
+
+    @cached_property
+    def customer_id(self):
+        return self.token.get('customer_id')
+
+    @cached_property
+    def is_staff(self):
+        if not self.token.get('is_staff', False):
+            return False
+        # sync only: the async views don't look at is_staff
+        return get_user_model().objects.filter(id=self.id, is_staff=True, is_active=True).exists()
+
+
+class ReadOnlyClaimsAuthentication(JWTAuthentication):
+    """
+    Use it in views that only need request.user.id, is_staff or customer_id on GET.
+    Old tokens without the customer_id claim are handled like before (the user is loaded from the database).
+    """
+
+    def authenticate(self, request):
+        # get_user() doesn't receive the request, so we remember if this one is a read
+        self.read_only = request.method in SAFE_METHODS
+        return super().authenticate(request)
+
+    def get_user(self, validated_token):
+        if self.read_only and 'customer_id' in validated_token:
+            return ClaimsUser(validated_token)
+        return super().get_user(validated_token)
@@ -0,0 +1,141 @@
+import logging
+import random
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections
+from .middleware import HybridMiddleware
+
+logger = logging.getLogger(__name__)
+
+# Read replicas
+# Catalog reads don't need to compete with the checkout for the primary database. Views with
+# read_from_replica = True read from a replica on GET/HEAD/OPTIONS (ReplicaRoutingMiddleware turns it on), everything
+# else uses the primary (default):
+#   - every write
+#   - reads inside transaction.atomic(), they must see the transaction's own writes
+#   - reads AFTER a write in the same request, the replica may not have the write yet (replication lag)
+# Replicas are normal DATABASES entries, DATABASE_REPLICAS gives each one a weight:
+#   DATABASE_REPLICAS = {'replica1': 2, 'replica2': 1}
+# A replica we can't connect to is skipped for REPLICA_RETRY_SECONDS. When no replica is available we use the primary.
+# NOTE: a client that writes and then reads in the NEXT request can still read from a lagging replica. Don't mark
+# views that must show what the user just saved.
+# The response cache (store/cache.py) would keep what a lagging replica returns for an hour: for DATABASE_REPLICA_MAX_LAG
+# seconds after a model changes its cache misses read from the primary (use_primary).
+
+REPLICA_RETRY_SECONDS = 30
+# how far behind the primary a replica can be, in seconds. Monitor it (Seconds_Behind_Source on MySQL)
+REPLICA_MAX_LAG_SECONDS = getattr(settings, 'DATABASE_REPLICA_MAX_LAG', 10)
+
+_state = ContextVar('db_routing', default=None)
+
+
+class RoutingState:
+    def __init__(self):
+        self.use_replica = False
+        # set by the first write, from then on this request reads from the primary
+        self.wrote = False
+
+
+def get_state():
+    return _state.get()
+
+
+@contextmanager
+def use_primary():
+    """
+    The reads inside go to the primary, also in a view with read_from_replica = True.
+    """
+    state = get_state()
+    if state is None:
+        yield
+        return
+    use_replica, state.use_replica = state.use_replica, False
+    try:
+        yield
+    finally:
+        state.use_replica = use_replica
+
+
+class ReplicaRouter:
+    def __init__(self):
+        # alias -> time.monotonic() until we try it again
+        self.down = {}
+
+    def db_for_read(self, model, **hints):
+        state = get_state()
+        if state is None or not state.use_replica or state.wrote:
+            return DEFAULT_DB_ALIAS
+        if connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return DEFAULT_DB_ALIAS
+        return self.choose_replica() or DEFAULT_DB_ALIAS
+
+    def db_for_write(self, model, **hints):
+        state = get_state()
+        if state is not None:
+            state.wrote = True
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # the replicas are copies of the primary, objects from any of them can be related
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # migrate only runs on the database you pass it, the replicas get the schema through replication
+        return None
+
+    def choose_replica(self):
+        replicas = getattr(settings, 'DATABASE_REPLICAS', {})
+        now = time.monotonic()
+        candidates = {alias: weight for alias, weight in replicas.items()
+                      if weight > 0 and self.down.get(alias, 0) <= now}
+        while candidates:
+            alias = random.choices(list(candidates), weights=list(candidates.values()))[0]
+            if self.is_healthy(alias):
+                return alias
+            del candidates[alias]
+        return None
+
+    def is_healthy(self, alias):
+        connection = connections[alias]
+        # an open connection is checked by django itself (CONN_MAX_AGE / CONN_HEALTH_CHECKS), we only check the
+        # first connection of the thread
+        if connection.connection is not None:
+            return True
+        try:
+            connection.ensure_connection()
+        except DatabaseError as e:
+            logger.warning('Replica %s is down, using the others for %ss (%s)', alias, REPLICA_RETRY_SECONDS, e)
+            self.down[alias] = time.monotonic() + REPLICA_RETRY_SECONDS
+            return False
+        self.down.pop(alias, None)
+        return True
+
+
+class ReplicaRoutingMiddleware(HybridMiddleware):
+    """
+    Put it after the other middlewares. It turns replica reads on for the views with read_from_replica = True.
+    """
+    SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+    def call(self, request):
+        # every request starts on the primary and with no writes
+        token = _state.set(RoutingState())
+        try:
+            return self.get_response(request)
+        finally:
+            _state.reset(token)
+
+    async def __acall__(self, request):
+        token = _state.set(RoutingState())
+        try:
+            return await self.get_response(request)
+        finally:
+            _state.reset(token)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        # DRF's as_view() keeps the class in view_func.cls
+        view = getattr(view_func, 'cls', view_func)
+        if request.method in self.SAFE_METHODS and getattr(view, 'read_from_replica', False):
+            get_state().use_replica = True
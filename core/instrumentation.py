@@ -0,0 +1,225 @@
+import logging
+import os
+import sys
+import time
+from collections import Counter
+from contextvars import ContextVar
+from functools import partial
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from django.db.backends.signals import connection_created
+from rest_framework import serializers
+from .middleware import HybridMiddleware
+
+logger = logging.getLogger(__name__)
+
+# Where does the time of a request go?
+# QueryInstrumentationMiddleware measures, for every request:
+#   - the number of SQL queries and the time spent in the database
+#   - the time spent in serializer.data
+#   - the time of the whole request (view)
+# and sends them in a Server-Timing header (the browser dev tools show it in the network tab) and one log line, with
+# the numbers in extra={...} (they are fields of the json lines, see core/logs.py).
+# When the same SQL (with different parameters) runs more than N_PLUS_ONE_THRESHOLD times in a request it is
+# probably an N+1: a query inside a loop that should be a select_related/prefetch_related. The log line names where
+# it comes from, for example "OrderSerializer.items" or "CustomerAdmin.get_orders (store/admin.py:80)".
+#
+# It is off by default: REQUEST_INSTRUMENTATION = {'ENABLED': True} in the settings (or INSTRUMENT_REQUESTS=1 in
+# the environment). When it is off the middleware removes itself from the chain, it costs nothing.
+
+DEFAULTS = {
+    'ENABLED': False,
+    'N_PLUS_ONE_THRESHOLD': 5,
+}
+
+_current = ContextVar('request_instrumentation', default=None)
+# the wrappers of ExecuteWrappers, outermost first
+_execute_wrappers = ContextVar('execute_wrappers', default=())
+
+
+class RequestStats:
+    def __init__(self, threshold):
+        self.threshold = threshold
+        self.queries = 0
+        self.db_time = 0
+        self.serializer_time = 0
+        self.serializer_depth = 0
+        self.templates = Counter()
+        # sql template -> where it was called from, once it passed the threshold
+        self.repeated = {}
+
+    def execute(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.db_time += time.perf_counter() - start
+            self.queries += 1
+            # sql has placeholders (%s), the parameters are not part of it: the same query in a loop has the same sql
+            self.templates[sql] += 1
+            if self.templates[sql] == self.threshold + 1:
+                # only here we pay for walking the stack
+                self.repeated[sql] = find_source(sys._getframe(1))
+
+    def n_plus_one(self):
+        return [{'source': source, 'count': self.templates[sql], 'sql': sql[:200]}
+                for sql, source in self.repeated.items()]
+
+
+def find_source(frame):
+    """
+    The serializer field that ran the query, or else the first frame of our code.
+    """
+    base_dir = str(settings.BASE_DIR)
+    this_file = os.path.abspath(__file__)
+    code_frame = None
+    while frame is not None:
+        instance = frame.f_locals.get('self')
+        if isinstance(instance, serializers.Field) and instance.field_name and instance.parent is not None:
+            parent = instance.parent
+            # items = OrderItemSerializer(many=True) is a ListSerializer whose parent is the OrderSerializer
+            if isinstance(parent, serializers.ListSerializer) and parent.parent is not None:
+                parent = parent.parent
+            return f'{type(parent).__name__}.{instance.field_name}'
+
+        filename = os.path.abspath(frame.f_code.co_filename)
+        if code_frame is None and filename.startswith(base_dir) and filename != this_file \
+                and 'site-packages' not in filename:
+            code_frame = frame
+        frame = frame.f_back
+
+    if code_frame is None:
+        return 'unknown'
+    instance = code_frame.f_locals.get('self')
+    name = code_frame.f_code.co_name
+    if instance is not None:
+        name = f'{type(instance).__name__}.{name}'
+    path = os.path.relpath(code_frame.f_code.co_filename, base_dir)
+    return f'{name} ({path}:{code_frame.f_lineno})'
+
+
+def timed_data(data_property):
+    # serializer.data calls super().data, and nested serializers too. We only time the outermost call
+    def data(self):
+        stats = _current.get()
+        if stats is None:
+            return data_property.fget(self)
+        stats.serializer_depth += 1
+        start = time.perf_counter()
+        try:
+            return data_property.fget(self)
+        finally:
+            stats.serializer_depth -= 1
+            if stats.serializer_depth == 0:
+                stats.serializer_time += time.perf_counter() - start
+    return property(data)
+
+
+_patched = False
+
+
+def patch_serializers():
+    global _patched
+    if _patched:
+        return
+    _patched = True
+    for serializer_class in [serializers.BaseSerializer, serializers.Serializer, serializers.ListSerializer]:
+        serializer_class.data = timed_data(serializer_class.__dict__['data'])
+
+
+class QueryInstrumentationMiddleware(HybridMiddleware):
+    """
+    Put it first in MIDDLEWARE so the view time includes the other middlewares.
+    """
+
+    def __init__(self, get_response):
+        options = {**DEFAULTS, **getattr(settings, 'REQUEST_INSTRUMENTATION', {})}
+        if not options['ENABLED']:
+            raise MiddlewareNotUsed()
+        super().__init__(get_response)
+        self.threshold = options['N_PLUS_ONE_THRESHOLD']
+        patch_serializers()
+
+    def call(self, request):
+        stats = RequestStats(self.threshold)
+        token = _current.set(stats)
+        start = time.perf_counter()
+        try:
+            with ExecuteWrappers(stats.execute):
+                response = self.get_response(request)
+        finally:
+            _current.reset(token)
+        return self.finish(request, response, stats, time.perf_counter() - start)
+
+    async def __acall__(self, request):
+        stats = RequestStats(self.threshold)
+        token = _current.set(stats)
+        start = time.perf_counter()
+        try:
+            with ExecuteWrappers(stats.execute):
+                response = await self.get_response(request)
+        finally:
+            _current.reset(token)
+        return self.finish(request, response, stats, time.perf_counter() - start)
+
+    def finish(self, request, response, stats, view_time):
+        response['Server-Timing'] = ', '.join([
+            f'db;dur={stats.db_time * 1000:.1f};desc="{stats.queries} queries"',
+            f'serializer;dur={stats.serializer_time * 1000:.1f}',
+            f'view;dur={view_time * 1000:.1f}',
+        ])
+
+        match = request.resolver_match
+        line = {
+            'method': request.method,
+            'path': request.path,
+            'route': match.route if match else None,
+            'status': response.status_code,
+            'queries': stats.queries,
+            'db_ms': round(stats.db_time * 1000, 1),
+            'serializer_ms': round(stats.serializer_time * 1000, 1),
+            'view_ms': round(view_time * 1000, 1),
+        }
+        n_plus_one = stats.n_plus_one()
+        if n_plus_one:
+            line['n_plus_one'] = n_plus_one
+            logger.warning('N+1 queries in %s %s', request.method, request.path, extra=line)
+        else:
+            logger.info('%s %s', request.method, request.path, extra=line)
+        return response
+
+
+class ExecuteWrappers:
+    """
+    Runs the wrapper around every query of this context (the request).
+    The wrappers are in a ContextVar and not on the connections of the thread: the async ORM runs the queries of an
+    async view in another thread, with a copy of the context.
+    """
+
+    def __init__(self, wrapper):
+        self.wrapper = wrapper
+        self.token = None
+
+    def __enter__(self):
+        # the connections opened before this module was imported don't have it yet
+        for connection in connections.all():
+            install_execute_wrappers(connection)
+        self.token = _execute_wrappers.set(_execute_wrappers.get() + (self.wrapper,))
+
+    def __exit__(self, *exc_info):
+        _execute_wrappers.reset(self.token)
+
+
+def run_execute_wrappers(execute, sql, params, many, context):
+    for wrapper in reversed(_execute_wrappers.get()):
+        execute = partial(wrapper, execute)
+    return execute(sql, params, many, context)
+
+
+def install_execute_wrappers(connection, **kwargs):
+    if run_execute_wrappers not in connection.execute_wrappers:
+        connection.execute_wrappers.append(run_execute_wrappers)
+
+
+connection_created.connect(install_execute_wrappers)
@@ -0,0 +1,258 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import re
+import threading
+import time
+import uuid
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from .middleware import HybridMiddleware
+
+# Logging that doesn't block the requests
+# A FileHandler writes to the disk in the thread that logs, holding the lock of the handler: under load the requests
+# wait for the disk and for each other. QueueHandler only puts the record in a queue, a listener thread (one per
+# process) writes it:
+#   - to the console, in the usual one line format
+#   - to FILENAME, one json object per line, rotated every MAX_BYTES (BACKUP_COUNT old files are kept)
+# The json lines have the request id and the time since the request started (RequestContextMiddleware), so you can
+# find every line of one request, and anything passed in extra={...}.
+# If the listener can't keep up and the queue is full the record is dropped (and counted) instead of waiting.
+#
+# SamplingFilter keeps chatty INFO (and DEBUG) messages in check: every line of code can log RATE records per PER
+# seconds, the rest are dropped. The next record of that line says how many were dropped (sampled_out). WARNING and
+# above always go through.
+#
+# Every gunicorn worker rotates its own file: put {pid} in the filename (logs/storefront.{pid}.log, without
+# --preload so every worker configures its own logging), two processes rotating the same file lose lines.
+# Every process gets a file, manage.py commands too: when a process starts it removes the files of the processes that
+# are gone (ship the logs while they run, e.g. a log agent that tails logs/*.log).
+
+_request = ContextVar('log_request', default=None)
+
+REQUEST_ID_HEADER = 'X-Request-ID'
+# the request id of a proxy or a client is only kept if it looks like one
+VALID_REQUEST_ID = re.compile(r'^[A-Za-z0-9._-]{1,64}$')
+
+# the attributes of every LogRecord, the others come from extra={...}
+RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', None, None))) | {'message', 'asctime'}
+
+
+class RequestContext:
+    def __init__(self, request_id, method, path):
+        self.request_id = request_id
+        self.method = method
+        self.path = path
+        self.start = time.perf_counter()
+
+
+class RequestContextMiddleware(HybridMiddleware):
+    """
+    Put it first in MIDDLEWARE so every log line of the request has its id.
+    """
+
+    def call(self, request):
+        token = self.start(request)
+        try:
+            response = self.get_response(request)
+        finally:
+            _request.reset(token)
+        response[REQUEST_ID_HEADER] = request.id
+        return response
+
+    async def __acall__(self, request):
+        token = self.start(request)
+        try:
+            response = await self.get_response(request)
+        finally:
+            _request.reset(token)
+        response[REQUEST_ID_HEADER] = request.id
+        return response
+
+    def start(self, request):
+        request_id = request.headers.get(REQUEST_ID_HEADER, '')
+        if not VALID_REQUEST_ID.match(request_id):
+            request_id = uuid.uuid4().hex
+        request.id = request_id
+        return _request.set(RequestContext(request_id, request.method, request.path))
+
+
+class RequestContextFilter(logging.Filter):
+    # it runs in the thread that logs, the listener thread doesn't know the request
+    def filter(self, record):
+        context = _request.get()
+        if context is not None:
+            record.request_id = context.request_id
+            record.method = context.method
+            record.path = context.path
+            record.elapsed_ms = round((time.perf_counter() - context.start) * 1000, 1)
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    def __init__(self, rate=20, per=1.0, level='INFO'):
+        super().__init__()
+        self.rate = rate
+        self.per = per
+        self.level = logging.getLevelName(level) if isinstance(level, str) else level
+        # (file, line) -> [start of the window, records let through, records dropped]
+        self.windows = {}
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno > self.level:
+            return True
+        key = (record.pathname, record.lineno)
+        now = time.monotonic()
+        with self.lock:
+            window = self.windows.get(key)
+            if window is None or now - window[0] >= self.per:
+                dropped = window[2] if window else 0
+                window = self.windows[key] = [now, 0, 0]
+                if dropped:
+                    record.sampled_out = dropped
+            if window[1] >= self.rate:
+                window[2] += 1
+                return False
+            window[1] += 1
+            return True
+
+
+def pid_is_alive(pid):
+    # signal 0 only checks that the process exists (gunicorn and the rest of the deploy run on posix)
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def remove_stale_files(pattern):
+    """
+    Removes the files of the pattern (and their rotations) whose {pid} is not a running process.
+    """
+    directory, name = os.path.split(os.path.abspath(pattern))
+    prefix, suffix = name.split('{pid}', 1)
+    stale = re.compile(re.escape(prefix) + r'(\d+)' + re.escape(suffix) + r'(\.\d+)?$')
+    for entry in os.listdir(directory):
+        match = stale.match(entry)
+        if match is None or pid_is_alive(int(match.group(1))):
+            continue
+        try:
+            os.remove(os.path.join(directory, entry))
+        except FileNotFoundError:
+            # another process that started at the same time removed it
+            pass
+
+
+class JSONFormatter(logging.Formatter):
+    def format(self, record):
+        line = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'process': record.process,
+            'thread': record.threadName,
+        }
+        # request_id, elapsed_ms, sampled_out, extra={...}
+        line.update((key, value) for key, value in vars(record).items() if key not in RECORD_ATTRIBUTES)
+        if record.exc_text:
+            line['exception'] = record.exc_text
+        if record.stack_info:
+            line['stack'] = record.stack_info
+        return json.dumps(line, default=str)
+
+
+class QueueHandler(logging.handlers.QueueHandler):
+    """
+    The handler of the root logger. It starts the listener thread that owns the real handlers.
+    """
+
+    def __init__(self, filename, max_bytes=50 * 1024 * 1024, backup_count=5, queue_size=10000, console=True):
+        super().__init__(queue.Queue(queue_size))
+        self.dropped = 0
+
+        self.handlers = []
+        self.console_handler = None
+        if console:
+            self.console_handler = logging.StreamHandler()
+            self.handlers.append(self.console_handler)
+        if filename:
+            os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+            if '{pid}' in filename:
+                remove_stale_files(filename)
+                filename = filename.format(pid=os.getpid())
+            file_handler = logging.handlers.RotatingFileHandler(
+                filename, maxBytes=max_bytes, backupCount=backup_count, encoding='utf-8')
+            file_handler.setFormatter(JSONFormatter())
+            self.handlers.append(file_handler)
+
+        self.listener = None
+        self.closed = False
+        self.start()
+        # write what is still in the queue before the process ends
+        atexit.register(self.stop)
+        # gunicorn forks the workers: the thread of the listener doesn't exist in the child
+        os.register_at_fork(after_in_child=self.start)
+
+    def setFormatter(self, fmt):
+        # the formatter of the handler in LOGGING is the one of the console
+        super().setFormatter(fmt)
+        if self.console_handler is not None:
+            self.console_handler.setFormatter(fmt)
+
+    def start(self):
+        if self.closed:
+            return
+        self.queue = queue.Queue(self.queue.maxsize)
+        self.listener = logging.handlers.QueueListener(self.queue, *self.handlers, respect_handler_level=True)
+        self.listener.start()
+
+    def stop(self):
+        if self.listener is not None and self.listener._thread is not None:
+            self.listener.stop()
+
+    def close(self):
+        # logging.config.dictConfig() closes the old handlers when it configures new ones
+        self.closed = True
+        self.stop()
+        for handler in self.handlers:
+            handler.close()
+        super().close()
+
+    def flush(self):
+        # waits until the listener wrote everything that is in the queue (logging.shutdown() calls it at exit)
+        if self.listener is not None and self.listener._thread is not None:
+            self.queue.join()
+
+    def prepare(self, record):
+        # The message and the traceback are built here: the arguments and the frames of the traceback can change
+        # before the listener gets to the record. The rest of the formatting happens in the listener.
+        # No copy of the record, the message doesn't change for the other handlers
+        record.message = record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info and not record.exc_text:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            return
+        if self.dropped:
+            dropped, self.dropped = self.dropped, 0
+            warning = logging.makeLogRecord({
+                'name': __name__, 'levelno': logging.WARNING, 'levelname': 'WARNING',
+                'msg': f'The log queue was full, {dropped} records were dropped'})
+            try:
+                self.queue.put_nowait(warning)
+            except queue.Full:
+                self.dropped += dropped
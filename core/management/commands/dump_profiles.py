@@ -0,0 +1,39 @@
+import os
+from collections import Counter
+from django.core.management.base import BaseCommand
+from core import profiling
+
+
+class Command(BaseCommand):
+    help = 'Merges the profiles of every worker into one flame graph file per route (see core/profiling.py)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--output', help='Directory for the merged .folded files, the default is DIRECTORY/merged')
+        parser.add_argument('--top', type=int, default=10, help='Functions to show per route')
+        parser.add_argument('--reset', action='store_true', help='Start again from zero after the dump')
+
+    def handle(self, *args, **options):
+        directory = profiling.get_options()['DIRECTORY']
+        output = options['output'] or os.path.join(directory, 'merged')
+        profiles = profiling.read_profiles(directory)
+        if not profiles:
+            self.stdout.write('No profiles yet')
+
+        os.makedirs(output, exist_ok=True)
+        for route, (requests, stacks) in sorted(profiles.items()):
+            path = os.path.join(output, f'{profiling.route_filename(route)}.folded')
+            with open(path, 'w') as f:
+                f.write(''.join(f'{stack} {count}\n' for stack, count in stacks.most_common()))
+
+            total = sum(stacks.values())
+            self.stdout.write(self.style.SUCCESS(f'{route}: {requests} requests, {total} samples -> {path}'))
+            # the functions where the samples were taken (the leaf of the stack)
+            leaves = Counter()
+            for stack, count in stacks.items():
+                leaves[stack.rsplit(';', 1)[-1]] += count
+            for function, count in leaves.most_common(options['top']):
+                self.stdout.write(f'  {count / total:6.1%}  {function}')
+
+        if options['reset']:
+            profiling.reset_profiles(directory)
+            self.stdout.write('Profiles reset')
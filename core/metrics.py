@@ -0,0 +1,328 @@
+import atexit
+import fcntl
+import json
+import math
+import os
+import re
+import threading
+import time
+from collections import defaultdict
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.http import Http404, HttpResponse
+from .instrumentation import ExecuteWrappers
+from .logs import pid_is_alive
+from .middleware import HybridMiddleware
+
+# Metrics for Prometheus
+# MetricsMiddleware counts every request in a registry inside the process:
+#   storefront_http_requests_total{method, route, status}             counter
+#   storefront_http_request_duration_seconds{method, route}           histogram, the p99 of a route comes from it:
+#       histogram_quantile(0.99, sum by (le) (rate(storefront_http_request_duration_seconds_bucket{route="store/products/"}[5m])))
+#   storefront_http_request_db_queries{method, route}                 histogram of the SQL queries per request
+# The label is the route of the url pattern ('store/products/<int:pk>/'), not the path: one series per endpoint, not
+# one per product. Urls that don't match any pattern are counted as route="unmatched".
+#
+# gunicorn runs several worker processes and Prometheus only scrapes one of them per request. A thread of every
+# process writes its numbers to DIRECTORY/<pid>.json every WRITE_INTERVAL seconds (the requests only add to a dict),
+# and /metrics adds up the files of all the processes. All the values are counters (a histogram is a counter per
+# bucket plus _sum and _count), so adding them up is correct. Empty DIRECTORY when you deploy, like the multiprocess
+# mode of prometheus_client.
+# The counters of a worker that is gone must not go down: before its first write a process adds the files of the
+# pids that are not running anymore (and the old file of its own pid, when the pid is reused) to archive.json.
+#
+# It is off by default: METRICS = {'ENABLED': True} (or METRICS_ENABLED=1 in the environment). /metrics wants the
+# header Authorization: Bearer <TOKEN> (bearer_token in the scrape config of Prometheus). Without a TOKEN it is only
+# open when DEBUG is on.
+
+DEFAULTS = {
+    'ENABLED': False,
+    'DIRECTORY': os.path.join(settings.BASE_DIR, 'metrics'),
+    'WRITE_INTERVAL': 1,
+    'TOKEN': None,
+    # seconds
+    'LATENCY_BUCKETS': (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+    'QUERY_BUCKETS': (0, 1, 2, 5, 10, 20, 50, 100),
+}
+
+METHODS = {'GET', 'HEAD', 'OPTIONS', 'POST', 'PUT', 'PATCH', 'DELETE'}
+# the file of a process, archive.json has the numbers of the processes that are gone
+PROCESS_FILE = re.compile(r'^(\d+)\.json$')
+ARCHIVE_FILE = 'archive.json'
+
+
+def get_options():
+    return {**DEFAULTS, **getattr(settings, 'METRICS', {})}
+
+
+class Registry:
+    """
+    The values of this process: (metric, sample, labels) -> value.
+    """
+
+    def __init__(self):
+        # metric -> (type, help)
+        self.metrics = {}
+        self.values = defaultdict(float)
+        self.lock = threading.Lock()
+        self.last_write = 0
+        # the process that archived the old files and the one that started the writer thread
+        self.pid = None
+        self.writer_pid = None
+
+    def counter(self, name, documentation):
+        self.metrics[name] = ('counter', documentation)
+        return Counter(self, name)
+
+    def histogram(self, name, documentation, buckets):
+        self.metrics[name] = ('histogram', documentation)
+        return Histogram(self, name, buckets)
+
+    def add(self, samples):
+        with self.lock:
+            for key, value in samples:
+                self.values[key] += value
+
+    def write(self, directory, write_interval=0):
+        if self.pid != os.getpid():
+            # the first write of this process
+            archive_stale_files(directory)
+            self.pid = os.getpid()
+        now = time.monotonic()
+        with self.lock:
+            if now - self.last_write < write_interval:
+                return
+            self.last_write = now
+            values = [[metric, sample, list(labels), value] for (metric, sample, labels), value in self.values.items()]
+        write_samples(os.path.join(directory, f'{os.getpid()}.json'), values)
+
+    def start_writer(self, directory, write_interval):
+        """
+        Starts the thread that writes the file of this process. A forked gunicorn worker doesn't have the thread of its
+        parent, it starts its own.
+        """
+        with self.lock:
+            if self.writer_pid == os.getpid():
+                return
+            self.writer_pid = os.getpid()
+        threading.Thread(target=self.write_periodically, args=(directory, write_interval),
+                         name='metrics-writer', daemon=True).start()
+        # the last requests of a worker that stops normally
+        atexit.register(self.write, directory)
+
+    def write_periodically(self, directory, write_interval):
+        while True:
+            # WRITE_INTERVAL = 0 means as soon as possible, not a busy loop
+            time.sleep(max(write_interval, 0.1))
+            self.write(directory)
+
+    def clear(self):
+        with self.lock:
+            self.values.clear()
+
+
+class Counter:
+    def __init__(self, registry, name):
+        self.registry = registry
+        self.name = name
+
+    def inc(self, labels, amount=1):
+        self.registry.add([((self.name, self.name, labels_key(labels)), amount)])
+
+
+class Histogram:
+    def __init__(self, registry, name, buckets):
+        self.registry = registry
+        self.name = name
+        self.buckets = [*sorted(buckets), math.inf]
+
+    def observe(self, labels, value):
+        # the buckets are cumulative: a value is counted in every bucket it fits in. The others get 0, so every bucket
+        # of a series is exposed from its first observation (histogram_quantile needs all of them)
+        samples = [((self.name, f'{self.name}_bucket', labels_key({**labels, 'le': format_value(bucket)})),
+                    1 if value <= bucket else 0)
+                   for bucket in self.buckets]
+        samples.append(((self.name, f'{self.name}_sum', labels_key(labels)), value))
+        samples.append(((self.name, f'{self.name}_count', labels_key(labels)), 1))
+        self.registry.add(samples)
+
+
+def labels_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def write_samples(path, values):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(values, f)
+    os.replace(path + '.tmp', path)
+
+
+def read_samples(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        # a process that died in the middle of a write, the others still count
+        return []
+
+
+def archive_stale_files(directory):
+    """
+    Adds the files of the processes that are gone to archive.json, so their counters don't drop when the pid is reused
+    and the directory doesn't grow with every restart.
+    """
+    os.makedirs(directory, exist_ok=True)
+    # two processes that start at the same time would archive the same file twice
+    with open(os.path.join(directory, '.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        stale = []
+        for name in os.listdir(directory):
+            match = PROCESS_FILE.match(name)
+            if match is None:
+                continue
+            pid = int(match.group(1))
+            # our pid before our first write: the file of a process that had the same pid
+            if pid == os.getpid() or not pid_is_alive(pid):
+                stale.append(os.path.join(directory, name))
+        if not stale:
+            return
+        archive = os.path.join(directory, ARCHIVE_FILE)
+        values = defaultdict(float)
+        for path in [archive, *stale]:
+            for metric, sample, labels, value in read_samples(path):
+                values[(metric, sample, tuple(tuple(label) for label in labels))] += value
+        write_samples(archive, [[metric, sample, list(labels), value]
+                                for (metric, sample, labels), value in values.items()])
+        for path in stale:
+            os.remove(path)
+
+
+registry = Registry()
+# a forked child starts from zero, its parent still writes what it counted
+os.register_at_fork(after_in_child=registry.clear)
+
+requests_total = registry.counter(
+    'storefront_http_requests_total', 'Requests by route, method and status code')
+request_duration = registry.histogram(
+    'storefront_http_request_duration_seconds', 'Time to answer a request, by route and method',
+    get_options()['LATENCY_BUCKETS'])
+request_queries = registry.histogram(
+    'storefront_http_request_db_queries', 'SQL queries per request, by route and method',
+    get_options()['QUERY_BUCKETS'])
+
+
+class QueryCounter:
+    def __init__(self):
+        self.queries = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.queries += 1
+        return execute(sql, params, many, context)
+
+
+class MetricsMiddleware(HybridMiddleware):
+    """
+    Put it near the top of MIDDLEWARE, the time of the middlewares after it is part of the latency.
+    """
+
+    def __init__(self, get_response):
+        options = get_options()
+        if not options['ENABLED']:
+            raise MiddlewareNotUsed()
+        super().__init__(get_response)
+        self.directory = options['DIRECTORY']
+        self.write_interval = options['WRITE_INTERVAL']
+
+    def call(self, request):
+        counter = QueryCounter()
+        start = time.perf_counter()
+        with ExecuteWrappers(counter):
+            response = self.get_response(request)
+        return self.finish(request, response, counter.queries, time.perf_counter() - start)
+
+    async def __acall__(self, request):
+        counter = QueryCounter()
+        start = time.perf_counter()
+        with ExecuteWrappers(counter):
+            response = await self.get_response(request)
+        return self.finish(request, response, counter.queries, time.perf_counter() - start)
+
+    def finish(self, request, response, queries, duration):
+        match = request.resolver_match
+        labels = {
+            'method': request.method if request.method in METHODS else 'other',
+            'route': match.route if match else 'unmatched',
+        }
+        requests_total.inc({**labels, 'status': str(response.status_code)})
+        request_duration.observe(labels, duration)
+        request_queries.observe(labels, queries)
+        registry.start_writer(self.directory, self.write_interval)
+        return response
+
+
+def read_metrics(directory):
+    """
+    Adds up the files of every process: (metric, sample, labels) -> value.
+    """
+    values = defaultdict(float)
+    if not os.path.isdir(directory):
+        return values
+    for name in os.listdir(directory):
+        if not name.endswith('.json'):
+            continue
+        for metric, sample, labels, value in read_samples(os.path.join(directory, name)):
+            values[(metric, sample, tuple(tuple(label) for label in labels))] += value
+    return values
+
+
+def exposition(values):
+    """
+    The text format of Prometheus.
+    """
+    by_metric = defaultdict(list)
+    for (metric, sample, labels), value in values.items():
+        by_metric[metric].append((sample, labels, value))
+
+    lines = []
+    for metric in sorted(by_metric):
+        kind, documentation = registry.metrics.get(metric, ('untyped', ''))
+        lines.append(f'# HELP {metric} {documentation}')
+        lines.append(f'# TYPE {metric} {kind}')
+        # the buckets of a series go together and in order, then _sum and _count
+        for sample, labels, value in sorted(by_metric[metric], key=sort_key):
+            label_text = ','.join(f'{key}="{escape(value)}"' for key, value in labels)
+            lines.append(f'{sample}{{{label_text}}} {format_value(value)}')
+    return '\n'.join(lines) + '\n'
+
+
+def sort_key(item):
+    sample, labels, _ = item
+    series = [label for label in labels if label[0] != 'le']
+    le = dict(labels).get('le')
+    return series, sample.endswith('_count'), sample.endswith('_sum'), float(le) if le else 0
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def metrics_view(request):
+    options = get_options()
+    if not options['ENABLED']:
+        raise Http404()
+    # without a token the numbers of the store (routes, traffic) would be public
+    if not options['TOKEN'] and not settings.DEBUG:
+        return HttpResponse(status=403)
+    if options['TOKEN'] and request.headers.get('Authorization') != f'Bearer {options["TOKEN"]}':
+        return HttpResponse(status=401)
+    # our own numbers are always up to date, the other processes wrote theirs less than WRITE_INTERVAL ago
+    registry.write(options['DIRECTORY'])
+    return HttpResponse(exposition(read_metrics(options['DIRECTORY'])),
+                        content_type='text/plain; version=0.0.4; charset=utf-8')
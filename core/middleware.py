@@ -0,0 +1,41 @@
+import asyncio
+from asgiref.sync import markcoroutinefunction
+
+# Middlewares that run in the mode of the chain they are in
+# Between an async handler and a sync only middleware Django puts a thread (sync_to_async), for every request: the
+# async views (store/async_views.py) would pin a thread again. Our middlewares work both ways: under WSGI __call__ is
+# sync, under ASGI it returns the coroutine of __acall__ and process_view is a coroutine too (a sync process_view in an
+# async chain also runs in a thread).
+# The state of the request is kept in ContextVars, the async ORM copies them into the thread that runs the queries.
+# NOTE: a sync only middleware anywhere in MIDDLEWARE (WhiteNoise 6 is one) still makes everything above it sync.
+
+
+class HybridMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = asyncio.iscoroutinefunction(get_response)
+        if self.is_async:
+            # Django looks at the instance to know if it has to await it
+            markcoroutinefunction(self)
+            if hasattr(self, 'process_view'):
+                process_view = self.process_view
+
+                # our process_view methods don't block, they can run in the event loop
+                async def async_process_view(request, view_func, view_args, view_kwargs):
+                    return process_view(request, view_func, view_args, view_kwargs)
+
+                self.process_view = async_process_view
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        return self.call(request)
+
+    def call(self, request):
+        raise NotImplementedError
+
+    async def __acall__(self, request):
+        raise NotImplementedError
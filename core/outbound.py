@@ -0,0 +1,168 @@
+import logging
+import threading
+import time
+from asgiref.sync import sync_to_async
+from django.conf import settings
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+# Outbound HTTP calls (other services, webhooks, httpbin in the playground)
+# requests.get(url) opens a new connection every time and waits FOREVER if the other side doesn't answer: a slow
+# service blocks our worker with it. Use this module instead:
+#   - one Session per host with a pool of keep-alive connections (no new TCP/TLS handshake per call)
+#   - a connect and a read timeout on every call
+#   - a circuit breaker per host: after FAILURE_THRESHOLD failures in a row we stop calling the host for
+#     RESET_TIMEOUT seconds and fail immediately, so our workers are free to serve other requests. After that one
+#     call is let through, if it works the circuit closes again.
+#
+#   from core import outbound
+#   response = outbound.get('https://httpbin.org/get')           # sync views
+#   response = await outbound.aget('https://httpbin.org/get')    # async views
+#
+# Settings (all optional): OUTBOUND_HTTP = {'TIMEOUT': (3.05, 10), 'POOL_SIZE': 10, 'FAILURE_THRESHOLD': 5,
+# 'RESET_TIMEOUT': 30}
+
+DEFAULTS = {
+    # (connect, read) in seconds
+    'TIMEOUT': (3.05, 10),
+    'POOL_SIZE': 10,
+    'FAILURE_THRESHOLD': 5,
+    'RESET_TIMEOUT': 30,
+}
+
+
+class OutboundError(Exception):
+    pass
+
+
+class CircuitOpenError(OutboundError):
+    pass
+
+
+class CircuitBreaker:
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, failure_threshold, reset_timeout):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+        self.lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return self.CLOSED
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return self.HALF_OPEN
+        return self.OPEN
+
+    def allow(self):
+        with self.lock:
+            state = self.state
+            if state == self.CLOSED:
+                return True
+            # half open: only ONE call tries the host, the others keep failing fast until we know the result
+            if state == self.HALF_OPEN and not self.trial:
+                self.trial = True
+                return True
+            return False
+
+    def success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial = False
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            self.trial = False
+            if self.opened_at is not None or self.failures >= self.failure_threshold:
+                # a failed trial opens the circuit for another reset_timeout
+                self.opened_at = time.monotonic()
+
+
+class Client:
+    """
+    Keep one Client per host (or use the module functions, they do). It is safe to share between threads.
+    """
+
+    def __init__(self, timeout=None, pool_size=None, failure_threshold=None, reset_timeout=None):
+        options = {**DEFAULTS, **getattr(settings, 'OUTBOUND_HTTP', {})}
+        self.timeout = timeout or options['TIMEOUT']
+        self.breaker = CircuitBreaker(
+            failure_threshold or options['FAILURE_THRESHOLD'],
+            reset_timeout if reset_timeout is not None else options['RESET_TIMEOUT'])
+
+        self.session = requests.Session()
+        # we don't retry here: retrying a slow service makes the caller wait even longer
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size or options['POOL_SIZE'], max_retries=0)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def request(self, method, url, **kwargs):
+        if not self.breaker.allow():
+            raise CircuitOpenError(f'Circuit open for {url}')
+        kwargs.setdefault('timeout', self.timeout)
+        try:
+            response = self.session.request(method, url, **kwargs)
+        except requests.RequestException as e:
+            self.breaker.failure()
+            raise OutboundError(f'{method} {url} failed: {e}') from e
+
+        # 5xx means the service is in trouble. 4xx is our fault, it doesn't open the circuit
+        if response.status_code >= 500:
+            self.breaker.failure()
+            raise OutboundError(f'{method} {url} returned {response.status_code}')
+        self.breaker.success()
+        return response
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    async def arequest(self, method, url, **kwargs):
+        # requests has no async api. The call runs in a thread of the executor, the event loop keeps serving other
+        # requests while it waits (the timeouts and the circuit breaker still apply)
+        return await sync_to_async(self.request, thread_sensitive=False)(method, url, **kwargs)
+
+    async def aget(self, url, **kwargs):
+        return await self.arequest('GET', url, **kwargs)
+
+    def close(self):
+        self.session.close()
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(url):
+    """
+    The shared client of the host of this url.
+    """
+    host = requests.utils.urlparse(url).netloc
+    with _clients_lock:
+        if host not in _clients:
+            _clients[host] = Client()
+        return _clients[host]
+
+
+def get(url, **kwargs):
+    return get_client(url).get(url, **kwargs)
+
+
+def post(url, **kwargs):
+    return get_client(url).post(url, **kwargs)
+
+
+async def aget(url, **kwargs):
+    return await get_client(url).aget(url, **kwargs)
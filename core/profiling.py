@@ -0,0 +1,230 @@
+import logging
+import os
+import random
+import re
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.urls import Resolver404, URLResolver, get_resolver, resolve
+from .middleware import HybridMiddleware
+
+logger = logging.getLogger(__name__)
+
+# Profiling in production
+# ProfilingMiddleware profiles a fraction of the requests of the routes you choose, without a redeploy of the code:
+#   PROFILING = {'ENABLED': True, 'ROUTES': {'store/orders/': 0.05, 'store/carts/<uuid:pk>/': 0.1}}
+# The keys are the routes of the url patterns (request.resolver_match.route, the "route" of the log lines of
+# core/instrumentation.py) or the urls, the values the fraction of requests. The viewsets of DRF routers have regex
+# routes like 'store/orders/$', the anchors are ignored on both sides: 'store/orders/' is the list of the orders.
+# A key that is neither a route nor a url of the site is logged as a warning when the middleware starts.
+# A sampled request gets a thread that looks at its stack every INTERVAL seconds (a statistical profiler, like py-spy
+# but inside the process). The stacks are added up per route in the "folded" format of flame graphs:
+#   django.core.handlers.base:_get_response;store.views:list;store.serializers:to_representation 12
+# Every process writes its totals to DIRECTORY/<route>.<pid>.folded every WRITE_INTERVAL seconds. The
+# dump_profiles command merges the files of all the processes (flamegraph.pl or speedscope.app can open them) and
+# --reset starts again from zero.
+# Requests that are not sampled only pay for a dict lookup and a random number.
+
+DEFAULTS = {
+    'ENABLED': False,
+    'ROUTES': {},
+    'INTERVAL': 0.005,
+    'DIRECTORY': os.path.join(settings.BASE_DIR, 'profiles'),
+    'WRITE_INTERVAL': 10,
+}
+
+RESET_FILE = 'reset'
+
+
+def get_options():
+    return {**DEFAULTS, **getattr(settings, 'PROFILING', {})}
+
+
+def normalize_route(route):
+    # '/store/^orders/$' -> 'store/orders/'
+    return re.sub(r'(^|/)\^', r'\1', route.lstrip('/')).replace('$', '')
+
+
+def get_routes(resolver=None, prefix=''):
+    """
+    The routes of every url pattern, as in resolver_match.route.
+    """
+    resolver = resolver or get_resolver()
+    for pattern in resolver.url_patterns:
+        route = prefix + str(pattern.pattern)
+        if isinstance(pattern, URLResolver):
+            yield from get_routes(pattern, route)
+        else:
+            yield route
+
+
+def unknown_routes(routes):
+    known = {normalize_route(route) for route in get_routes()}
+    unknown = []
+    for route in routes:
+        if route in known:
+            continue
+        try:
+            resolve('/' + route)
+        except Resolver404:
+            unknown.append(route)
+    return unknown
+
+
+def route_filename(route):
+    # store/carts/<uuid:pk>/ -> store_carts_uuid_pk
+    return re.sub(r'[^A-Za-z0-9]+', '_', route).strip('_') or 'root'
+
+
+class StackSampler(threading.Thread):
+    def __init__(self, thread_id, interval):
+        super().__init__(daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.sample()
+
+    def sample(self):
+        frame = sys._current_frames().get(self.thread_id)
+        stack = []
+        while frame is not None:
+            stack.append(f'{frame.f_globals.get("__name__", "?")}:{frame.f_code.co_name}')
+            frame = frame.f_back
+        if stack:
+            # root first
+            self.stacks[';'.join(reversed(stack))] += 1
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        return self.stacks
+
+
+class Profiles:
+    """
+    The totals of this process: route -> stack -> samples, and route -> sampled requests.
+    """
+
+    def __init__(self, directory, write_interval):
+        self.directory = directory
+        self.write_interval = write_interval
+        self.stacks = defaultdict(Counter)
+        self.requests = Counter()
+        self.lock = threading.Lock()
+        self.last_write = time.monotonic()
+        self.last_reset = time.time()
+
+    def add(self, route, stacks):
+        with self.lock:
+            due = time.monotonic() - self.last_write >= self.write_interval
+            if due:
+                self.check_reset()
+            self.requests[route] += 1
+            self.stacks[route].update(stacks)
+        if due:
+            self.write()
+
+    def write(self):
+        os.makedirs(self.directory, exist_ok=True)
+        with self.lock:
+            self.last_write = time.monotonic()
+            for route, stacks in self.stacks.items():
+                path = os.path.join(self.directory, f'{route_filename(route)}.{os.getpid()}.folded')
+                # the first line says which route it is and how many requests were sampled
+                lines = [f'# {route} {self.requests[route]}']
+                lines += [f'{stack} {count}' for stack, count in stacks.items()]
+                with open(path + '.tmp', 'w') as f:
+                    f.write('\n'.join(lines) + '\n')
+                os.replace(path + '.tmp', path)
+
+    def check_reset(self):
+        # dump_profiles --reset can't reach the memory of the workers, it leaves a file with the time of the reset
+        try:
+            reset_at = os.path.getmtime(os.path.join(self.directory, RESET_FILE))
+        except OSError:
+            return
+        if reset_at > self.last_reset:
+            self.stacks.clear()
+            self.requests.clear()
+            self.last_reset = reset_at
+
+
+class ProfilingMiddleware(HybridMiddleware):
+    """
+    Put it last in MIDDLEWARE, the route is only known when the view is about to run.
+    An async view is sampled in the thread of the event loop: the stacks of the other requests it serves at the same
+    time are in its profile too.
+    """
+
+    def __init__(self, get_response):
+        options = get_options()
+        if not options['ENABLED'] or not options['ROUTES']:
+            raise MiddlewareNotUsed()
+        super().__init__(get_response)
+        self.routes = {normalize_route(route): rate for route, rate in options['ROUTES'].items()}
+        self.interval = options['INTERVAL']
+        self.profiles = Profiles(options['DIRECTORY'], options['WRITE_INTERVAL'])
+        for route in unknown_routes(self.routes):
+            logger.warning(f'PROFILING route {route!r} matches no url, its requests are never sampled')
+
+    def call(self, request):
+        return self.finish(request, self.get_response(request))
+
+    async def __acall__(self, request):
+        return self.finish(request, await self.get_response(request))
+
+    def finish(self, request, response):
+        sampler = getattr(request, '_profiling_sampler', None)
+        if sampler is not None:
+            # the view and the rendering of the response are included
+            self.profiles.add(request._profiling_route, sampler.stop())
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        # the route of the url pattern, or the url itself
+        for route in (normalize_route(request.resolver_match.route), request.path.lstrip('/')):
+            rate = self.routes.get(route)
+            if rate is not None:
+                break
+        if rate and random.random() < rate:
+            sampler = StackSampler(threading.get_ident(), self.interval)
+            sampler.start()
+            request._profiling_sampler = sampler
+            request._profiling_route = route
+
+
+def read_profiles(directory):
+    """
+    Merges the files of every process: route -> (sampled requests, Counter of stacks).
+    """
+    profiles = {}
+    if not os.path.isdir(directory):
+        return profiles
+    for name in sorted(os.listdir(directory)):
+        if not name.endswith('.folded') or name.count('.') != 2:
+            continue
+        with open(os.path.join(directory, name)) as f:
+            header, *lines = f.read().splitlines()
+        route, requests = header[2:].rsplit(' ', 1)
+        total_requests, stacks = profiles.setdefault(route, (0, Counter()))
+        for line in lines:
+            stack, count = line.rsplit(' ', 1)
+            stacks[stack] += int(count)
+        profiles[route] = (total_requests + int(requests), stacks)
+    return profiles
+
+
+def reset_profiles(directory):
+    os.makedirs(directory, exist_ok=True)
+    for name in os.listdir(directory):
+        if name.endswith('.folded'):
+            os.remove(os.path.join(directory, name))
+    with open(os.path.join(directory, RESET_FILE), 'w') as f:
+        f.write(str(time.time()))
@@ -1,4 +1,5 @@
 from djoser.serializers import UserCreateSerializer as BaseUserCreateSerializer, UserSerializer as BaseUserSerializer
+from rest_framework_simplejwt.serializers import TokenObtainPairSerializer
 
 
 class UserCreateSerializer(BaseUserCreateSerializer):
@@ -15,3 +16,19 @@ class UserSerializer(BaseUserSerializer):
     class Meta(BaseUserSerializer.Meta):
         fields = ['id', 'username', 'email',
                   'first_name', 'last_name']
+
+
+class CustomerTokenObtainPairSerializer(TokenObtainPairSerializer):
+    """
+    Adds customer_id and is_staff to the token, so the store endpoints don't have to look them up on every request
+    (see core/authentication.py). The refresh endpoint copies these claims into the new access tokens.
+    """
+    @classmethod
+    def get_token(cls, user):
+        token = super().get_token(user)
+        # the customer is created by a signal when the user is created. We use the reverse relation
+        # so core doesn't have to import the store app
+        customer = getattr(user, 'customer', None)
+        token['customer_id'] = customer.id if customer else None
+        token['is_staff'] = user.is_staff
+        return token
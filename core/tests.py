@@ -1,3 +1,689 @@
-from django.test import TestCase
+import asyncio
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+from django.contrib.auth import get_user_model
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.core.handlers.asgi import ASGIHandler
+from django.core.management import call_command
+from django.db import connections, router, transaction
+from django.urls import resolve
+from django.http import HttpResponse
+from django.test import AsyncClient, RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from rest_framework import serializers
+from rest_framework.test import APIClient
+from store.cache import clear as clear_cache
+from store.models import Collection, Product
+from . import dbrouter, logs, metrics, outbound, profiling
+from .instrumentation import QueryInstrumentationMiddleware
 
 # Create your tests here.
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    # keep-alive, so we can see if the client reuses its connections
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super().setup()
+        self.server.connections += 1
+
+    def do_GET(self):
+        self.server.requests += 1
+        if self.path.startswith('/slow'):
+            time.sleep(1)
+        status = 500 if self.path.startswith('/fail') else 200
+        body = json.dumps({'path': self.path}).encode()
+        try:
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        except (BrokenPipeError, ConnectionResetError):
+            # the client timed out before /slow answered
+            self.close_connection = True
+
+    def log_message(self, *args):
+        pass
+
+
+class StubServerTestCase(SimpleTestCase):
+    """
+    A local http server instead of httpbin, the tests don't need the internet.
+    """
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+        self.server.daemon_threads = True
+        self.server.connections = 0
+        self.server.requests = 0
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.url = f'http://127.0.0.1:{self.server.server_address[1]}'
+
+
+class OutboundClientTests(StubServerTestCase):
+    def make_client(self, **kwargs):
+        client = outbound.Client(**{'timeout': (1, 0.2), 'failure_threshold': 3, 'reset_timeout': 60, **kwargs})
+        self.addCleanup(client.close)
+        return client
+
+    def test_connections_are_reused(self):
+        client = self.make_client()
+        for _ in range(5):
+            self.assertEqual(client.get(f'{self.url}/ok').json(), {'path': '/ok'})
+        self.assertEqual(self.server.requests, 5)
+        self.assertEqual(self.server.connections, 1)
+
+    def test_slow_host_times_out(self):
+        client = self.make_client()
+        start = time.monotonic()
+        with self.assertRaises(outbound.OutboundError):
+            client.get(f'{self.url}/slow')
+        self.assertLess(time.monotonic() - start, 0.9)
+
+    def test_circuit_opens_and_frees_the_workers(self):
+        client = self.make_client()
+        for _ in range(3):
+            with self.assertRaises(outbound.OutboundError):
+                client.get(f'{self.url}/slow')
+        self.assertEqual(client.breaker.state, outbound.CircuitBreaker.OPEN)
+
+        # the host is not called anymore and the calls fail immediately instead of waiting for the timeout
+        requests = self.server.requests
+        start = time.monotonic()
+        for _ in range(20):
+            with self.assertRaises(outbound.CircuitOpenError):
+                client.get(f'{self.url}/slow')
+        self.assertLess(time.monotonic() - start, 0.1)
+        self.assertEqual(self.server.requests, requests)
+
+    def test_half_open_trial_closes_the_circuit(self):
+        client = self.make_client(reset_timeout=0)
+        for _ in range(3):
+            with self.assertRaises(outbound.OutboundError):
+                client.get(f'{self.url}/fail')
+        self.assertEqual(client.breaker.state, outbound.CircuitBreaker.HALF_OPEN)
+        client.get(f'{self.url}/ok')
+        self.assertEqual(client.breaker.state, outbound.CircuitBreaker.CLOSED)
+
+    def test_async_variant(self):
+        client = self.make_client()
+
+        async def fetch_many():
+            return await asyncio.gather(*[client.aget(f'{self.url}/ok') for _ in range(5)])
+
+        responses = asyncio.run(fetch_many())
+        self.assertEqual([response.status_code for response in responses], [200] * 5)
+
+
+class HelloViewTests(StubServerTestCase):
+    def test_hello_uses_the_outbound_client(self):
+        with override_settings(HTTPBIN_URL=self.url):
+            self.assertEqual(self.client.get('/playground/hello/').status_code, 200)
+            self.assertEqual(self.client.get('/playground/hello2/').status_code, 200)
+        self.assertEqual(self.server.requests, 2)
+
+    def test_hello_still_answers_when_httpbin_is_down(self):
+        self.server.shutdown()
+        self.server.server_close()
+        with override_settings(HTTPBIN_URL=self.url):
+            start = time.monotonic()
+            self.assertEqual(self.client.get('/playground/hello/').status_code, 200)
+        self.assertLess(time.monotonic() - start, 2)
+
+
+class ReplicaRouterTests(TransactionTestCase):
+    """
+    Two SQLite files stand in for the primary (the test database) and a replica. The replica has different rows,
+    so we can see where every query went.
+    """
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        # added after the test case is set up, the test runner only knows about the databases in the settings
+        cls.directory = tempfile.TemporaryDirectory()
+        connections.settings['replica'] = {
+            **connections.settings['default'], 'NAME': os.path.join(cls.directory.name, 'replica.sqlite3')}
+        # sqlite can't create a file in a directory that doesn't exist, this one is always down
+        connections.settings['broken'] = {
+            **connections.settings['default'], 'NAME': os.path.join(cls.directory.name, 'missing', 'db.sqlite3')}
+        call_command('migrate', database='replica', verbosity=0)
+
+    @classmethod
+    def tearDownClass(cls):
+        for alias in ['replica', 'broken']:
+            connections[alias].close()
+            del connections[alias]
+            del connections.settings[alias]
+        cls.directory.cleanup()
+        super().tearDownClass()
+
+    def setUp(self):
+        router.routers[0].down.clear()
+        Collection.objects.create(title='On the primary')
+        Collection.objects.using('replica').all().delete()
+        Collection.objects.using('replica').create(title='On the replica')
+        # the collection we just created is not a recent change for the tests
+        clear_cache()
+
+    def titles(self, response):
+        return [collection['title'] for collection in response.data]
+
+    def request_state(self):
+        state = dbrouter.RoutingState()
+        state.use_replica = True
+        self.addCleanup(dbrouter._state.reset, dbrouter._state.set(state))
+        return state
+
+    def read_through_middleware(self, method='GET'):
+        # what a view with read_from_replica = True reads, django calls process_view inside the middleware
+        class View:
+            read_from_replica = True
+
+        titles = []
+
+        def get_response(request):
+            middleware.process_view(request, View, (), {})
+            titles.extend(Collection.objects.values_list('title', flat=True))
+            return HttpResponse()
+
+        middleware = dbrouter.ReplicaRoutingMiddleware(get_response)
+        middleware(RequestFactory().generic(method, '/'))
+        return titles
+
+    @override_settings(DATABASE_REPLICAS={'replica': 1})
+    def test_marked_views_read_from_the_replica(self):
+        self.assertEqual(self.read_through_middleware(), ['On the replica'])
+        self.assertEqual(self.read_through_middleware('POST'), ['On the primary'])
+
+    def test_without_replicas_everything_uses_the_primary(self):
+        self.assertEqual(self.read_through_middleware(), ['On the primary'])
+
+    @override_settings(DATABASE_REPLICAS={'replica': 1})
+    def test_catalog_reads_go_to_the_replica(self):
+        response = APIClient().get('/store/collections/')
+        self.assertEqual(self.titles(response), ['On the replica'])
+
+    @override_settings(DATABASE_REPLICAS={'replica': 1})
+    def test_cache_is_filled_from_the_primary_right_after_a_change(self):
+        Collection.objects.create(title='New')
+        # a lagging replica would put the old rows in the cache under the new version
+        response = APIClient().get('/store/collections/')
+        self.assertEqual(set(self.titles(response)), {'On the primary', 'New'})
+
+        with mock.patch('store.cache.REPLICA_MAX_LAG_SECONDS', 0.001):
+            Collection.objects.create(title='Newer')
+        time.sleep(0.01)
+        # the replica had time to get the change
+        response = APIClient().get('/store/collections/')
+        self.assertEqual(self.titles(response), ['On the replica'])
+
+    @override_settings(DATABASE_REPLICAS={'replica': 1})
+    def test_writes_go_to_the_primary(self):
+        client = APIClient()
+        client.force_authenticate(get_user_model()(id=1, is_staff=True))
+        response = client.post('/store/collections/', {'title': 'New'})
+        self.assertEqual(response.status_code, 201)
+        self.assertTrue(Collection.objects.using('default').filter(title='New').exists())
+
+    @override_settings(DATABASE_REPLICAS={'replica': 1})
+    def test_reads_after_a_write_use_the_primary(self):
+        self.request_state()
+        self.assertEqual(list(Collection.objects.values_list('title', flat=True)), ['On the replica'])
+        Collection.objects.create(title='New')
+        self.assertEqual(set(Collection.objects.values_list('title', flat=True)), {'On the primary', 'New'})
+
+    @override_settings(DATABASE_REPLICAS={'replica': 1})
+    def test_reads_in_a_transaction_use_the_primary(self):
+        self.request_state()
+        with transaction.atomic():
+            self.assertEqual(list(Collection.objects.values_list('title', flat=True)), ['On the primary'])
+
+    @override_settings(DATABASE_REPLICAS={'broken': 100, 'replica': 1})
+    def test_replicas_that_are_down_are_skipped(self):
+        self.request_state()
+        for _ in range(5):
+            self.assertEqual(list(Collection.objects.values_list('title', flat=True)), ['On the replica'])
+        self.assertIn('broken', router.routers[0].down)
+
+    @override_settings(DATABASE_REPLICAS={'broken': 1})
+    def test_primary_when_no_replica_is_available(self):
+        self.request_state()
+        self.assertEqual(list(Collection.objects.values_list('title', flat=True)), ['On the primary'])
+
+
+@override_settings(REQUEST_INSTRUMENTATION={'ENABLED': True, 'N_PLUS_ONE_THRESHOLD': 3})
+class QueryInstrumentationTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        for i in range(6):
+            collection = Collection.objects.create(title=f'Collection {i}')
+            Product.objects.create(title=f'Product {i}', price=1, inventory=1, collection=collection)
+
+    def setUp(self):
+        clear_cache()
+
+    def test_server_timing_and_log_line(self):
+        with self.assertLogs('core.instrumentation', 'INFO') as logs:
+            response = APIClient().get('/store/collections/')
+        timing = response['Server-Timing']
+        self.assertRegex(timing, r'db;dur=[\d.]+;desc="1 queries"')
+        self.assertRegex(timing, r'serializer;dur=[\d.]+')
+        self.assertRegex(timing, r'view;dur=[\d.]+')
+
+        line = vars(logs.records[0])
+        self.assertEqual(line['route'], 'store/collections/')
+        self.assertEqual(line['status'], 200)
+        self.assertEqual(line['queries'], 1)
+        self.assertNotIn('n_plus_one', line)
+
+    def n_plus_one_view(self, request):
+        counts = []
+        for collection in Collection.objects.all():
+            # the products of every collection, one query per collection
+            counts.append(collection.products.count())
+        return HttpResponse(str(counts))
+
+    def test_n_plus_one_names_the_source(self):
+        middleware = QueryInstrumentationMiddleware(self.n_plus_one_view)
+        with self.assertLogs('core.instrumentation', 'WARNING') as logs:
+            middleware(RequestFactory().get('/'))
+        line = vars(logs.records[0])
+        self.assertEqual(line['queries'], 7)
+        [n_plus_one] = line['n_plus_one']
+        self.assertEqual(n_plus_one['count'], 6)
+        self.assertRegex(n_plus_one['source'], r'^QueryInstrumentationTests.n_plus_one_view \(core/tests.py:\d+\)$')
+
+    def test_n_plus_one_in_a_serializer_field(self):
+        class CollectionWithProductsSerializer(serializers.ModelSerializer):
+            products = serializers.StringRelatedField(many=True)
+
+            class Meta:
+                model = Collection
+                fields = ['id', 'products']
+
+        def view(request):
+            return HttpResponse(json.dumps(CollectionWithProductsSerializer(Collection.objects.all(), many=True).data))
+
+        with self.assertLogs('core.instrumentation', 'WARNING') as logs:
+            QueryInstrumentationMiddleware(view)(RequestFactory().get('/'))
+        [n_plus_one] = logs.records[0].n_plus_one
+        self.assertEqual(n_plus_one['source'], 'CollectionWithProductsSerializer.products')
+
+    @override_settings(REQUEST_INSTRUMENTATION={'ENABLED': False})
+    def test_disabled_is_not_in_the_chain(self):
+        with self.assertRaises(MiddlewareNotUsed):
+            QueryInstrumentationMiddleware(lambda request: HttpResponse())
+        self.assertFalse(APIClient().get('/store/collections/').has_header('Server-Timing'))
+
+
+class ProfilingTests(SimpleTestCase):
+    ROUTE = 'store/collections/'
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.settings = override_settings(PROFILING={
+            'ENABLED': True, 'ROUTES': {self.ROUTE: 1}, 'DIRECTORY': self.directory, 'WRITE_INTERVAL': 0,
+            'INTERVAL': 0.001})
+        self.settings.enable()
+
+    def tearDown(self):
+        self.settings.disable()
+
+    def slow_view(self, request):
+        time.sleep(0.05)
+        return HttpResponse()
+
+    def get(self, middleware, path):
+        # what django's handler does: resolve the url, process_view of the middlewares, then the view
+        def get_response(request):
+            middleware.process_view(request, self.slow_view, (), {})
+            return self.slow_view(request)
+
+        middleware.get_response = get_response
+        request = RequestFactory().get(path)
+        request.resolver_match = resolve(path)
+        return middleware(request)
+
+    def test_sampled_requests_are_written_per_route(self):
+        middleware = profiling.ProfilingMiddleware(None)
+        self.get(middleware, '/store/collections/')
+        self.get(middleware, '/store/collections/')
+
+        requests, stacks = profiling.read_profiles(self.directory)[self.ROUTE]
+        self.assertEqual(requests, 2)
+        self.assertTrue(any(stack.endswith('core.tests:slow_view') for stack in stacks))
+
+    def test_router_routes_and_urls(self):
+        with override_settings(PROFILING={**profiling.get_options(), 'ROUTES': {
+                '/store/orders/': 1, 'store/products/1/': 1}}):
+            middleware = profiling.ProfilingMiddleware(None)
+        # the route of the DRF router is 'store/orders/$'
+        self.get(middleware, '/store/orders/')
+        self.get(middleware, '/store/products/1/')
+        self.get(middleware, '/store/products/2/')
+        profiles = profiling.read_profiles(self.directory)
+        self.assertEqual({route: requests for route, (requests, _) in profiles.items()},
+                         {'store/orders/': 1, 'store/products/1/': 1})
+
+    def test_unknown_routes_are_logged(self):
+        with override_settings(PROFILING={**profiling.get_options(), 'ROUTES': {
+                'store/orders/': 1, 'store/^orders/(?P<pk>[^/.]+)/$': 1, 'store/order/': 1}}):
+            with self.assertLogs('core.profiling', 'WARNING') as logs:
+                profiling.ProfilingMiddleware(None)
+        [warning] = logs.output
+        self.assertIn("'store/order/'", warning)
+
+    def test_other_routes_are_not_sampled(self):
+        middleware = profiling.ProfilingMiddleware(None)
+        self.get(middleware, '/store/products/')
+        self.assertEqual(profiling.read_profiles(self.directory), {})
+
+    def test_files_of_every_process_are_merged(self):
+        with open(os.path.join(self.directory, 'store_collections.1.folded'), 'w') as f:
+            f.write(f'# {self.ROUTE} 3\na;b 5\na;c 1\n')
+        with open(os.path.join(self.directory, 'store_collections.2.folded'), 'w') as f:
+            f.write(f'# {self.ROUTE} 1\na;b 2\n')
+
+        requests, stacks = profiling.read_profiles(self.directory)[self.ROUTE]
+        self.assertEqual(requests, 4)
+        self.assertEqual(stacks, {'a;b': 7, 'a;c': 1})
+
+    def test_reset_clears_the_workers(self):
+        middleware = profiling.ProfilingMiddleware(None)
+        self.get(middleware, '/store/collections/')
+        # the reset file must be newer than the last reset of the worker
+        time.sleep(0.01)
+        call_command('dump_profiles', '--reset', output=os.path.join(self.directory, 'merged'),
+                     stdout=open(os.devnull, 'w'))
+        self.assertTrue(os.path.exists(os.path.join(self.directory, 'merged', 'store_collections.folded')))
+        self.assertEqual(profiling.read_profiles(self.directory), {})
+
+        # the worker forgets what it had before the reset
+        self.get(middleware, '/store/collections/')
+        requests, _ = profiling.read_profiles(self.directory)[self.ROUTE]
+        self.assertEqual(requests, 1)
+
+    def test_disabled_is_not_in_the_chain(self):
+        with override_settings(PROFILING={'ENABLED': False, 'ROUTES': {self.ROUTE: 1}}):
+            with self.assertRaises(MiddlewareNotUsed):
+                profiling.ProfilingMiddleware(None)
+        with override_settings(PROFILING={'ENABLED': True}):
+            with self.assertRaises(MiddlewareNotUsed):
+                profiling.ProfilingMiddleware(None)
+
+
+class MetricsTests(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.settings = override_settings(METRICS={
+            'ENABLED': True, 'DIRECTORY': self.directory, 'WRITE_INTERVAL': 0, 'TOKEN': 'secret'})
+        self.settings.enable()
+        metrics.registry.clear()
+        clear_cache()
+
+    def tearDown(self):
+        self.settings.disable()
+        metrics.registry.clear()
+
+    def scrape(self):
+        response = self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer secret')
+        self.assertEqual(response.status_code, 200)
+        return response.content.decode()
+
+    def test_requests_are_labeled_by_route(self):
+        collection = Collection.objects.create(title='a')
+        self.client.get(f'/store/collections/{collection.id}/')
+        self.client.get('/store/collections/0/')
+        self.client.get('/not-a-page/')
+
+        text = self.scrape()
+        route = 'store/collections/<int:pk>/'
+        self.assertIn(f'storefront_http_requests_total{{method="GET",route="{route}",status="200"}} 1.0', text)
+        self.assertIn(f'storefront_http_requests_total{{method="GET",route="{route}",status="404"}} 1.0', text)
+        self.assertIn('storefront_http_requests_total{method="GET",route="unmatched",status="404"} 1.0', text)
+        self.assertIn(f'storefront_http_request_duration_seconds_count{{method="GET",route="{route}"}} 2.0', text)
+        self.assertIn(f'storefront_http_request_duration_seconds_bucket{{le="+Inf",method="GET",route="{route}"}} 2.0',
+                      text)
+        self.assertIn('# TYPE storefront_http_request_duration_seconds histogram', text)
+
+    def test_queries_are_counted(self):
+        Collection.objects.create(title='a')
+        self.client.get('/store/collections/')
+        text = self.scrape()
+        [line] = [line for line in text.splitlines()
+                  if line.startswith('storefront_http_request_db_queries_sum{method="GET",route="store/collections/"}')]
+        self.assertGreater(float(line.split()[-1]), 0)
+
+    def test_buckets_are_cumulative_and_in_order(self):
+        histogram = metrics.Histogram(metrics.registry, 'test_seconds', [0.1, 1])
+        histogram.observe({'route': 'r'}, 0.5)
+        histogram.observe({'route': 'r'}, 0.05)
+        text = metrics.exposition(metrics.registry.values)
+        lines = [line for line in text.splitlines() if line.startswith('test_seconds')]
+        self.assertEqual(lines, [
+            'test_seconds_bucket{le="0.1",route="r"} 1.0',
+            'test_seconds_bucket{le="1",route="r"} 2.0',
+            'test_seconds_bucket{le="+Inf",route="r"} 2.0',
+            'test_seconds_sum{route="r"} 0.55',
+            'test_seconds_count{route="r"} 2.0',
+        ])
+
+    def test_every_bucket_is_exposed_from_the_first_observation(self):
+        histogram = metrics.Histogram(metrics.registry, 'test_latency', [0.1, 1])
+        histogram.observe({'route': 'r'}, 5)
+        text = metrics.exposition(metrics.registry.values)
+        lines = [line for line in text.splitlines() if line.startswith('test_latency_bucket')]
+        self.assertEqual(lines, [
+            'test_latency_bucket{le="0.1",route="r"} 0.0',
+            'test_latency_bucket{le="1",route="r"} 0.0',
+            'test_latency_bucket{le="+Inf",route="r"} 1.0',
+        ])
+
+    def test_the_files_of_every_worker_are_added_up(self):
+        self.client.get('/store/collections/')
+        # another gunicorn worker
+        with open(os.path.join(self.directory, '1.json'), 'w') as f:
+            json.dump([['storefront_http_requests_total', 'storefront_http_requests_total',
+                        [['method', 'GET'], ['route', 'store/collections/'], ['status', '200']], 4]], f)
+
+        text = self.scrape()
+        self.assertIn('storefront_http_requests_total{method="GET",route="store/collections/",status="200"} 5.0', text)
+
+    def test_token(self):
+        self.assertEqual(self.client.get('/metrics').status_code, 401)
+        self.assertEqual(self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer other').status_code, 401)
+        # no token: closed unless DEBUG is on
+        with override_settings(METRICS={'ENABLED': True, 'DIRECTORY': self.directory}):
+            self.assertEqual(self.client.get('/metrics').status_code, 403)
+            with override_settings(DEBUG=True):
+                self.assertEqual(self.client.get('/metrics').status_code, 200)
+
+    def test_requests_leave_the_write_to_the_thread(self):
+        with mock.patch.object(metrics.registry, 'write') as write:
+            self.client.get('/store/collections/')
+        write.assert_not_called()
+        self.assertEqual(metrics.registry.writer_pid, os.getpid())
+
+    def test_files_of_dead_processes_are_archived(self):
+        dead = os.fork()
+        if dead == 0:
+            os._exit(0)
+        os.waitpid(dead, 0)
+        sample = ['storefront_http_requests_total', 'storefront_http_requests_total',
+                  [['method', 'GET'], ['route', 'store/collections/'], ['status', '200']]]
+        for pid, value in [(dead, 2), (os.getpid(), 3)]:
+            with open(os.path.join(self.directory, f'{pid}.json'), 'w') as f:
+                json.dump([sample + [value]], f)
+
+        # the first write of this process: the file of its pid is from a process that had the same pid
+        with mock.patch.object(metrics.registry, 'pid', None):
+            metrics.registry.write(self.directory)
+        self.assertEqual({name for name in os.listdir(self.directory) if name.endswith('.json')},
+                         {'archive.json', f'{os.getpid()}.json'})
+        self.assertIn('storefront_http_requests_total{method="GET",route="store/collections/",status="200"} 5.0',
+                      self.scrape())
+
+    def test_disabled(self):
+        with override_settings(METRICS={'ENABLED': False}):
+            with self.assertRaises(MiddlewareNotUsed):
+                metrics.MetricsMiddleware(lambda request: HttpResponse())
+            self.assertEqual(self.client.get('/metrics').status_code, 404)
+
+
+class LogPipelineTests(SimpleTestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'test.{pid}.log')
+        self.logger = logging.getLogger('core.tests.pipeline')
+        self.logger.propagate = False
+        self.logger.setLevel(logging.INFO)
+
+    def tearDown(self):
+        for handler in self.logger.handlers:
+            self.logger.removeHandler(handler)
+            handler.close()
+
+    def add_handler(self, *filters, **options):
+        handler = logs.QueueHandler(self.filename, console=False, **options)
+        for log_filter in filters:
+            handler.addFilter(log_filter)
+        self.logger.addHandler(handler)
+        return handler
+
+    def read_lines(self, handler):
+        handler.flush()
+        with open(self.filename.format(pid=os.getpid())) as f:
+            return [json.loads(line) for line in f]
+
+    def test_files_of_dead_processes_are_removed(self):
+        # a child that already exited: its pid is not running anymore
+        dead = os.fork()
+        if dead == 0:
+            os._exit(0)
+        os.waitpid(dead, 0)
+        for name in [f'test.{dead}.log', f'test.{dead}.log.1', f'test.{os.getppid()}.log', 'other.log']:
+            open(os.path.join(self.directory, name), 'w').close()
+
+        self.add_handler()
+        self.assertEqual(sorted(os.listdir(self.directory)),
+                         sorted([f'test.{os.getppid()}.log', f'test.{os.getpid()}.log', 'other.log']))
+
+    def test_json_lines_with_the_request(self):
+        handler = self.add_handler(logs.RequestContextFilter())
+
+        def view(request):
+            self.logger.info('hello %s', 'world', extra={'order_id': 5})
+            return HttpResponse()
+
+        response = logs.RequestContextMiddleware(view)(RequestFactory().get('/store/', HTTP_X_REQUEST_ID='abc-123'))
+        self.assertEqual(response['X-Request-ID'], 'abc-123')
+        try:
+            1 / 0
+        except ZeroDivisionError:
+            self.logger.exception('outside of a request')
+
+        first, second = self.read_lines(handler)
+        self.assertEqual(first['message'], 'hello world')
+        self.assertEqual(first['request_id'], 'abc-123')
+        self.assertEqual(first['path'], '/store/')
+        self.assertEqual(first['order_id'], 5)
+        self.assertIn('elapsed_ms', first)
+        self.assertNotIn('request_id', second)
+        self.assertIn('ZeroDivisionError', second['exception'])
+
+    def test_invalid_request_ids_are_replaced(self):
+        response = logs.RequestContextMiddleware(lambda request: HttpResponse())(
+            RequestFactory().get('/', HTTP_X_REQUEST_ID='<script>'))
+        self.assertRegex(response['X-Request-ID'], r'^[0-9a-f]{32}$')
+
+    def test_sampling(self):
+        handler = self.add_handler(logs.SamplingFilter(rate=3, per=60))
+        for i in range(10):
+            self.logger.info('chatty %s', i)
+            self.logger.warning('important %s', i)
+
+        lines = self.read_lines(handler)
+        self.assertEqual([line['message'] for line in lines if line['level'] == 'INFO'],
+                         ['chatty 0', 'chatty 1', 'chatty 2'])
+        self.assertEqual(len([line for line in lines if line['level'] == 'WARNING']), 10)
+
+    def test_sampling_reports_what_it_dropped(self):
+        sampling = logs.SamplingFilter(rate=1, per=0.05)
+        handler = self.add_handler(sampling)
+        for i in range(2):
+            for _ in range(5):
+                self.logger.info('chatty')
+            time.sleep(0.06)
+
+        first, second = self.read_lines(handler)
+        self.assertNotIn('sampled_out', first)
+        self.assertEqual(second['sampled_out'], 4)
+
+    def test_rotation(self):
+        handler = self.add_handler(max_bytes=1000, backup_count=2)
+        for i in range(100):
+            self.logger.info('line %s', i)
+        handler.flush()
+        names = sorted(os.listdir(self.directory))
+        self.assertEqual(names, [f'test.{os.getpid()}.log', f'test.{os.getpid()}.log.1', f'test.{os.getpid()}.log.2'])
+
+    def test_a_full_queue_drops_instead_of_blocking(self):
+        handler = self.add_handler(queue_size=5)
+        # nobody reads the queue
+        handler.stop()
+        start = time.perf_counter()
+        for i in range(100):
+            self.logger.info('line %s', i)
+        self.assertLess(time.perf_counter() - start, 1)
+        self.assertEqual(handler.dropped, 95)
+
+
+@override_settings(
+    # WhiteNoise is sync only, with it the chain can't stay async (see MIDDLEWARE)
+    MIDDLEWARE=[name for name in settings.MIDDLEWARE if not name.startswith('whitenoise.')],
+    REQUEST_INSTRUMENTATION={'ENABLED': True},
+    PROFILING={'ENABLED': True, 'ROUTES': {'store/async/collections/': 1}, 'DIRECTORY': tempfile.mkdtemp(),
+               'WRITE_INTERVAL': 0},
+)
+class AsyncMiddlewareTests(TestCase):
+    def setUp(self):
+        self.settings = override_settings(METRICS={'ENABLED': True, 'DIRECTORY': tempfile.mkdtemp()})
+        self.settings.enable()
+        metrics.registry.clear()
+
+    def tearDown(self):
+        self.settings.disable()
+        metrics.registry.clear()
+
+    def adaptations(self, middleware):
+        # django logs every sync/async adaptation of the chain when DEBUG is on
+        with override_settings(DEBUG=True, MIDDLEWARE=middleware), \
+                self.assertLogs('django.request', 'DEBUG') as logs:
+            logging.getLogger('django.request').debug('loaded')
+            ASGIHandler().load_middleware(is_async=True)
+        return [record.getMessage() for record in logs.records if 'adapted' in record.getMessage()]
+
+    def test_the_handler_chain_stays_async(self):
+        self.assertEqual(self.adaptations(settings.MIDDLEWARE), [])
+        # with WhiteNoise everything above it is sync
+        self.assertTrue(self.adaptations(settings.MIDDLEWARE + ['whitenoise.middleware.WhiteNoiseMiddleware']))
+
+    async def test_async_view_through_the_async_chain(self):
+        await Collection.objects.acreate(title='a')
+        with self.assertLogs('core.instrumentation', 'INFO'):
+            response = await AsyncClient().get('/store/async/collections/')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.has_header('X-Request-ID'))
+        # the queries of the async ORM run in another thread, the wrappers of the request still see them
+        self.assertRegex(response['Server-Timing'], r'db;dur=[\d.]+;desc="1 queries"')
+
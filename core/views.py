@@ -1,3 +1,10 @@
 from django.shortcuts import render
+from rest_framework_simplejwt.views import TokenObtainPairView
+from .serializers import CustomerTokenObtainPairSerializer
 
 # Create your views here.
+
+
+class CustomerTokenObtainPairView(TokenObtainPairView):
+    # /auth/jwt/create, the same as the djoser one but the tokens also carry customer_id and is_staff
+    serializer_class = CustomerTokenObtainPairSerializer
@@ -0,0 +1,173 @@
+import atexit
+import logging
+import os
+import threading
+import time
+from collections import defaultdict
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.db import connections, transaction
+from django.db.models import Count
+from .models import LikeCounter, LikedItem
+
+logger = logging.getLogger(__name__)
+
+# Like counters
+# Counting the LikedItem rows of a popular product on every page view is slow, and doing UPDATE count = count + 1 on
+# every click makes all the clicks on that product wait for the same row lock.
+# Instead every process keeps the +1/-1 in memory (record) and every few seconds a thread of the process writes the
+# counters of the objects that changed (flush): a thousand likes on a product become ONE update.
+# The flush writes the absolute count (one COUNT of the LikedItem rows per object), not counter + delta: the deltas
+# only say which counters are stale, and until the flush get_counts adds them to what the counter says. So a flush
+# can't count a like twice, after the recount_likes command or after another process counted it too, and a worker
+# that dies before its flush is corrected by the next flush of the same object.
+# The likes of an idle worker reach LikeCounter within 2 * FLUSH_INTERVAL seconds, sooner when MAX_PENDING objects
+# are waiting. The request that records a like never waits for a flush.
+# The recount_likes command rebuilds every counter from the LikedItem rows, it can run while likes come in.
+
+FLUSH_INTERVAL = getattr(settings, 'LIKES_FLUSH_INTERVAL', 5)
+# flush sooner when this many different objects are waiting
+MAX_PENDING = 1000
+
+_lock = threading.Lock()
+# (content_type_id, object_id) -> delta
+_pending = defaultdict(int)
+_last_flush = time.monotonic()
+# record sets it to make the flusher thread flush before FLUSH_INTERVAL
+_flush_now = threading.Event()
+# the process that started the flusher thread. A forked gunicorn worker doesn't have the thread of its parent
+_flusher_pid = None
+
+
+def like(user, obj):
+    """
+    Returns True if it is a new like. Liking twice does nothing.
+    """
+    content_type = ContentType.objects.get_for_model(obj)
+    _, created = LikedItem.objects.get_or_create(user=user, content_type=content_type, object_id=obj.pk)
+    if created:
+        # only count it if the like is committed
+        transaction.on_commit(lambda: record(content_type.id, obj.pk, 1))
+    return created
+
+
+def unlike(user, obj):
+    content_type = ContentType.objects.get_for_model(obj)
+    deleted, _ = LikedItem.objects.filter(user=user, content_type=content_type, object_id=obj.pk).delete()
+    if deleted:
+        transaction.on_commit(lambda: record(content_type.id, obj.pk, -deleted))
+    return bool(deleted)
+
+
+def record(content_type_id, object_id, delta):
+    global _flusher_pid
+    with _lock:
+        _pending[(content_type_id, object_id)] += delta
+        due = len(_pending) >= MAX_PENDING or time.monotonic() - _last_flush >= FLUSH_INTERVAL
+        if _flusher_pid != os.getpid():
+            _flusher_pid = os.getpid()
+            threading.Thread(target=flush_periodically, name='like-counters', daemon=True).start()
+    # the flusher thread writes them, the request only adds to a dict
+    if due:
+        _flush_now.set()
+
+
+def flush():
+    """
+    Add the pending deltas to the counters. Returns the number of counters updated.
+    """
+    global _pending, _last_flush
+    with _lock:
+        pending, _pending = _pending, defaultdict(int)
+        _last_flush = time.monotonic()
+    pending = {key: delta for key, delta in pending.items() if delta}
+    if not pending:
+        return 0
+
+    try:
+        apply(pending)
+    except Exception:
+        # put them back, the next flush tries again
+        logger.exception('Could not flush %s like counters', len(pending))
+        with _lock:
+            for key, delta in pending.items():
+                _pending[key] += delta
+        return 0
+    return len(pending)
+
+
+def flush_periodically():
+    while True:
+        asked = _flush_now.wait(FLUSH_INTERVAL)
+        _flush_now.clear()
+        with _lock:
+            due = bool(_pending) and (asked or time.monotonic() - _last_flush >= FLUSH_INTERVAL)
+        if due:
+            flush()
+            # this thread opened its own database connection
+            connections.close_all()
+
+
+def apply(pending):
+    with transaction.atomic():
+        # create the missing counters first. ignore_conflicts because another process can create them at the same time
+        LikeCounter.objects.bulk_create(
+            [LikeCounter(content_type_id=content_type_id, object_id=object_id)
+             for content_type_id, object_id in pending],
+            ignore_conflicts=True)
+        content_type_ids = {content_type_id for content_type_id, _ in pending}
+        object_ids = {object_id for _, object_id in pending}
+        # lock the rows in id order, two processes flushing the same counters wait for each other instead of deadlocking
+        counters = list(LikeCounter.objects
+                        .select_for_update()
+                        .filter(content_type_id__in=content_type_ids, object_id__in=object_ids)
+                        .order_by('id'))
+        # counted after the lock: the process that flushed before us committed, we see its likes too
+        counts = {
+            (row['content_type_id'], row['object_id']): row['count']
+            for row in LikedItem.objects
+            .filter(content_type_id__in=content_type_ids, object_id__in=object_ids)
+            .values('content_type_id', 'object_id')
+            .annotate(count=Count('id'))
+        }
+        updated = []
+        for counter in counters:
+            key = (counter.content_type_id, counter.object_id)
+            if key in pending:
+                counter.count = counts.get(key, 0)
+                updated.append(counter)
+        LikeCounter.objects.bulk_update(updated, ['count'], batch_size=1000)
+
+
+def get_counts(obj_type, objects):
+    """
+    The like count of many objects in one query: {object_id: count}. It includes what this process didn't flush yet.
+    """
+    content_type = ContentType.objects.get_for_model(obj_type)
+    object_ids = [getattr(obj, 'pk', obj) for obj in objects]
+    counts = dict.fromkeys(object_ids, 0)
+    counts.update(LikeCounter.objects
+                  .filter(content_type=content_type, object_id__in=object_ids)
+                  .values_list('object_id', 'count'))
+    with _lock:
+        for object_id in object_ids:
+            counts[object_id] += _pending.get((content_type.id, object_id), 0)
+    return counts
+
+
+def recount():
+    """
+    Rebuild every counter from the LikedItem rows. Returns the number of counters.
+    The deltas the processes didn't flush yet stay: their flush writes the count again, it doesn't add them.
+    """
+    with transaction.atomic():
+        LikeCounter.objects.all().delete()
+        counters = LikeCounter.objects.bulk_create([
+            LikeCounter(**row)
+            for row in LikedItem.objects.values('content_type_id', 'object_id').annotate(count=Count('id'))
+        ], batch_size=1000)
+    return len(counters)
+
+
+# don't lose the last deltas when the worker stops normally
+atexit.register(flush)
@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+from likes import counters
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the like counters from the liked items, for example after a worker died before flushing'
+
+    def handle(self, *args, **options):
+        count = counters.recount()
+        self.stdout.write(self.style.SUCCESS(f'Recounted {count} objects'))
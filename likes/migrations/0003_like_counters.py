@@ -0,0 +1,61 @@
+# Generated by Django 4.1 on 2026-10-16 23:49
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def remove_duplicate_likes(apps, schema_editor):
+    # keep the first like of every (user, object), the unique constraint would fail on the others
+    LikedItem = apps.get_model('likes', 'LikedItem')
+    duplicates = LikedItem.objects \
+        .values('user_id', 'content_type_id', 'object_id') \
+        .annotate(first_id=models.Min('id'), count=models.Count('id')) \
+        .filter(count__gt=1)
+    for row in duplicates:
+        LikedItem.objects \
+            .filter(user_id=row['user_id'], content_type_id=row['content_type_id'], object_id=row['object_id']) \
+            .exclude(id=row['first_id']) \
+            .delete()
+
+
+def count_existing_likes(apps, schema_editor):
+    LikedItem = apps.get_model('likes', 'LikedItem')
+    LikeCounter = apps.get_model('likes', 'LikeCounter')
+    LikeCounter.objects.bulk_create([
+        LikeCounter(**row)
+        for row in LikedItem.objects.values('content_type_id', 'object_id').annotate(count=models.Count('id'))
+    ], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('likes', '0002_likeditem_object_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LikeCounter',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('object_id', models.PositiveIntegerField()),
+                ('count', models.IntegerField(default=0)),
+            ],
+        ),
+        migrations.RunPython(remove_duplicate_likes, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='likeditem',
+            constraint=models.UniqueConstraint(fields=('user', 'content_type', 'object_id'), name='unique_like'),
+        ),
+        migrations.AddField(
+            model_name='likecounter',
+            name='content_type',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='contenttypes.contenttype'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='likecounter',
+            unique_together={('content_type', 'object_id')},
+        ),
+        migrations.RunPython(count_existing_likes, migrations.RunPython.noop),
+    ]
@@ -1,3 +1,4 @@
+from collections import defaultdict
 from django.db import models
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.contenttypes.fields import GenericForeignKey
@@ -8,6 +9,38 @@ from django.conf import settings
 # Create your models here.
 
 
+class LikedItemManager(models.Manager):
+    def get_for_objects(self, obj_type, objects):
+        """
+            Get the likes of many objects of the same model in ONE query. objects can be a queryset, a list of
+            model instances or a list of ids. Returns {object_id: [liked_item, ...]}.
+        """
+        content_type = ContentType.objects.get_for_model(obj_type)
+        if isinstance(objects, models.QuerySet):
+            object_ids = objects.values('pk')
+        else:
+            object_ids = [getattr(obj, 'pk', obj) for obj in objects]
+
+        likes = defaultdict(list)
+        for item in self.filter(content_type=content_type, object_id__in=object_ids):
+            likes[item.object_id].append(item)
+        return likes
+
+    def liked_by(self, user, obj_type, objects):
+        """
+            Which of these objects did the user like? One query, returns a set of object ids.
+        """
+        content_type = ContentType.objects.get_for_model(obj_type)
+        if isinstance(objects, models.QuerySet):
+            object_ids = objects.values('pk')
+        else:
+            object_ids = [getattr(obj, 'pk', obj) for obj in objects]
+
+        return set(self
+                   .filter(user=user, content_type=content_type, object_id__in=object_ids)
+                   .values_list('object_id', flat=True))
+
+
 class LikedItem(models.Model):
     user = models.ForeignKey(settings.AUTH_USER_MODEL,
                              on_delete=models.CASCADE)
@@ -15,5 +48,29 @@ class LikedItem(models.Model):
     object_id = models.PositiveIntegerField()
     content_object = GenericForeignKey()
 
+    objects = LikedItemManager()
+
+    class Meta:
+        # the likes of an object are always looked up by both columns
+        indexes = [
+            models.Index(fields=['content_type', 'object_id']),
+        ]
+        # a user likes something once. This also makes get_or_create in counters.like() safe with concurrent clicks
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'content_type', 'object_id'], name='unique_like'),
+        ]
+
     def __str__(self):
         return f"{self.user} likes {self.content_object}"
+
+
+class LikeCounter(models.Model):
+    """
+    The number of likes of an object. It is updated in batches by likes/counters.py, don't update it directly.
+    """
+    content_type = models.ForeignKey(ContentType, on_delete=models.CASCADE)
+    object_id = models.PositiveIntegerField()
+    count = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = [['content_type', 'object_id']]
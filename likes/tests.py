@@ -1,3 +1,109 @@
+import os
+import threading
+import time
+from unittest import mock
+from django.contrib.auth import get_user_model
 from django.test import TestCase
+from . import counters
+from .models import LikeCounter, LikedItem
+
+User = get_user_model()
 
 # Create your tests here.
+
+
+class LikeCounterTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        # anything can be liked, users are the simplest model we have here
+        cls.users = [User.objects.create_user(username=f'user{i}', email=f'user{i}@domain.com') for i in range(20)]
+        cls.popular, cls.other = cls.users[0], cls.users[1]
+
+    def setUp(self):
+        counters._pending.clear()
+        # only explicit flushes in these tests
+        patcher = mock.patch.object(counters, 'FLUSH_INTERVAL', 3600)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def like(self, user, obj):
+        with self.captureOnCommitCallbacks(execute=True):
+            return counters.like(user, obj)
+
+    def test_likes_are_counted_once(self):
+        self.assertTrue(self.like(self.users[2], self.popular))
+        self.assertFalse(self.like(self.users[2], self.popular))
+        self.assertEqual(counters.get_counts(User, [self.popular])[self.popular.id], 1)
+        self.assertEqual(LikedItem.objects.count(), 1)
+
+    def test_many_likes_become_one_update(self):
+        for user in self.users:
+            self.like(user, self.popular)
+        self.like(self.users[3], self.other)
+        # nothing is written to the counters until the flush
+        self.assertFalse(LikeCounter.objects.exists())
+        self.assertEqual(counters.get_counts(User, [self.popular, self.other]),
+                         {self.popular.id: 20, self.other.id: 1})
+
+        # insert missing counters, lock them, count the liked items and one bulk update
+        with self.assertNumQueries(6):
+            self.assertEqual(counters.flush(), 2)
+        self.assertEqual(LikeCounter.objects.get(object_id=self.popular.id).count, 20)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            counters.unlike(self.users[5], self.popular)
+        counters.flush()
+        self.assertEqual(LikeCounter.objects.get(object_id=self.popular.id).count, 19)
+
+    def test_failed_flush_keeps_the_deltas(self):
+        self.like(self.users[2], self.popular)
+        with mock.patch.object(counters, 'apply', side_effect=Exception('database is down')):
+            self.assertEqual(counters.flush(), 0)
+        self.assertEqual(counters.flush(), 1)
+        self.assertEqual(LikeCounter.objects.get(object_id=self.popular.id).count, 1)
+
+    def test_idle_process_flushes_in_the_background(self):
+        flushed = threading.Event()
+
+        def flush():
+            if threading.current_thread() is not threading.main_thread():
+                flushed.set()
+
+        with mock.patch.object(counters, 'FLUSH_INTERVAL', 0.05), mock.patch.object(counters, 'flush', flush), \
+                mock.patch.object(counters, '_flusher_pid', None):
+            counters._last_flush = time.monotonic()
+            # not due yet, and no other like comes
+            counters.record(1, self.popular.id, 1)
+            self.assertTrue(flushed.wait(2))
+            counters._pending.clear()
+
+    def test_liked_by_many_objects_in_one_query(self):
+        user = self.users[2]
+        self.like(user, self.users[5])
+        self.like(user, self.users[7])
+        with self.assertNumQueries(1):
+            liked = LikedItem.objects.liked_by(user, User, self.users)
+        self.assertEqual(liked, {self.users[5].id, self.users[7].id})
+
+    def test_recount_from_the_liked_items(self):
+        self.like(self.users[2], self.popular)
+        self.like(self.users[3], self.popular)
+        counters._pending.clear()
+        self.assertEqual(counters.recount(), 1)
+        self.assertEqual(counters.get_counts(User, [self.popular])[self.popular.id], 2)
+
+    def test_recount_while_likes_are_pending(self):
+        # another worker recounts while this one still has the like in memory
+        self.like(self.users[2], self.popular)
+        counters.recount()
+        counters.flush()
+        self.assertEqual(LikeCounter.objects.get(object_id=self.popular.id).count, 1)
+
+    def test_due_flush_is_left_to_the_thread(self):
+        with mock.patch.object(counters, 'MAX_PENDING', 1), mock.patch.object(counters, 'flush') as flush, \
+                mock.patch.object(counters, '_flusher_pid', os.getpid()):
+            counters.record(1, self.popular.id, 1)
+        flush.assert_not_called()
+        self.assertTrue(counters._flush_now.is_set())
+        counters._flush_now.clear()
+        counters._pending.clear()
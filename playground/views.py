@@ -1,3 +1,4 @@
+from django.conf import settings
 from django.shortcuts import render
 from django.contrib.contenttypes.models import ContentType
 from django.db import transaction, connection
@@ -9,7 +10,7 @@ from store.models import Product, OrderItem, Order, Customer, Collection
 from tags.models import TaggedItem
 from rest_framework.views import APIView
 from rest_framework.permissions import IsAuthenticated, AllowAny, IsAdminUser
-import requests
+from core import outbound
 import logging
 
 # this converts to playground.views. This is better than hardcoding the name because if we ever change the name of the file, this will break
@@ -25,18 +26,23 @@ class HelloView(APIView):
     def get(self, request):
         try:
             logger.info('calling httpbin')
-            response = requests.get('https://httpbin.org/delay/2')
+            # pooled connection, timeouts and circuit breaker. If httpbin is down we find out fast (see core/outbound.py)
+            response = outbound.get(f'{settings.HTTPBIN_URL}/delay/2')
             logger.info('received the response')
             data = response.json()
 
-        except requests.ConnectionError:
-            logger.critical('httpbin is offline')
+        except outbound.OutboundError as e:
+            logger.critical('httpbin is offline (%s)', e)
 
         return render(request, 'hello.html', {'name': 'Mosh'})
 
 
-def say_hello2(request):
-    requests.get('https://httpbin.org/delay/2')
+# An async view doesn't keep a worker busy while it waits for httpbin
+async def say_hello2(request):
+    try:
+        await outbound.aget(f'{settings.HTTPBIN_URL}/delay/2')
+    except outbound.OutboundError as e:
+        logger.critical('httpbin is offline (%s)', e)
 
     return render(request, 'hello.html', {'name': 'Mosh'})
 
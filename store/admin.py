@@ -1,28 +1,128 @@
+import json
 from django.contrib import admin
+from django.contrib.admin.models import CHANGE, LogEntry
+from django.contrib.contenttypes.models import ContentType
+from django.core.paginator import Paginator
+from django.db import connections, transaction
 from django.db.models.aggregates import Count
+from django.utils import timezone
+from django.utils.functional import cached_property
 from . import models
+from .cache import bump_version
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    The admin runs a COUNT(*) on every changelist page. On big tables that is a full scan, so when the list is
+    not filtered we read the number of rows from the table statistics of the database instead.
+    Small tables and filtered lists (search, list_filter) still get the exact count.
+    """
+    # below this number the exact count is cheap and we prefer it
+    exact_count_limit = 10000
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        if not queryset.query.where:
+            estimate = self.estimate_count(queryset)
+            if estimate is not None and estimate >= self.exact_count_limit:
+                return estimate
+        return super().count
+
+    def estimate_count(self, queryset):
+        connection = connections[queryset.db]
+        table = queryset.model._meta.db_table
+        queries = {
+            'mysql': 'SELECT TABLE_ROWS FROM information_schema.TABLES '
+                     'WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s',
+            'postgresql': 'SELECT reltuples::bigint FROM pg_class WHERE relname = %s',
+            # only there after running ANALYZE. The first number of the stat is the number of rows
+            'sqlite': "SELECT CAST(stat AS INTEGER) FROM sqlite_stat1 WHERE tbl = %s LIMIT 1",
+        }
+        if connection.vendor not in queries:
+            return None
+        try:
+            with transaction.atomic(using=queryset.db), connection.cursor() as cursor:
+                cursor.execute(queries[connection.vendor], [table])
+                row = cursor.fetchone()
+        except Exception:
+            # e.g. sqlite_stat1 doesn't exist because ANALYZE never ran
+            return None
+        if row is None or row[0] is None or row[0] < 0:
+            return None
+        return int(row[0])
+
+
+class FastChangeListMixin:
+    """
+    Settings for changelists of big tables: estimated count and no second COUNT(*) for the "(x total)" link
+    """
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
 
 # The name of this class can be anything but the convention is ModelNameAdmin
 
 
 @admin.register(models.Product)
-class ProductAdmin(admin.ModelAdmin):
+class ProductAdmin(FastChangeListMixin, admin.ModelAdmin):
     # You can add computed columns as well like inventory_status
-    list_display = ['title', 'price', 'inventory_status']
+    list_display = ['title', 'price', 'inventory_status', 'collection']
     list_editable = ['price']
     list_per_page = 10
+    # load the collection of every product in the same query
+    list_select_related = ['collection']
 
     @admin.display(ordering='inventory')
     def inventory_status(self, product):
         return 'Ok' if product.inventory > 10 else 'Low'
 
+    # Saving the price of 100 products from the changelist would be 100 UPDATEs and 100 log entries.
+    # While the changelist saves, save_model and log_change only collect the objects, and at the end we save
+    # them with one bulk_update and one bulk_create.
+    def changelist_view(self, request, extra_context=None):
+        if request.method != 'POST' or '_save' not in request.POST:
+            return super().changelist_view(request, extra_context)
+
+        request.pending_saves, request.pending_logs = [], []
+        with transaction.atomic():
+            response = super().changelist_view(request, extra_context)
+            if request.pending_saves:
+                # bulk_update doesn't know about auto_now
+                now = timezone.now()
+                for product in request.pending_saves:
+                    product.last_udpate = now
+                models.Product.objects.bulk_update(
+                    request.pending_saves, list(self.list_editable) + ['last_udpate'], batch_size=500)
+                LogEntry.objects.bulk_create(request.pending_logs, batch_size=500)
+                # bulk_update doesn't fire post_save either, so we invalidate the cached product responses here
+                transaction.on_commit(lambda: bump_version(models.Product))
+        return response
+
+    def save_model(self, request, obj, form, change):
+        if change and hasattr(request, 'pending_saves'):
+            request.pending_saves.append(obj)
+            return
+        super().save_model(request, obj, form, change)
+
+    def log_change(self, request, obj, message):
+        if not hasattr(request, 'pending_logs'):
+            return super().log_change(request, obj, message)
+        request.pending_logs.append(LogEntry(
+            user_id=request.user.pk,
+            content_type_id=ContentType.objects.get_for_model(obj).pk,
+            object_id=str(obj.pk),
+            object_repr=str(obj)[:200],
+            action_flag=CHANGE,
+            change_message=json.dumps(message) if isinstance(message, list) else message,
+        ))
+
 # You can add more classes for each of the models
 
 
 # Register your models here.
 # admin.site.register(models.Collection)
 @admin.register(models.Collection)
-class CollectionAdmin(admin.ModelAdmin):
+class CollectionAdmin(FastChangeListMixin, admin.ModelAdmin):
     list_display = ['title', 'products_count']
 
     # custom column
@@ -40,5 +140,29 @@ class CollectionAdmin(admin.ModelAdmin):
 
 
 @admin.register(models.Customer)
-class CustomerAdmin(admin.ModelAdmin):
-    list_display = ['first_name', 'last_name', 'membership', 'get_orders']
+class CustomerAdmin(FastChangeListMixin, admin.ModelAdmin):
+    list_display = ['first_name', 'last_name', 'membership', 'orders_count', 'lifetime_spend', 'last_order_at']
+    # the user for the names and the precomputed summary for the order columns, all in the same query
+    list_select_related = ['user', 'summary']
+    # Customer.Meta.ordering sorts by the name of the user, that is a join and a sort of the whole table on every
+    # page. The admin walks the primary key instead (newest first), you can still click the name columns to sort
+    ordering = ['-id']
+
+    @admin.display(ordering='summary__orders_count')
+    def orders_count(self, customer):
+        return customer.get_summary().orders_count
+
+    @admin.display(ordering='summary__lifetime_spend')
+    def lifetime_spend(self, customer):
+        return customer.get_summary().lifetime_spend
+
+    @admin.display(ordering='summary__last_order_at')
+    def last_order_at(self, customer):
+        return customer.get_summary().last_order_at
+
+
+@admin.register(models.OutboxEvent)
+class OutboxEventAdmin(admin.ModelAdmin):
+    list_display = ['id', 'name', 'status', 'attempts', 'created_at', 'available_at']
+    list_filter = ['status', 'name']
+    readonly_fields = ['payload', 'last_error', 'created_at']
@@ -7,3 +7,4 @@ class StoreConfig(AppConfig):
 
     def ready(self) -> None:
         import store.signals.handlers
+        import store.checks
@@ -0,0 +1,150 @@
+from functools import wraps
+from django.db.models import F
+from django.http import HttpResponse
+from rest_framework.renderers import JSONRenderer
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import InvalidToken, TokenError
+from core.authentication import ClaimsUser
+from .filters import ProductFilter
+from .models import Cart, Collection, Product
+from .pagination import DefaultPagination
+from .serializers import CartSerializer, CollectionSerializer, ProductSerializer
+from .views import CartViewSet, CollectionList
+
+# Async read endpoints for the catalog and the carts (/store/async/...)
+# A sync worker is busy for the whole request, also while it waits for the database or for a slow client to send the
+# request or read the response. With an async worker one process serves many of those requests at the same time:
+#   gunicorn storefront.asgi -k uvicorn.workers.UvicornWorker
+# DRF views are sync only, so these are plain Django async views. They return the same json as the DRF endpoints:
+# the queries run with the async ORM (acount, aget, async for) and the serializers only turn loaded objects into
+# dicts, they don't touch the database.
+# The benchmark_async command compares these with the sync endpoints.
+# The middlewares of Django that are sync only (MiddlewareMixin ones such as CommonMiddleware) and WhiteNoise still
+# run in a thread under ASGI, the core middlewares don't (see core/middleware.py).
+# /store/async/products/ supports the filters (ProductFilter, ?search= included), ?ordering= and ?page= of
+# /store/products/. ?pagination=cursor and ?expand=tags are only on the DRF endpoint, here they are a 400.
+
+PAGE_SIZE = DefaultPagination.page_size
+ORDERING_FIELDS = ['title', 'price', 'last_update']
+
+
+def json_response(data, status=200):
+    return HttpResponse(JSONRenderer().render(data), status=status, content_type='application/json')
+
+
+def not_found():
+    return json_response({'detail': 'Not found.'}, status=404)
+
+
+def get_user(request):
+    """
+    The user from the JWT claims, without loading it from the database (see core/authentication.py).
+    Returns None if there is no valid token.
+    """
+    authentication = JWTAuthentication()
+    header = authentication.get_header(request)
+    raw_token = authentication.get_raw_token(header) if header else None
+    if raw_token is None:
+        return None
+    try:
+        return ClaimsUser(authentication.get_validated_token(raw_token))
+    except (InvalidToken, TokenError):
+        return None
+
+
+def not_authenticated():
+    return json_response({'detail': 'Authentication credentials were not provided.'}, status=401)
+
+
+def read_only(view):
+    # django's require_GET doesn't support async views before django 5
+    @wraps(view)
+    async def wrapper(request, *args, **kwargs):
+        if request.method not in ('GET', 'HEAD'):
+            return json_response({'detail': f'Method "{request.method}" not allowed.'}, status=405)
+        return await view(request, *args, **kwargs)
+    return wrapper
+
+
+@read_only
+async def product_list(request):
+    for param in ('pagination', 'expand'):
+        if request.GET.get(param):
+            return json_response({'detail': f'?{param}= is not supported here, use /store/products/.'}, status=400)
+
+    # the same filters as ProductView. The queryset is lazy, nothing runs until acount()
+    queryset = ProductFilter(request.GET, queryset=Product.objects.annotate(last_update=F('last_udpate'))).qs
+
+    # like OrderingFilter: the valid fields of ?ordering=, otherwise the order of the filters (the search rank) or
+    # of the model (title)
+    ordering = [field for field in request.GET.get('ordering', '').split(',')
+                if field.strip().lstrip('-') in ORDERING_FIELDS]
+    if ordering:
+        queryset = queryset.order_by(*(field.strip() for field in ordering))
+
+    try:
+        page = int(request.GET.get('page', 1))
+    except ValueError:
+        page = 0
+    count = await queryset.acount()
+    if page < 1 or (page > 1 and (page - 1) * PAGE_SIZE >= count):
+        return json_response({'detail': 'Invalid page.'}, status=404)
+
+    start = (page - 1) * PAGE_SIZE
+    products = [product async for product in queryset[start:start + PAGE_SIZE]]
+
+    url = request.build_absolute_uri()
+    next_url = replace_query_param(url, 'page', page + 1) if start + PAGE_SIZE < count else None
+    previous_url = None
+    if page == 2:
+        previous_url = remove_query_param(url, 'page')
+    elif page > 2:
+        previous_url = replace_query_param(url, 'page', page - 1)
+
+    return json_response({
+        'count': count,
+        'next': next_url,
+        'previous': previous_url,
+        'results': ProductSerializer(products, many=True).data,
+    })
+
+
+@read_only
+async def product_detail(request, pk):
+    # same as ProductDetail, you need to be logged in
+    if get_user(request) is None:
+        return not_authenticated()
+    try:
+        product = await Product.objects.aget(pk=pk)
+    except Product.DoesNotExist:
+        return not_found()
+    return json_response(ProductSerializer(product).data)
+
+
+@read_only
+async def collection_list(request):
+    # .all() is a new queryset every time, iterating the class attribute would cache the rows in it forever
+    collections = [collection async for collection in CollectionList.queryset.all()]
+    return json_response(CollectionSerializer(collections, many=True).data)
+
+
+@read_only
+async def collection_detail(request, pk):
+    try:
+        collection = await CollectionList.queryset.aget(pk=pk)
+    except Collection.DoesNotExist:
+        return not_found()
+    return json_response(CollectionSerializer(collection).data)
+
+
+@read_only
+async def cart_detail(request, pk):
+    if get_user(request) is None:
+        return not_authenticated()
+    try:
+        # the same 2 queries as CartViewSet: the cart with its total, and the items with their products
+        cart = await CartViewSet.queryset.aget(pk=pk)
+    except Cart.DoesNotExist:
+        return not_found()
+    return json_response(CartSerializer(cart).data)
@@ -0,0 +1,24 @@
+import statistics
+
+# Shared by the benchmark and benchmark_async commands
+
+
+def summarize(latencies, errors, elapsed):
+    """
+    Requests per second and p50/p95/p99 latency of one run. latencies are in milliseconds, elapsed in seconds.
+    """
+    latencies = sorted(latencies)
+
+    def percentile(p):
+        if not latencies:
+            return 0
+        return latencies[min(len(latencies) - 1, int(len(latencies) * p / 100))]
+
+    return {
+        'ok': len(latencies),
+        'errors': errors,
+        'rps': len(latencies) / elapsed if elapsed else 0,
+        'p50': statistics.median(latencies) if latencies else 0,
+        'p95': percentile(95),
+        'p99': percentile(99),
+    }
@@ -0,0 +1,365 @@
+import logging
+import random
+import threading
+import time
+from collections import Counter, OrderedDict, defaultdict, namedtuple
+from contextlib import nullcontext
+from functools import wraps
+from hashlib import md5
+from urllib.parse import urlencode
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connections
+from django.utils.cache import get_conditional_response
+from django.utils.http import parse_http_date_safe
+from rest_framework.response import Response
+from core.dbrouter import REPLICA_MAX_LAG_SECONDS, use_primary
+
+# Response cache for the catalog read endpoints.
+# Instead of deleting cache entries when a product changes (we would need to know every url that contains it) every
+# model has a VERSION number that is part of the cache key. post_save/post_delete bump the version (see
+# signals/handlers.py), so the next request builds a new key and the old entries simply expire. Nothing is served
+# stale and we never flush the whole cache.
+
+logger = logging.getLogger(__name__)
+
+VERSION_KEY = 'store:version:{}'
+# set by bump_version for as long as a replica can take to get the change
+CHANGED_KEY = 'store:changed:{}'
+STATS_KEY = 'store:stats:{}:{}'
+
+
+def version_key(model):
+    return VERSION_KEY.format(model._meta.label_lower)
+
+
+def get_versions(models):
+    keys = [version_key(model) for model in models]
+    versions = cache.get_many(keys)
+    for key in keys:
+        if key not in versions:
+            # If the cache evicted the counter we can't start again from 1, an old entry could have that version.
+            # The current time in ms is always bigger than any version we handed out before
+            versions[key] = int(time.time() * 1000)
+            if not cache.add(key, versions[key], timeout=None):
+                versions[key] = cache.get(key, versions[key])
+    return [versions[key] for key in keys]
+
+
+def bump_version(model):
+    key = version_key(model)
+    # before the new version: a request that sees the new version also sees that the replicas may be behind
+    cache.set(CHANGED_KEY.format(model._meta.label_lower), True, timeout=REPLICA_MAX_LAG_SECONDS)
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.set(key, int(time.time() * 1000), timeout=None)
+
+
+def recently_changed(models):
+    """
+    True when a replica may not have the last change of any of the models yet.
+    """
+    return bool(cache.get_many([CHANGED_KEY.format(model._meta.label_lower) for model in models]))
+
+
+def incr_stat(name, stat):
+    key = STATS_KEY.format(name, stat)
+    try:
+        cache.incr(key)
+    except ValueError:
+        if not cache.add(key, 1, timeout=None):
+            cache.incr(key)
+
+
+def get_stats(name):
+    hits = cache.get(STATS_KEY.format(name, 'hits'), 0)
+    misses = cache.get(STATS_KEY.format(name, 'misses'), 0)
+    return {'hits': hits, 'misses': misses}
+
+
+# Two tiers
+# get_or_compute() looks in a small LRU inside the process first (no network, no unpickling), then in the shared
+# cache (CACHES['default']), and only then computes the value:
+#   - TTL with jitter: entries written at the same time (after a deploy) don't all expire at the same time
+#   - single flight: when a key is missing, ONE thread of the process computes it and the others wait for its result
+#     instead of all going to the database
+#   - stale while revalidate: for stale_ttl seconds after it expires an entry is still returned, and a background
+#     thread computes the new value
+# The local tier can't see deletes done by other processes. Use versioned keys (like the response cache and the
+# decorators below do) instead of deleting.
+# The values of the local tier are shared by every request of the process: DON'T MODIFY THEM.
+
+LOCAL_MAX_ENTRIES = getattr(settings, 'STORE_LOCAL_CACHE_ENTRIES', 1000)
+JITTER = 0.1
+# a waiting thread computes the value itself if the first one takes longer than this
+FLIGHT_TIMEOUT = 10
+
+# fresh_until and stale_until are time.time(), so they mean the same in every process
+Entry = namedtuple('Entry', ['value', 'fresh_until', 'stale_until'])
+
+
+class LocalCache:
+    """
+    Least recently used entries are dropped when there are more than max_entries.
+    """
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+            return entry
+
+    def set(self, key, entry):
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+local_cache = LocalCache(LOCAL_MAX_ENTRIES)
+
+# per key prefix, only for this process: local, shared, stale, wait (got the value of another thread) and miss
+_tier_stats = defaultdict(Counter)
+_stats_lock = threading.Lock()
+
+
+def record(prefix, source):
+    with _stats_lock:
+        _tier_stats[prefix][source] += 1
+
+
+def get_tier_stats():
+    with _stats_lock:
+        stats = {prefix: dict(counter) for prefix, counter in _tier_stats.items()}
+    for counter in stats.values():
+        total = sum(counter.values())
+        counter['hit_rate'] = round((total - counter.get('miss', 0)) / total, 3) if total else 0
+    return stats
+
+
+def clear():
+    """
+    Both tiers of this process. Other processes keep their local entries.
+    """
+    cache.clear()
+    local_cache.clear()
+    with _stats_lock:
+        _tier_stats.clear()
+
+
+class Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.failed = False
+        self.value = None
+
+
+_flights = {}
+_flights_lock = threading.Lock()
+
+
+def single_flight(key, compute):
+    """
+    Returns (value, waited). Only one thread per key runs compute at a time, the others get its value.
+    """
+    with _flights_lock:
+        flight = _flights.get(key)
+        leader = flight is None
+        if leader:
+            flight = _flights[key] = Flight()
+
+    if not leader:
+        if flight.done.wait(FLIGHT_TIMEOUT) and not flight.failed:
+            return flight.value, True
+        # the first thread failed or it is too slow
+        return compute(), False
+
+    try:
+        flight.value = compute()
+        return flight.value, False
+    except BaseException:
+        flight.failed = True
+        raise
+    finally:
+        flight.done.set()
+        with _flights_lock:
+            del _flights[key]
+
+
+def store(key, value, ttl, stale_ttl):
+    now = time.time()
+    fresh_for = ttl * random.uniform(1 - JITTER, 1 + JITTER)
+    entry = Entry(value, now + fresh_for, now + fresh_for + stale_ttl)
+    cache.set(key, entry, fresh_for + stale_ttl)
+    local_cache.set(key, entry)
+    return value
+
+
+def refresh_in_background(key, compute, ttl, stale_ttl):
+    def refresh():
+        try:
+            single_flight(key, lambda: store(key, compute(), ttl, stale_ttl))
+        except Exception:
+            logger.exception('Could not refresh %s', key)
+        finally:
+            # this thread opened its own database connections
+            connections.close_all()
+
+    with _flights_lock:
+        if key in _flights:
+            # somebody is already computing it
+            return
+    threading.Thread(target=refresh, daemon=True).start()
+
+
+def get_or_compute(key, compute, ttl, stale_ttl=0, prefix='default'):
+    """
+    Returns (value, source). source is local, shared, stale, wait or miss.
+    """
+    now = time.time()
+    entry = local_cache.get(key)
+    source = 'local'
+    if entry is None:
+        entry = cache.get(key)
+        source = 'shared'
+        if not isinstance(entry, Entry):
+            # missing, or written by an older version of this code
+            entry = None
+        else:
+            local_cache.set(key, entry)
+
+    if entry is not None:
+        if now < entry.fresh_until:
+            record(prefix, source)
+            return entry.value, source
+        if now < entry.stale_until:
+            record(prefix, 'stale')
+            refresh_in_background(key, compute, ttl, stale_ttl)
+            return entry.value, 'stale'
+
+    value, waited = single_flight(key, lambda: store(key, compute(), ttl, stale_ttl))
+    source = 'wait' if waited else 'miss'
+    record(prefix, source)
+    return value, source
+
+
+def cached(prefix, ttl, models=(), stale_ttl=0, prepare=None):
+    """
+    Caches the result of the function per arguments. The arguments must have a stable repr (numbers, strings...).
+    When any of the models changes the cached results are invalidated (see bump_version).
+    prepare turns the result into something that can be pickled, see cached_queryset and cached_serializer.
+    """
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            version = '.'.join(str(v) for v in get_versions(models))
+            arguments = md5(repr((args, sorted(kwargs.items()))).encode('utf-8')).hexdigest()
+            # two functions of the same prefix can take the same arguments and depend on models with the same versions
+            key = f'store:tiered:{prefix}:{function.__module__}.{function.__qualname__}:{version}:{arguments}'
+
+            def compute():
+                result = function(*args, **kwargs)
+                return prepare(result) if prepare else result
+
+            value, _ = get_or_compute(key, compute, ttl, stale_ttl, prefix)
+            return value
+        return wrapper
+    return decorator
+
+
+def cached_queryset(prefix, ttl, models=(), stale_ttl=0):
+    """
+    For functions that return a queryset. The cached value is the list of rows.
+    """
+    return cached(prefix, ttl, models, stale_ttl, prepare=list)
+
+
+def cached_serializer(prefix, ttl, models=(), stale_ttl=0):
+    """
+    For functions that return a serializer. The cached value is serializer.data.
+    """
+    return cached(prefix, ttl, models, stale_ttl, prepare=lambda serializer: serializer.data)
+
+
+class NotCacheable(Exception):
+    def __init__(self, response):
+        self.response = response
+
+
+class CachedResponseMixin:
+    """
+    Add it to a view to cache its GET responses. cache_models are the models the response is built from,
+    when any of them changes the cached responses are invalidated.
+    We cache the serialized data, not the rendered bytes, so content negotiation (json/browsable api) still works.
+    With read_from_replica the misses read from a replica, except right after a change of the cache_models (the
+    replica may not have it yet and we would cache the old rows under the new version).
+    Only the cache_query_params are part of the key: the view ignores the other parameters, and a client adding
+    ?random=123 to every request must not fill the cache with copies of the same response.
+    """
+    cache_models = []
+    cache_timeout = 60 * 60
+    cache_query_params = []
+
+    def get_cache_name(self):
+        return self.__class__.__name__
+
+    def get_cache_key(self, request):
+        versions = get_versions(self.cache_models)
+        # ?page=2&ordering=price and ?ordering=price&page=2 are the same response
+        query = urlencode(sorted((name, values) for name, values in request.query_params.lists()
+                                 if name in self.cache_query_params), doseq=True)
+        version = '.'.join(str(v) for v in versions)
+        # the host is part of the key because the pagination links are absolute urls
+        return f'store:response:{self.get_cache_name()}:{version}:{request.get_host()}{request.path}?{query}'
+
+    def get(self, request, *args, **kwargs):
+        # get() runs after the permission checks, and these responses are the same for every user
+        key = self.get_cache_key(request)
+
+        def render():
+            reads = use_primary() if recently_changed(self.cache_models) else nullcontext()
+            with reads:
+                response = super(CachedResponseMixin, self).get(request, *args, **kwargs)
+            # we don't cache errors like 404 (the object could be created a second later) or 304 (there is no data)
+            if response.status_code != 200:
+                raise NotCacheable(response)
+            validators = {header: response[header]
+                          for header in ('ETag', 'Last-Modified') if response.has_header(header)}
+            return response.data, response.status_code, validators
+
+        try:
+            # the keys are versioned, so there is nothing stale to serve (stale_ttl=0). When a version changes every
+            # worker misses at once, single flight makes only one thread per process render the response
+            cached, source = get_or_compute(key, render, self.cache_timeout, prefix=self.get_cache_name())
+        except NotCacheable as e:
+            incr_stat(self.get_cache_name(), 'misses')
+            e.response['X-Cache'] = 'MISS'
+            return e.response
+
+        hit = source != 'miss'
+        incr_stat(self.get_cache_name(), 'hits' if hit else 'misses')
+        data, status, validators = cached
+        # The ETag/Last-Modified are cached with the data, so a conditional GET on a cached response
+        # is answered without touching the database
+        response = get_conditional_response(
+            request,
+            etag=validators.get('ETag'),
+            last_modified=parse_http_date_safe(validators.get('Last-Modified')))
+        if response is None:
+            response = Response(data, status=status)
+        for header, value in validators.items():
+            response[header] = value
+        response['X-Cache'] = 'HIT' if hit else 'MISS'
+        return response
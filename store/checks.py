@@ -0,0 +1,21 @@
+from django.conf import settings
+from django.core.checks import Error, Tags, register
+
+# The versions of store/cache.py must be shared by every process: with a cache that lives inside the process
+# (LocMemCache) a product saved in one gunicorn worker, the admin or a management command only bumps the version
+# of that process, the other workers keep serving the old responses until they expire.
+# It is a deployment check: python manage.py check --deploy (with the production settings)
+PROCESS_LOCAL_BACKENDS = {'django.core.cache.backends.locmem.LocMemCache'}
+
+
+@register(Tags.caches, deploy=True)
+def check_shared_cache(app_configs, **kwargs):
+    backend = settings.CACHES.get('default', {}).get('BACKEND')
+    if backend not in PROCESS_LOCAL_BACKENDS:
+        return []
+    return [Error(
+        f'CACHES["default"] uses {backend}, every process would have its own cache versions.',
+        hint='Use a cache shared by every process in production (Redis, set REDIS_URL).',
+        obj='store.cache',
+        id='store.E001',
+    )]
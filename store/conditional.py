@@ -0,0 +1,56 @@
+from hashlib import md5
+from urllib.parse import urlencode
+from django.db.models import Count, Max
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
+
+# Conditional GET (ETag / Last-Modified)
+# The client sends back the ETag it got the last time (If-None-Match). If nothing changed we answer 304 Not Modified
+# with an empty body. Checking that only needs MAX(last_udpate) and a COUNT, so a client that polls every few seconds
+# never makes us load and serialize the products again.
+# NOTE: queryset.update() does not touch auto_now fields, if you use it set last_udpate yourself.
+
+
+class ConditionalGetMixin:
+    """
+    The view implements get_validators() and returns (etag, last_modified). Either one can be None.
+    last_modified is a datetime.
+    """
+
+    def get_validators(self, request, *args, **kwargs):
+        return None, None
+
+    def get(self, request, *args, **kwargs):
+        etag, last_modified = self.get_validators(request, *args, **kwargs)
+        timestamp = int(last_modified.timestamp()) if last_modified else None
+
+        response = get_conditional_response(request, etag=etag, last_modified=timestamp)
+        if response is None:
+            response = super().get(request, *args, **kwargs)
+
+        if response.status_code in (200, 304):
+            if etag:
+                response['ETag'] = etag
+            if timestamp:
+                response['Last-Modified'] = http_date(timestamp)
+        return response
+
+
+def make_etag(*parts):
+    # Weak ETag (W/) because the same data can be rendered as json or as the browsable api
+    return 'W/"%s"' % md5('|'.join(str(part) for part in parts).encode('utf-8')).hexdigest()
+
+
+def get_list_validators(queryset, request, params=None):
+    """
+    One small aggregate query for a whole list. The count is there because deleting a product doesn't change the
+    MAX(last_udpate). The query string is part of the ETag because every page and filter is a different response.
+    With params only those query parameters count, like the key of the response cache.
+    We don't return a Last-Modified for lists for the same reason, it cannot see deletes.
+    """
+    summary = queryset.order_by().aggregate(
+        last_update=Max('last_udpate'), count=Count('id'))
+    query = urlencode(sorted((name, values) for name, values in request.query_params.lists()
+                             if params is None or name in params), doseq=True)
+    etag = make_etag(query, summary['last_update'] and summary['last_update'].isoformat(), summary['count'])
+    return etag, None
@@ -1,8 +1,16 @@
-from django_filters.rest_framework import FilterSet
+from django_filters.rest_framework import FilterSet, CharFilter
 from .models import Product
+from .search import search_products
 
 
 class ProductFilter(FilterSet):
+    # ?search=coffee uses the full-text index (see search.py) and sorts by relevance
+    # title__icontains is still here but it scans the whole table, don't use it for search boxes
+    search = CharFilter(method='filter_search')
+
+    def filter_search(self, queryset, name, value):
+        return search_products(queryset, value)
+
     class Meta:
         model = Product
         # for more details and options you need to read the documentation
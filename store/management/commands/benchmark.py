@@ -0,0 +1,295 @@
+import json
+import platform
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+import django
+import requests
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand, CommandError
+from django.core.servers.basehttp import ThreadedWSGIServer, WSGIRequestHandler, get_internal_wsgi_application
+from django.db import connection
+from core.serializers import CustomerTokenObtainPairSerializer
+from store.benchmarks import summarize
+from store.models import Cart, Collection, Customer, Order, OrderItem, Product
+
+# End to end benchmark of the store API
+#   python manage.py benchmark --output before.json
+#   ... change something ...
+#   python manage.py benchmark --output after.json --baseline before.json --threshold 0.2
+# It creates its own data (a collection, --products products and one user per client) in the database of the
+# settings, runs every scenario at every --concurrency level and deletes the data at the end. It refuses to run unless
+# DEBUG is on or you pass --allow-writes: with the production settings it would write to the production database.
+# Without --url it starts the app in a threaded server inside this process (at 127.0.0.1, it has to be in ALLOWED_HOSTS
+# when DEBUG is off). The server and the client threads share the GIL of this process, so the numbers are lower than
+# those of a real server and the concurrency levels above the cores are mostly the client: compare in-process runs
+# with each other only. With --url it uses a server you started (gunicorn, uvicorn), which must use the same database.
+# With --baseline the command fails when the p95 of a scenario went up, or its requests/second went down, by more than
+# --threshold (0.2 = 20%), so it can run in CI. Compare runs of the same machine and database only.
+# SQLite only lets one transaction write at a time: the scenarios that write (carts, checkout) get "database is
+# locked" errors at high concurrency. Use MySQL for those numbers.
+
+PASSWORD = 'benchmark-password'
+
+
+class Client:
+    """
+    One per thread: a keep-alive session, a user and a cart of its own.
+    """
+
+    def __init__(self, benchmark, token):
+        self.benchmark = benchmark
+        self.session = requests.Session()
+        self.session.headers['Authorization'] = f'JWT {token}'
+        self.cart_id = None
+
+    def call(self, method, path, body=None):
+        response = self.session.request(method, self.benchmark.url + path, json=body, timeout=self.benchmark.timeout)
+        response.raise_for_status()
+        data = response.json() if response.content else None
+        # every cart we create is deleted at the end, also the ones of the timed requests (cart_create)
+        if method == 'POST' and path == '/store/carts/':
+            self.benchmark.cart_ids.append(data['id'])
+        return data
+
+    def new_cart(self, items=0):
+        cart_id = self.call('POST', '/store/carts/')['id']
+        for _ in range(items):
+            self.call('POST', f'/store/carts/{cart_id}/items/', {'product_id': self.product_id(), 'quantity': 1})
+        return cart_id
+
+    def own_cart(self):
+        if self.cart_id is None:
+            self.cart_id = self.new_cart(items=3)
+        return self.cart_id
+
+    def product_id(self):
+        return random.choice(self.benchmark.product_ids)
+
+    # The scenarios: every one returns the request to time, what it needs first (a cart with items) is not timed
+
+    def product_list(self):
+        return 'GET', '/store/products/', None
+
+    def product_detail(self):
+        return 'GET', f'/store/products/{self.product_id()}/', None
+
+    def collection_list(self):
+        return 'GET', '/store/collections/', None
+
+    def cart_create(self):
+        return 'POST', '/store/carts/', None
+
+    def cart_add(self):
+        return 'POST', f'/store/carts/{self.own_cart()}/items/', {'product_id': self.product_id(), 'quantity': 1}
+
+    def cart_retrieve(self):
+        return 'GET', f'/store/carts/{self.own_cart()}/', None
+
+    def checkout(self):
+        # the order deletes the cart, every checkout needs a new one
+        return 'POST', '/store/orders/', {'cart_id': self.new_cart(items=2)}
+
+    def order_list(self):
+        return 'GET', '/store/orders/', None
+
+
+SCENARIOS = ['product_list', 'product_detail', 'collection_list', 'cart_create', 'cart_add', 'cart_retrieve',
+             'checkout', 'order_list']
+
+
+class QuietHandler(WSGIRequestHandler):
+    # the headers and the body are sent in two writes. With Nagle's algorithm the body waits for the ACK of the
+    # headers, that is a delayed ACK of 40ms on every keep-alive request
+    disable_nagle_algorithm = True
+
+    # no log line for every request
+    def log_message(self, format, *args):
+        pass
+
+
+class Command(BaseCommand):
+    help = 'Measures throughput and p50/p95/p99 latency of the store API at several concurrency levels'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', help='Base url of a running server, by default the app runs inside this command')
+        parser.add_argument('--scenarios', default=','.join(SCENARIOS), help=f'Comma separated, from {SCENARIOS}')
+        parser.add_argument('--concurrency', default='1,8,32', help='Comma separated levels of concurrent clients')
+        parser.add_argument('--requests', type=int, default=200, help='Timed requests per scenario and level')
+        parser.add_argument('--warmup', type=int, default=20, help='Requests per scenario before timing')
+        parser.add_argument('--products', type=int, default=100, help='Products to create')
+        parser.add_argument('--timeout', type=float, default=30)
+        parser.add_argument('--seed', type=int, default=1)
+        parser.add_argument('--output', help='Write the results to this json file')
+        parser.add_argument('--baseline', help='json file of a previous run to compare with')
+        parser.add_argument('--threshold', type=float, default=0.2,
+                            help='Allowed change against the baseline (0.2 = 20%%) before it counts as a regression')
+        parser.add_argument('--allow-writes', action='store_true',
+                            help='Run with DEBUG off. The data is created in (and deleted from) the database of the '
+                                 'settings')
+
+    def handle(self, *args, **options):
+        scenarios = options['scenarios'].split(',')
+        unknown = set(scenarios) - set(SCENARIOS)
+        if unknown:
+            raise CommandError(f'Unknown scenarios: {", ".join(sorted(unknown))}')
+        levels = [int(level) for level in options['concurrency'].split(',')]
+        if not settings.DEBUG and not options['allow_writes']:
+            raise CommandError(f'DEBUG is off: this would write to {connection.settings_dict["NAME"]}. '
+                               f'Pass --allow-writes if it is a database for benchmarks')
+        random.seed(options['seed'])
+        self.timeout = options['timeout']
+        self.cart_ids = []
+
+        server = None
+        if options['url']:
+            self.url = options['url'].rstrip('/')
+        else:
+            server = self.start_server()
+            self.stdout.write(self.style.WARNING(
+                'The server runs in this process and shares the GIL with the clients: compare the numbers with other '
+                'in-process runs only, use --url for the real throughput'))
+
+        self.stdout.write('Creating data...')
+        collection, users = self.setup(options['products'], max(levels))
+        try:
+            results = self.run(scenarios, levels, users, options)
+        finally:
+            self.cleanup(collection, users)
+            if server:
+                server.shutdown()
+                server.server_close()
+
+        report = {
+            'meta': {
+                'started_at': datetime.now(timezone.utc).isoformat(),
+                # in-process: the server shares the GIL with the clients
+                'server': options['url'] or 'in-process',
+                'database': connection.vendor,
+                'python': platform.python_version(),
+                'django': django.get_version(),
+                'requests': options['requests'],
+                'products': options['products'],
+            },
+            'results': results,
+        }
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(report, f, indent=2)
+            self.stdout.write(f'Results written to {options["output"]}')
+
+        if options['baseline']:
+            with open(options['baseline']) as f:
+                baseline = json.load(f)
+            regressions = compare(baseline['results'], results, options['threshold'])
+            for regression in regressions:
+                self.stdout.write(self.style.ERROR(regression))
+            if regressions:
+                raise CommandError(f'{len(regressions)} regressions against {options["baseline"]}')
+            self.stdout.write(self.style.SUCCESS(f'No regressions against {options["baseline"]}'))
+
+    def start_server(self):
+        server = ThreadedWSGIServer(('127.0.0.1', 0), QuietHandler)
+        server.set_app(get_internal_wsgi_application())
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.url = f'http://127.0.0.1:{server.server_port}'
+        return server
+
+    def setup(self, products, clients):
+        collection = Collection.objects.create(title='Benchmark')
+        Product.objects.bulk_create([
+            Product(title=f'Benchmark product {i}', slug=f'benchmark-{i}', price=10 + i % 90,
+                    inventory=10 ** 6, collection=collection)
+            for i in range(products)])
+        self.product_ids = list(Product.objects.filter(collection=collection).values_list('id', flat=True))
+
+        # hashing a password is slow on purpose, all the users share one hash
+        password = make_password(PASSWORD)
+        suffix = time.time_ns()
+        users = []
+        for i in range(clients):
+            # the post_save signal creates the customer for every user
+            users.append(get_user_model().objects.create(
+                username=f'benchmark_{i}_{suffix}', email=f'benchmark_{i}_{suffix}@domain.com', password=password))
+        return collection, users
+
+    def run(self, scenarios, levels, users, options):
+        results = {}
+        self.stdout.write(f'{"scenario":<16} {"clients":>7} {"ok":>6} {"errors":>6} {"req/s":>8} '
+                          f'{"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8}')
+        for scenario in scenarios:
+            results[scenario] = {}
+            for level in levels:
+                result = self.run_level(scenario, level, users, options)
+                results[scenario][str(level)] = result
+                self.stdout.write(
+                    f'{scenario:<16} {level:>7} {result["ok"]:>6} {result["errors"]:>6} {result["rps"]:>8.1f} '
+                    f'{result["p50"]:>8.1f} {result["p95"]:>8.1f} {result["p99"]:>8.1f}')
+        return results
+
+    def run_level(self, scenario, level, users, options):
+        tokens = [str(CustomerTokenObtainPairSerializer.get_token(user).access_token) for user in users[:level]]
+        local = threading.local()
+        lock = threading.Lock()
+        latencies, errors = [], 0
+
+        def one(timed):
+            nonlocal errors
+            if not hasattr(local, 'client'):
+                with lock:
+                    local.client = Client(self, tokens.pop())
+            try:
+                method, path, body = getattr(local.client, scenario)()
+                start = time.perf_counter()
+                local.client.call(method, path, body)
+                latency = (time.perf_counter() - start) * 1000
+            except requests.RequestException:
+                latency = None
+            if timed:
+                with lock:
+                    if latency is None:
+                        errors += 1
+                    else:
+                        latencies.append(latency)
+
+        with ThreadPoolExecutor(max_workers=level) as executor:
+            list(executor.map(lambda _: one(False), range(options['warmup'])))
+            start = time.perf_counter()
+            list(executor.map(lambda _: one(True), range(options['requests'])))
+            elapsed = time.perf_counter() - start
+        return summarize(latencies, errors, elapsed)
+
+    def cleanup(self, collection, users):
+        user_ids = [user.id for user in users]
+        OrderItem.objects.filter(order__customer__user_id__in=user_ids).delete()
+        Order.objects.filter(customer__user_id__in=user_ids).delete()
+        Cart.objects.filter(pk__in=self.cart_ids).delete()
+        Customer.objects.filter(user_id__in=user_ids).delete()
+        get_user_model().objects.filter(id__in=user_ids).delete()
+        Product.objects.filter(collection=collection).delete()
+        collection.delete()
+
+
+def compare(baseline, results, threshold):
+    """
+    The scenarios and levels that got slower than the baseline by more than threshold.
+    """
+    regressions = []
+    for scenario, levels in results.items():
+        for level, result in levels.items():
+            before = baseline.get(scenario, {}).get(level)
+            if before is None:
+                continue
+            name = f'{scenario} with {level} clients'
+            if before['p95'] and result['p95'] > before['p95'] * (1 + threshold):
+                regressions.append(f'{name}: p95 {before["p95"]:.1f} ms -> {result["p95"]:.1f} ms')
+            if before['rps'] and result['rps'] < before['rps'] * (1 - threshold):
+                regressions.append(f'{name}: {before["rps"]:.1f} -> {result["rps"]:.1f} requests/second')
+            if result['errors'] > before['errors']:
+                regressions.append(f'{name}: {before["errors"]} -> {result["errors"]} errors')
+    return regressions
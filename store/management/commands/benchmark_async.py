@@ -0,0 +1,122 @@
+import asyncio
+import time
+from urllib.parse import urlsplit
+from django.core.management.base import BaseCommand, CommandError
+from store.benchmarks import summarize
+
+# Compares the sync endpoints (gunicorn storefront.wsgi) with the async ones (gunicorn storefront.asgi -k
+# uvicorn.workers.UvicornWorker). Start both servers with the same number of workers and point this command at them:
+#   python manage.py benchmark_async --wsgi http://localhost:8000 --asgi http://localhost:8001 --slow-clients 50
+# Slow clients open a connection and send their request one byte at a time. A sync worker is stuck with each of them,
+# an async worker keeps serving the other requests. The latency of the normal requests shows the difference.
+# Only run it against your own servers.
+
+SYNC_PATH = '/store/products/'
+ASYNC_PATH = '/store/async/products/'
+
+
+class Command(BaseCommand):
+    help = 'Compares the latency of the sync (WSGI) and async (ASGI) catalog endpoints under concurrency and slow clients'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--wsgi', help='Base url of the WSGI server, for example http://localhost:8000')
+        parser.add_argument('--asgi', help='Base url of the ASGI server, for example http://localhost:8001')
+        parser.add_argument('--sync-path', default=SYNC_PATH)
+        parser.add_argument('--async-path', default=ASYNC_PATH)
+        parser.add_argument('--requests', type=int, default=1000)
+        parser.add_argument('--concurrency', type=int, default=100)
+        parser.add_argument('--slow-clients', type=int, default=0,
+                            help='Connections that send their request very slowly during the benchmark')
+        parser.add_argument('--slow-delay', type=float, default=0.5, help='Seconds between bytes of a slow client')
+        parser.add_argument('--token', help='JWT access token, for the endpoints that need a user')
+        parser.add_argument('--timeout', type=float, default=30)
+
+    def handle(self, *args, **options):
+        targets = [(name, options[name], path) for name, path in
+                   [('wsgi', options['sync_path']), ('asgi', options['async_path'])] if options[name]]
+        if not targets:
+            raise CommandError('Pass --wsgi and/or --asgi')
+
+        self.stdout.write(f'{"server":<6} {"ok":>6} {"errors":>6} {"req/s":>8} {"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8}')
+        for name, base_url, path in targets:
+            result = asyncio.run(run(base_url + path, options))
+            self.stdout.write(
+                f'{name:<6} {result["ok"]:>6} {result["errors"]:>6} {result["rps"]:>8.1f} '
+                f'{result["p50"]:>8.1f} {result["p95"]:>8.1f} {result["p99"]:>8.1f}')
+
+
+async def run(url, options):
+    parts = urlsplit(url)
+    host, port = parts.hostname, parts.port or 80
+    target = parts.path + (f'?{parts.query}' if parts.query else '')
+    headers = {'Host': parts.netloc, 'Connection': 'close', 'Accept': 'application/json'}
+    if options['token']:
+        headers['Authorization'] = f'JWT {options["token"]}'
+    request = (f'GET {target} HTTP/1.1\r\n' +
+               ''.join(f'{key}: {value}\r\n' for key, value in headers.items()) + '\r\n').encode()
+
+    stop = asyncio.Event()
+    slow = [asyncio.create_task(slow_client(host, port, request, options['slow_delay'], stop))
+            for _ in range(options['slow_clients'])]
+    # give the slow clients time to take the workers
+    if slow:
+        await asyncio.sleep(1)
+
+    semaphore = asyncio.Semaphore(options['concurrency'])
+    latencies, errors = [], 0
+
+    async def one():
+        nonlocal errors
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                status = await asyncio.wait_for(fetch(host, port, request), options['timeout'])
+            except (OSError, asyncio.TimeoutError):
+                status = None
+            if status == 200:
+                latencies.append((time.perf_counter() - start) * 1000)
+            else:
+                errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*[one() for _ in range(options['requests'])])
+    elapsed = time.perf_counter() - start
+
+    stop.set()
+    await asyncio.gather(*slow, return_exceptions=True)
+    return summarize(latencies, errors, elapsed)
+
+
+async def fetch(host, port, request):
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        writer.write(request)
+        await writer.drain()
+        status_line = await reader.readline()
+        # Connection: close, the server closes the socket at the end of the response
+        await reader.read()
+        return int(status_line.split()[1])
+    finally:
+        writer.close()
+
+
+async def slow_client(host, port, request, delay, stop):
+    while not stop.is_set():
+        try:
+            reader, writer = await asyncio.open_connection(host, port)
+        except OSError:
+            await asyncio.sleep(delay)
+            continue
+        try:
+            # the last two bytes (the empty line that ends the headers) are never sent while the benchmark runs
+            for byte in request[:-2]:
+                if stop.is_set():
+                    break
+                writer.write(bytes([byte]))
+                await writer.drain()
+                await asyncio.sleep(delay)
+        except OSError:
+            # the server timed us out, connect again
+            pass
+        finally:
+            writer.close()
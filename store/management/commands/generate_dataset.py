@@ -0,0 +1,399 @@
+import itertools
+import multiprocessing
+import random
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import timedelta
+from decimal import Decimal
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.contrib.contenttypes.models import ContentType
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.db import connection, connections, transaction
+from django.utils import timezone
+from likes.models import LikedItem
+from store.cache import bump_version
+from store.models import Cart, CartItem, Collection, Customer, Order, OrderItem, Product, Promotion, Review
+from tags.models import Tag, TaggedItem
+
+# A big, realistic database to reproduce production problems
+#   python manage.py generate_dataset --scale 10 --workers 8      # about 10M order items
+# Like in production a few products sell (and get reviewed, liked, added to carts) much more than the rest, and a
+# few customers place many orders: both are picked with a Zipf distribution, --skew controls how steep it is.
+# The same --seed and --batch-size always give the same data (except the uuids of the carts).
+#
+# It is fast because:
+#   - rows are inserted with bulk_create, --batch-size per INSERT, and a whole chunk per transaction
+#   - bulk_create doesn't send post_save: no create_customer_for_new_user per user (we insert the customers
+#     ourselves), no search index or cache invalidation per product (done once at the end)
+#   - the primary keys of the parent rows are computed, not read back, so every chunk is independent and --workers
+#     processes insert at the same time (SQLite only has one writer, there it always runs in one process).
+#     Before anything is inserted the id sequence of every table is moved past the new rows (reserve_ids), so the
+#     site can keep running: its inserts get ids after ours
+# At the end it rebuilds what the signals and the checkout normally keep up to date: like counters, customer summaries,
+# sales rollups and the search index (--skip-derived to do it yourself later).
+# The rows are ADDED to what is in the database. Every generated user has the password PASSWORD.
+
+PASSWORD = 'generated-password'
+
+# the number of rows of --scale 1
+SCALE_1 = {
+    'promotions': 20,
+    'collections': 50,
+    'tags': 200,
+    'products': 10_000,
+    'customers': 100_000,
+    'orders': 400_000,
+    'carts': 50_000,
+    'reviews': 50_000,
+    'likes': 200_000,
+}
+
+# items per order: 1 to 8, about 2.8 on average
+ITEMS_PER_ORDER = [1, 2, 3, 4, 5, 6, 7, 8]
+ITEMS_WEIGHTS = [30, 25, 17, 10, 7, 5, 3, 3]
+
+PAYMENT_STATUSES = [Order.PAYMENT_STATUS_COMPLETE, Order.PAYMENT_STATUS_PENDING, Order.PAYMENT_STATUS_FAILED]
+PAYMENT_WEIGHTS = [90, 7, 3]
+
+MEMBERSHIPS = [Customer.MEMBERSHIP_BRONZE, Customer.MEMBERSHIP_SILVER, Customer.MEMBERSHIP_GOLD]
+MEMBERSHIP_WEIGHTS = [80, 15, 5]
+
+ADJECTIVES = ['Organic', 'Classic', 'Spicy', 'Fresh', 'Smoked', 'Sweet', 'Frozen', 'Roasted', 'Wild', 'Golden',
+              'Crispy', 'Italian', 'Dark', 'Light', 'Premium', 'Rustic']
+NOUNS = ['Coffee', 'Tea', 'Bread', 'Cheese', 'Salmon', 'Pasta', 'Olive Oil', 'Chocolate', 'Honey', 'Rice', 'Beans',
+         'Sauce', 'Cookies', 'Juice', 'Granola', 'Soup', 'Crackers', 'Vinegar', 'Noodles', 'Almonds']
+FIRST_NAMES = ['Ana', 'John', 'Maria', 'David', 'Sofia', 'James', 'Lucia', 'Robert', 'Emma', 'Carlos', 'Olivia',
+               'Michael', 'Mia', 'Daniel', 'Laura', 'Peter', 'Elena', 'Thomas', 'Sara', 'Luis']
+LAST_NAMES = ['Smith', 'Garcia', 'Johnson', 'Martinez', 'Brown', 'Lopez', 'Davis', 'Gonzalez', 'Miller', 'Wilson',
+              'Anderson', 'Perez', 'Taylor', 'Sanchez', 'Moore', 'Ramirez', 'Clark', 'Torres', 'Lewis', 'Rivera']
+WORDS = ['good', 'great', 'price', 'quality', 'taste', 'fresh', 'again', 'delivery', 'box', 'love', 'small', 'big',
+         'recommend', 'family', 'perfect', 'not', 'bad', 'value', 'daily', 'favorite']
+
+# what the worker processes need, set before they are forked
+_plan = None
+
+
+class Plan:
+    """
+    Everything the chunks need to generate their rows, the same in every process.
+    """
+
+    def __init__(self, counts, seed, skew, days, batch_size):
+        self.counts = counts
+        self.seed = seed
+        self.batch_size = batch_size
+        self.days = days
+        self.now = timezone.now()
+        self.password = make_password(PASSWORD)
+        self.product_type_id = ContentType.objects.get_for_model(Product).id
+
+        # a range of ids of its own in every table
+        self.first_id = {model: reserve_ids(model, counts[kind]) for model, kind in [
+            (Promotion, 'promotions'), (Collection, 'collections'), (Tag, 'tags'), (Product, 'products'),
+            (get_user_model(), 'customers'), (Customer, 'customers'), (Order, 'orders')]}
+
+        rng = self.random('plan')
+        self.prices = [Decimal(str(round(min(max(rng.lognormvariate(3, 0.8), 1), 9999), 2)))
+                       for _ in range(counts['products'])]
+        # which products are hot and which customers are heavy buyers is random, not the first ids
+        self.product_ranks = self.ranks(rng, counts['products'], skew)
+        self.customer_ranks = self.ranks(rng, counts['customers'], skew)
+
+    def random(self, *key):
+        # string seeds are reproducible between runs and processes, hash() of a tuple is not
+        return random.Random(':'.join(str(part) for part in (self.seed, *key)))
+
+    @staticmethod
+    def ranks(rng, count, skew):
+        order = list(range(count))
+        rng.shuffle(order)
+        # Zipf: the n-th most popular is picked with a weight of 1 / n^skew
+        weights = list(itertools.accumulate(1 / (rank + 1) ** skew for rank in range(count)))
+        return order, weights
+
+    def pick(self, rng, ranks, k=1):
+        order, weights = ranks
+        return [order[index] for index in rng.choices(range(len(order)), cum_weights=weights, k=k)]
+
+    def product_index(self, rng, k=1):
+        return self.pick(rng, self.product_ranks, k)
+
+    def customer_index(self, rng, k=1):
+        return self.pick(rng, self.customer_ranks, k)
+
+    def past(self, rng):
+        # more recent dates are more likely, like a store that grows
+        return self.now - timedelta(days=self.days * rng.random() ** 1.5, seconds=rng.randrange(86400))
+
+    def order_time(self, rng, index):
+        # in production the order ids grow with the time, the sales rollups (and any index on placed_at) rely on it.
+        # More orders per day at the end, the store grows
+        age = self.days * (1 - index / self.counts['orders']) ** 1.5
+        return self.now - timedelta(days=age, seconds=rng.randrange(60))
+
+    def chunks(self, kind, count):
+        """
+        (kind, chunk number, first row, rows) of every chunk of count rows.
+        """
+        return [(kind, number, start, min(self.batch_size, count - start))
+                for number, start in enumerate(range(0, count, self.batch_size))]
+
+
+def reserve_ids(model, count):
+    """
+    Moves the id sequence of the table past count new ids and returns the first of them. The table is locked while
+    the sequence moves, an insert at the same time waits and then gets an id after the range.
+    """
+    table = connection.ops.quote_name(model._meta.db_table)
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            with transaction.atomic():
+                cursor.execute(f'LOCK TABLE {table} IN EXCLUSIVE MODE')
+                cursor.execute("SELECT pg_get_serial_sequence(%s, 'id')", [model._meta.db_table])
+                sequence = cursor.fetchone()[0]
+                cursor.execute(f'SELECT GREATEST((SELECT COALESCE(MAX(id), 0) FROM {table}), last_value) '
+                               f'FROM {sequence}')
+                last_id = cursor.fetchone()[0]
+                cursor.execute('SELECT setval(%s, %s)', [sequence, max(last_id + count, 1)])
+        elif connection.vendor == 'mysql':
+            # LOCK TABLES commits the transaction, it can't be inside one
+            cursor.execute(f'LOCK TABLES {table} WRITE')
+            try:
+                cursor.execute(f'SELECT COALESCE(MAX(id), 0) FROM {table}')
+                last_id = cursor.fetchone()[0]
+                cursor.execute(f'ALTER TABLE {table} AUTO_INCREMENT = {last_id + count + 1}')
+            finally:
+                cursor.execute('UNLOCK TABLES')
+        elif connection.vendor == 'sqlite':
+            # the AUTOINCREMENT tables of Django keep their last id in sqlite_sequence
+            with transaction.atomic():
+                name = model._meta.db_table
+                cursor.execute(f'SELECT MAX(COALESCE((SELECT MAX(id) FROM {table}), 0), '
+                               f'COALESCE((SELECT seq FROM sqlite_sequence WHERE name = %s), 0))', [name])
+                last_id = cursor.fetchone()[0]
+                cursor.execute('DELETE FROM sqlite_sequence WHERE name = %s', [name])
+                cursor.execute('INSERT INTO sqlite_sequence (name, seq) VALUES (%s, %s)', [name, last_id + count])
+        else:
+            cursor.execute(f'SELECT COALESCE(MAX(id), 0) FROM {table}')
+            last_id = cursor.fetchone()[0]
+    return last_id + 1
+
+
+@contextmanager
+def explicit_dates():
+    """
+    bulk_create fills auto_now/auto_now_add fields with the current time, we want dates in the past.
+    """
+    fields = [Order._meta.get_field('placed_at'), Cart._meta.get_field('created_at'),
+              Review._meta.get_field('date'), Product._meta.get_field('last_udpate')]
+    saved = [(field, field.auto_now, field.auto_now_add) for field in fields]
+    for field in fields:
+        field.auto_now = field.auto_now_add = False
+    try:
+        yield
+    finally:
+        for field, auto_now, auto_now_add in saved:
+            field.auto_now, field.auto_now_add = auto_now, auto_now_add
+
+
+def generate_products(plan, rng, start, count):
+    first_id = plan.first_id[Product]
+    products, promotions, tags = [], [], []
+    Through = Product.promotions.through
+    for index in range(start, start + count):
+        product_id = first_id + index
+        title = f'{rng.choice(ADJECTIVES)} {rng.choice(NOUNS)} {index}'
+        products.append(Product(
+            id=product_id, title=title, slug=title.lower().replace(' ', '-'),
+            description=' '.join(rng.choices(WORDS, k=rng.randrange(5, 30))),
+            price=plan.prices[index], inventory=rng.randrange(10, 1000), last_udpate=plan.past(rng),
+            collection_id=plan.first_id[Collection] + rng.randrange(plan.counts['collections'])))
+        if plan.counts['promotions'] and rng.random() < 0.05:
+            promotions.append(Through(product_id=product_id,
+                                      promotion_id=plan.first_id[Promotion] + rng.randrange(plan.counts['promotions'])))
+        if plan.counts['tags']:
+            for tag in rng.sample(range(plan.counts['tags']), min(rng.randrange(5), plan.counts['tags'])):
+                tags.append(TaggedItem(tag_id=plan.first_id[Tag] + tag, content_type_id=plan.product_type_id,
+                                       object_id=product_id))
+    Product.objects.bulk_create(products, batch_size=plan.batch_size)
+    Through.objects.bulk_create(promotions, batch_size=plan.batch_size)
+    TaggedItem.objects.bulk_create(tags, batch_size=plan.batch_size)
+    return len(products) + len(promotions) + len(tags)
+
+
+def generate_customers(plan, rng, start, count):
+    # the user and its customer together, what create_customer_for_new_user does one user at a time
+    User = get_user_model()
+    users, customers = [], []
+    for index in range(start, start + count):
+        user_id = plan.first_id[User] + index
+        users.append(User(
+            id=user_id, username=f'user{user_id}', email=f'user{user_id}@example.com', password=plan.password,
+            first_name=rng.choice(FIRST_NAMES), last_name=rng.choice(LAST_NAMES), date_joined=plan.past(rng)))
+        customers.append(Customer(
+            id=plan.first_id[Customer] + index, user_id=user_id, phone=f'555-{rng.randrange(10 ** 7):07}',
+            birth_date=(plan.now - timedelta(days=rng.randrange(18 * 365, 80 * 365))).date(),
+            membership=rng.choices(MEMBERSHIPS, MEMBERSHIP_WEIGHTS)[0]))
+    User.objects.bulk_create(users, batch_size=plan.batch_size)
+    Customer.objects.bulk_create(customers, batch_size=plan.batch_size)
+    return len(users) + len(customers)
+
+
+def generate_orders(plan, rng, start, count):
+    orders, items = [], []
+    for index in range(start, start + count):
+        order_id = plan.first_id[Order] + index
+        orders.append(Order(
+            id=order_id, placed_at=plan.order_time(rng, index), payment_status=rng.choices(PAYMENT_STATUSES, PAYMENT_WEIGHTS)[0],
+            customer_id=plan.first_id[Customer] + plan.customer_index(rng)[0]))
+        size = rng.choices(ITEMS_PER_ORDER, ITEMS_WEIGHTS)[0]
+        for product in set(plan.product_index(rng, size)):
+            items.append(OrderItem(order_id=order_id, product_id=plan.first_id[Product] + product,
+                                   quantity=rng.choices([1, 2, 3, 4], [70, 20, 7, 3])[0], unit_price=plan.prices[product]))
+    Order.objects.bulk_create(orders, batch_size=plan.batch_size)
+    OrderItem.objects.bulk_create(items, batch_size=plan.batch_size)
+    return len(orders) + len(items)
+
+
+def generate_carts(plan, rng, start, count):
+    carts, items = [], []
+    for _ in range(count):
+        # the ids are random uuids like in production, the only thing that changes between runs with the same seed
+        cart = Cart(id=uuid.uuid4(), created_at=plan.past(rng))
+        carts.append(cart)
+        for product in set(plan.product_index(rng, rng.choices(ITEMS_PER_ORDER, ITEMS_WEIGHTS)[0])):
+            items.append(CartItem(cart_id=cart.id, product_id=plan.first_id[Product] + product,
+                                  quantity=rng.choices([1, 2, 3], [80, 15, 5])[0]))
+    Cart.objects.bulk_create(carts, batch_size=plan.batch_size)
+    CartItem.objects.bulk_create(items, batch_size=plan.batch_size)
+    return len(carts) + len(items)
+
+
+def generate_reviews(plan, rng, start, count):
+    reviews = [Review(product_id=plan.first_id[Product] + plan.product_index(rng)[0],
+                      name=f'{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}',
+                      description=' '.join(rng.choices(WORDS, k=rng.randrange(3, 40))), date=plan.past(rng))
+               for _ in range(count)]
+    Review.objects.bulk_create(reviews, batch_size=plan.batch_size)
+    return len(reviews)
+
+
+def generate_likes(plan, rng, start, count):
+    likes = [LikedItem(user_id=plan.first_id[get_user_model()] + plan.customer_index(rng)[0],
+                       content_type_id=plan.product_type_id,
+                       object_id=plan.first_id[Product] + plan.product_index(rng)[0])
+             for _ in range(count)]
+    # a hot product is liked twice by the same heavy user now and then, the unique constraint drops those
+    LikedItem.objects.bulk_create(likes, batch_size=plan.batch_size, ignore_conflicts=True)
+    return len(likes)
+
+
+GENERATORS = {
+    'products': generate_products,
+    'customers': generate_customers,
+    'orders': generate_orders,
+    'carts': generate_carts,
+    'reviews': generate_reviews,
+    'likes': generate_likes,
+}
+
+
+def run_chunk(chunk):
+    kind, number, start, count = chunk
+    with transaction.atomic():
+        return kind, GENERATORS[kind](_plan, _plan.random(kind, number), start, count)
+
+
+class Command(BaseCommand):
+    help = 'Fills the store with a large, skewed and reproducible dataset (see the counts of --scale 1 in the code)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scale', type=float, default=1,
+                            help='Multiplies the counts of --scale 1 (about 1.1M order items)')
+        for name, count in SCALE_1.items():
+            parser.add_argument(f'--{name}', type=int, help=f'Number of {name} (default {count} x scale)')
+        parser.add_argument('--seed', type=int, default=1)
+        parser.add_argument('--skew', type=float, default=0.9,
+                            help='Exponent of the Zipf distribution of products and customers, 0 is uniform')
+        parser.add_argument('--days', type=int, default=365, help='Orders, carts and reviews are spread over this many days')
+        parser.add_argument('--batch-size', type=int, default=5000, help='Rows per INSERT and per chunk')
+        parser.add_argument('--workers', type=int, default=1, help='Processes inserting at the same time')
+        parser.add_argument('--skip-derived', action='store_true',
+                            help="Don't rebuild the like counters, summaries, rollups and search index")
+
+    def handle(self, *args, **options):
+        global _plan
+        counts = {name: options[name] if options[name] is not None else int(count * options['scale'])
+                  for name, count in SCALE_1.items()}
+        workers = options['workers']
+        if workers > 1 and connection.vendor == 'sqlite':
+            self.stdout.write(self.style.WARNING('SQLite has a single writer, using one process'))
+            workers = 1
+
+        _plan = Plan(counts, options['seed'], options['skew'], options['days'], options['batch_size'])
+        start = time.perf_counter()
+        with explicit_dates():
+            self.generate_small_tables(counts)
+            # customers and products first, everything else points to them
+            self.run_chunks('products and customers', workers,
+                            _plan.chunks('products', counts['products']) + _plan.chunks('customers', counts['customers']))
+            self.feature_products(counts)
+            self.run_chunks('orders, carts, reviews and likes', workers, [
+                chunk for kind in ['orders', 'carts', 'reviews', 'likes'] for chunk in _plan.chunks(kind, counts[kind])])
+
+        # bulk_create didn't send the signals that invalidate the cached catalog
+        for model in [Product, Collection, TaggedItem]:
+            bump_version(model)
+        if not options['skip_derived']:
+            self.stdout.write('Rebuilding derived data...')
+            call_command('recount_likes', stdout=self.stdout)
+            call_command('recompute_customer_summaries', stdout=self.stdout)
+            call_command('refresh_sales_rollups', rebuild=True, lag=0, stdout=self.stdout)
+            call_command('rebuild_search_index', stdout=self.stdout)
+        self.stdout.write(self.style.SUCCESS(f'Done in {time.perf_counter() - start:.0f}s'))
+
+    def generate_small_tables(self, counts):
+        rng = _plan.random('small')
+        with transaction.atomic():
+            Promotion.objects.bulk_create([
+                Promotion(id=_plan.first_id[Promotion] + index, description=f'Promotion {index}',
+                          discount=rng.choice([0.05, 0.1, 0.15, 0.2, 0.3]))
+                for index in range(counts['promotions'])])
+            Collection.objects.bulk_create([
+                Collection(id=_plan.first_id[Collection] + index, title=f'{rng.choice(NOUNS)} {index}')
+                for index in range(counts['collections'])])
+            Tag.objects.bulk_create([
+                Tag(id=_plan.first_id[Tag] + index, label=f'{rng.choice(ADJECTIVES).lower()}-{index}')
+                for index in range(counts['tags'])])
+
+    def feature_products(self, counts):
+        # the hottest product of every new collection
+        first_id = _plan.first_id[Product]
+        collections = dict(Product.objects.filter(id__gte=first_id).values_list('id', 'collection_id'))
+        featured = {}
+        for product in _plan.product_ranks[0]:
+            featured.setdefault(collections[first_id + product], first_id + product)
+            if len(featured) == counts['collections']:
+                break
+        with transaction.atomic():
+            for collection_id, product_id in featured.items():
+                Collection.objects.filter(id=collection_id).update(featured_product_id=product_id)
+
+    def run_chunks(self, name, workers, chunks):
+        self.stdout.write(f'Generating {name} ({len(chunks)} chunks)...')
+        start = time.perf_counter()
+        rows = 0
+        if workers > 1:
+            # the children must open their own connections, a connection shared with the parent breaks both
+            connections.close_all()
+            with multiprocessing.get_context('fork').Pool(workers) as pool:
+                for kind, count in pool.imap_unordered(run_chunk, chunks):
+                    rows += count
+        else:
+            for chunk in chunks:
+                rows += run_chunk(chunk)[1]
+        elapsed = time.perf_counter() - start
+        self.stdout.write(f'  {rows} rows in {elapsed:.1f}s ({rows / elapsed if elapsed else 0:.0f} rows/s)')
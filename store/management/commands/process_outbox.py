@@ -0,0 +1,64 @@
+import logging
+import multiprocessing
+import time
+from django.core.management.base import BaseCommand
+from django.db import OperationalError, connections
+from store import outbox
+
+logger = logging.getLogger(__name__)
+
+# when the database is down, wait 1s, 2s, 4s... up to a minute between the attempts
+ERROR_BACKOFF_SECONDS = 1
+MAX_ERROR_BACKOFF_SECONDS = 60
+
+
+class Command(BaseCommand):
+    help = 'Delivers the pending outbox events (e.g. order_created) to the signal receivers'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100)
+        parser.add_argument('--processes', type=int, default=1,
+                            help='Worker processes. You can also run the command on many machines')
+        parser.add_argument('--sleep', type=float, default=1,
+                            help='Seconds to wait when there are no pending events')
+        parser.add_argument('--max-attempts', type=int, default=outbox.MAX_ATTEMPTS)
+        parser.add_argument('--once', action='store_true',
+                            help='Process the pending events and exit')
+
+    def handle(self, *args, **options):
+        if options['processes'] == 1:
+            self.work(options)
+            return
+
+        # the children cannot share the database connections of the parent
+        connections.close_all()
+        workers = [multiprocessing.Process(target=self.work, args=(options,))
+                   for _ in range(options['processes'])]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+    def work(self, options):
+        total = 0
+        errors = 0
+        while True:
+            try:
+                processed = outbox.process_batch(options['batch_size'], options['max_attempts'])
+            except OperationalError:
+                # the database restarted or a failover: the worker waits for it instead of dying
+                errors += 1
+                delay = min(ERROR_BACKOFF_SECONDS * 2 ** (errors - 1), MAX_ERROR_BACKOFF_SECONDS)
+                logger.exception(f'Could not process the outbox, retrying in {delay}s')
+                # the connection can be broken, the next query opens a new one
+                connections.close_all()
+                time.sleep(delay)
+                continue
+            errors = 0
+            total += processed
+            if processed:
+                continue
+            if options['once']:
+                break
+            time.sleep(options['sleep'])
+        self.stdout.write(f'Processed {total} events')
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+from store.search import rebuild_index
+
+
+class Command(BaseCommand):
+    help = ('Rebuilds the product full-text search index (run it after bulk imports, they skip the signals). '
+            'On MySQL it only counts the products, the FULLTEXT index is always up to date')
+
+    def handle(self, *args, **options):
+        count = rebuild_index()
+        self.stdout.write(self.style.SUCCESS(f'Indexed {count} products'))
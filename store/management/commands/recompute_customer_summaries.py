@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+from store import summaries
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the order count, lifetime spend and last order time of every customer from the orders'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=summaries.CHUNK_SIZE,
+                            help='Customers rebuilt per transaction')
+
+    def handle(self, *args, **options):
+        count = summaries.recompute(options['chunk_size'])
+        self.stdout.write(self.style.SUCCESS(f'Recomputed {count} customers'))
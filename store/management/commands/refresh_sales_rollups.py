@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+from store import rollups
+
+
+class Command(BaseCommand):
+    help = 'Adds the orders placed since the last run to the daily sales rollups. Schedule it (e.g. every minute)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=rollups.BATCH_SIZE,
+                            help='Orders added per transaction')
+        parser.add_argument('--lag', type=int, default=rollups.LAG_SECONDS,
+                            help='Only add orders placed at least this many seconds ago')
+        parser.add_argument('--rebuild', action='store_true',
+                            help='Delete the rollups and build them again from all the orders')
+
+    def handle(self, *args, **options):
+        refresh = rollups.rebuild if options['rebuild'] else rollups.refresh
+        added = refresh(options['batch_size'], options['lag'])
+        self.stdout.write(self.style.SUCCESS(f'Added {added} orders to the rollups'))
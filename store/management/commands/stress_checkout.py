@@ -0,0 +1,118 @@
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import OperationalError, connection
+from rest_framework.exceptions import ValidationError
+from store.models import Cart, CartItem, Collection, Customer, Order, OrderItem, Product
+from store.serializers import CreateOrderSerializer
+
+# a checkout that finds the database locked waits 10ms, 20ms, 40ms... (at most RETRY_MAX_DELAY), with jitter so the
+# threads don't come back all at once
+RETRY_DELAY = 0.01
+RETRY_MAX_DELAY = 1
+
+
+class Command(BaseCommand):
+    help = 'Runs many concurrent checkouts of the same product and checks that we never sell more than the inventory'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--orders', type=int, default=500, help='Number of checkouts')
+        parser.add_argument('--threads', type=int, default=50, help='Checkouts running at the same time')
+        parser.add_argument('--inventory', type=int, default=200, help='Initial inventory of the product')
+        parser.add_argument('--quantity', type=int, default=1, help='Units of the product in every cart')
+        parser.add_argument('--max-retries', type=int, default=20,
+                            help='Times a checkout is retried when the database is locked before giving up')
+
+    def handle(self, *args, **options):
+        self.stdout.write('Creating carts...')
+        product, carts = self.setup(options)
+        try:
+            elapsed, results = self.run(carts, options['threads'], options['max_retries'])
+            self.report(product, options, elapsed, results)
+        finally:
+            self.cleanup(product, carts)
+
+    def setup(self, options):
+        User = get_user_model()
+        collection = Collection.objects.create(title='Stress test')
+        product = Product.objects.create(
+            title='Hot SKU', price=10, inventory=options['inventory'], collection=collection)
+
+        carts = []
+        for i in range(options['orders']):
+            # the post_save signal creates the customer for every user
+            user = User.objects.create_user(
+                username=f'stress_{i}_{time.time_ns()}', email=f'stress_{i}_{time.time_ns()}@domain.com')
+            cart = Cart.objects.create()
+            CartItem.objects.create(cart=cart, product=product, quantity=options['quantity'])
+            # the API gets the customer id from the token, so we look it up here, outside of the timed part
+            carts.append((user.id, user.customer.id, cart.id))
+        return product, carts
+
+    def checkout(self, user_id, customer_id, cart_id, max_retries):
+        """
+        True if the order was placed, False if it was rejected (not enough inventory), None if we gave up.
+        """
+        try:
+            for attempt in range(max_retries + 1):
+                try:
+                    serializer = CreateOrderSerializer(data={'cart_id': cart_id}, context={'user_id': user_id, 'customer_id': customer_id})
+                    serializer.is_valid(raise_exception=True)
+                    serializer.save()
+                    return True
+                except ValidationError:
+                    return False
+                except OperationalError:
+                    # SQLite doesn't wait for a lock held by another transaction, it fails with "database is locked".
+                    # The transaction was rolled back so it is safe to try again, like a client would
+                    if attempt == max_retries:
+                        return None
+                    self.retries += 1
+                    delay = min(RETRY_DELAY * 2 ** attempt, RETRY_MAX_DELAY)
+                    time.sleep(delay * random.uniform(0.5, 1.5))
+        finally:
+            # every thread has its own database connection
+            connection.close()
+
+    def run(self, carts, threads, max_retries):
+        self.retries = 0
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            results = list(executor.map(lambda cart: self.checkout(*cart, max_retries), carts))
+        return time.perf_counter() - start, results
+
+    def report(self, product, options, elapsed, results):
+        product.refresh_from_db()
+        placed = results.count(True)
+        sold = OrderItem.objects.filter(product=product).count() * options['quantity']
+
+        self.stdout.write(f'Orders placed:   {placed}')
+        self.stdout.write(f'Orders rejected: {results.count(False)}')
+        self.stdout.write(f'Inventory left:  {product.inventory}')
+        self.stdout.write(f'Lock retries:    {self.retries}')
+        self.stdout.write(f'Gave up:         {results.count(None)}')
+        self.stdout.write(f'Orders/second:   {len(results) / elapsed:.1f}')
+
+        if None in results:
+            # we don't know how many orders there should be, try with fewer --threads or more --max-retries
+            raise CommandError(f'{results.count(None)} checkouts were still locked out after '
+                               f'{options["max_retries"]} retries')
+
+        expected = min(options['orders'], options['inventory'] // options['quantity'])
+        if product.inventory < 0 or sold != options['inventory'] - product.inventory or placed != expected:
+            raise CommandError(f'Oversold! {sold} units sold, inventory went from '
+                               f'{options["inventory"]} to {product.inventory}')
+        self.stdout.write(self.style.SUCCESS('No overselling'))
+
+    def cleanup(self, product, carts):
+        user_ids = [user_id for user_id, customer_id, cart_id in carts]
+        OrderItem.objects.filter(product=product).delete()
+        Order.objects.filter(customer__user_id__in=user_ids).delete()
+        Cart.objects.filter(pk__in=[cart_id for user_id, customer_id, cart_id in carts]).delete()
+        Customer.objects.filter(user_id__in=user_ids).delete()
+        get_user_model().objects.filter(id__in=user_ids).delete()
+        collection = product.collection
+        product.delete()
+        collection.delete()
@@ -0,0 +1,24 @@
+# Generated by Django 4.1 on 2026-10-16 23:45
+
+from django.db import migrations
+import store.search
+
+
+def create_search_index(apps, schema_editor):
+    store.search.create_index(schema_editor)
+
+
+def drop_search_index(apps, schema_editor):
+    store.search.drop_index(schema_editor)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0013_product_keyset_indexes'),
+    ]
+
+    operations = [
+        # FULLTEXT index on MySQL, FTS5 table on SQLite. See store/search.py
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
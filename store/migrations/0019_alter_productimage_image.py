@@ -0,0 +1,19 @@
+# Generated by Django 4.1 on 2026-10-17 00:52
+
+from django.db import migrations, models
+import store.validators
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0018_customersummary'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='productimage',
+            name='image',
+            field=models.ImageField(upload_to='store/images', validators=[store.validators.validate_file_size]),
+        ),
+    ]
@@ -1,5 +1,8 @@
+from collections import defaultdict
 from django.contrib import admin
-from django.db import models
+from django.db import connections, models
+from django.db.models.functions import Now
+from django.utils import timezone
 from django.conf import settings
 from django.core.validators import MinValueValidator
 # This is to generate a alphanumeric string to avoid using 1,2,3,4. We are using this for the id of the cart since we are putting the id in the url.
@@ -37,6 +40,38 @@ class Collection(models.Model):
 # in Python by default the fiels are NOT NULL unless you say (null=True)!!! in Java is the opposite
 
 
+class OutOfStock(Exception):
+    pass
+
+
+class ProductManager(models.Manager):
+    def reserve_inventory(self, quantities):
+        """
+        quantities is a dictionary {product_id: quantity}. Decrements the inventory of all the products with ONE
+        conditional UPDATE:
+            UPDATE store_product SET inventory = inventory - CASE id WHEN 1 THEN 2 ... END
+            WHERE (id = 1 AND inventory >= 2) OR ...
+        The database checks the condition on the locked, latest version of every row, so two checkouts of the same
+        product can never both take the last unit. If a product doesn't have enough inventory its row is not updated
+        and we raise OutOfStock. Call it inside transaction.atomic() so the other products are rolled back too.
+        """
+        if not quantities:
+            return
+        enough = models.Q()
+        for product_id, quantity in quantities.items():
+            enough |= models.Q(id=product_id, inventory__gte=quantity)
+        reserved = models.Case(
+            *[models.When(id=product_id, then=quantity) for product_id, quantity in quantities.items()],
+            output_field=models.IntegerField())
+
+        # update() doesn't touch auto_now fields, last_udpate is what the ETags of the product endpoints use
+        updated = self.filter(enough).update(
+            inventory=models.F('inventory') - reserved,
+            last_udpate=Now())
+        if updated != len(quantities):
+            raise OutOfStock()
+
+
 class Product(models.Model):
     title = models.CharField(max_length=255)
     slug = models.SlugField(default='-')
@@ -55,11 +90,20 @@ class Product(models.Model):
     # products_set will be created in Promotion automatically
     promotions = models.ManyToManyField(Promotion, blank=True)
 
+    objects = ProductManager()
+
     def __str__(self) -> str:
         return self.title
 
     class Meta:
         ordering = ['title']
+        # These indexes back the keyset pagination in store.pagination. The id is the tie breaker of every ordering,
+        # so the database can seek straight to (value, id) instead of scanning and sorting the table
+        indexes = [
+            models.Index(fields=['title', 'id']),
+            models.Index(fields=['price', 'id']),
+            models.Index(fields=['last_udpate', 'id']),
+        ]
 
 
 class ProductImage(models.Model):
@@ -113,8 +157,16 @@ class Customer(models.Model):
     def last_name(self):
         return self.user.last_name
 
+    # The counters are kept up to date in CustomerSummary (see store/summaries.py), so this doesn't run a COUNT
     def get_orders(self):
-        return self.orders.count()
+        return self.get_summary().orders_count
+
+    def get_summary(self):
+        # customers without orders don't have a summary row yet
+        try:
+            return self.summary
+        except CustomerSummary.DoesNotExist:
+            return CustomerSummary(customer=self)
 
     class Meta:
         ordering = ['user__first_name', 'user__last_name']
@@ -150,6 +202,25 @@ class Order(models.Model):
         permissions = [
             ('cancel_order', 'Can cancel an order'),
         ]
+        # The order list is paginated by placed_at with the id as the tie breaker (see OrderPagination).
+        # Staff walk all the orders, customers only their own
+        indexes = [
+            models.Index(fields=['placed_at', 'id']),
+            models.Index(fields=['customer', 'placed_at', 'id']),
+        ]
+
+
+class CustomerSummary(models.Model):
+    """
+    Precomputed order count, lifetime spend and last order time of a customer. Updated by the checkout and when the
+    payment status of an order changes (see store/summaries.py). Failed orders don't count towards the spend.
+    """
+    customer = models.OneToOneField(
+        Customer, on_delete=models.CASCADE, primary_key=True, related_name='summary')
+    orders_count = models.PositiveIntegerField(default=0)
+    lifetime_spend = models.DecimalField(
+        max_digits=14, decimal_places=2, default=0)
+    last_order_at = models.DateTimeField(null=True, blank=True)
 
 
 class OrderItem(models.Model):
@@ -177,6 +248,53 @@ class Cart(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
 
 
+class CartItemManager(models.Manager):
+    def add_items(self, cart_id, items):
+        """
+        Add (product_id, quantity) pairs to a cart. If the product is already in the cart we increment the quantity.
+        This is a single INSERT ... ON CONFLICT/ON DUPLICATE KEY UPDATE statement, so two requests adding the same
+        product at the same time cannot lose an increment or hit the unique constraint on (cart, product).
+        Returns the affected cart items.
+        """
+        # the same product twice in one batch would update the same row twice, we merge them first
+        quantities = defaultdict(int)
+        for product_id, quantity in items:
+            quantities[product_id] += quantity
+        if not quantities:
+            return self.none()
+
+        connection = connections[self.db]
+        quote = connection.ops.quote_name
+        table = quote(self.model._meta.db_table)
+        cart_field = self.model._meta.get_field('cart')
+        cart, product, quantity = (quote(self.model._meta.get_field(name).column)
+                                   for name in ('cart', 'product', 'quantity'))
+        cart_id = cart_field.get_db_prep_value(cart_id, connection)
+
+        params = []
+        for product_id, added in quantities.items():
+            params += [cart_id, product_id, added]
+        sql = f'INSERT INTO {table} ({cart}, {product}, {quantity}) VALUES ' + \
+            ', '.join(['(%s, %s, %s)'] * len(quantities))
+
+        if connection.vendor == 'mysql':
+            sql += f' ON DUPLICATE KEY UPDATE {quantity} = {quantity} + VALUES({quantity})'
+        elif connection.vendor in ('sqlite', 'postgresql'):
+            sql += f' ON CONFLICT ({cart}, {product}) DO UPDATE SET {quantity} = {table}.{quantity} + excluded.{quantity}'
+        else:
+            # No upsert syntax we know of. Increment with F() and create what is missing
+            for product_id, added in quantities.items():
+                updated = self.filter(cart_id=cart_id, product_id=product_id) \
+                    .update(quantity=models.F('quantity') + added)
+                if not updated:
+                    self.create(cart_id=cart_id, product_id=product_id, quantity=added)
+            return self.filter(cart_id=cart_id, product_id__in=quantities)
+
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+        return self.filter(cart_id=cart_id, product_id__in=quantities)
+
+
 class CartItem(models.Model):
     # one to many relationship. A cart can have many cart items
     # related_name='cartitems' means the Cart model will have a field called items, othwerise django use the default: cartitem_set
@@ -187,7 +305,82 @@ class CartItem(models.Model):
         validators=[MinValueValidator(1)]
     )
 
+    objects = CartItemManager()
+
     # To create a unique constraint, use the Meta class
     class Meta:
         # we can you can have many constraints, you use a list of list. In this case we just want a unique constraint for cart and product together
         unique_together = [('cart', 'product')]
+
+
+class OutboxEvent(models.Model):
+    """
+    Transactional outbox. The event is saved in the SAME transaction as the data it talks about (e.g. the order),
+    so either both are saved or none. The process_outbox command delivers the events to the signal receivers later,
+    outside the request. See store/outbox.py
+    """
+    STATUS_PENDING = 'P'
+    STATUS_DONE = 'D'
+    STATUS_FAILED = 'F'
+    STATUS_CHOICES = [
+        (STATUS_PENDING, 'Pending'),
+        (STATUS_DONE, 'Done'),
+        (STATUS_FAILED, 'Failed'),
+    ]
+    name = models.CharField(max_length=255)
+    payload = models.JSONField(default=dict)
+    status = models.CharField(
+        max_length=1, choices=STATUS_CHOICES, default=STATUS_PENDING)
+    created_at = models.DateTimeField(auto_now_add=True)
+    # the event is not picked up before this time. We use it for the retry backoff and to lease the event to a worker
+    available_at = models.DateTimeField(default=timezone.now)
+    attempts = models.PositiveIntegerField(default=0)
+    last_error = models.TextField(blank=True)
+
+    def __str__(self) -> str:
+        return f'{self.name} #{self.id}'
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'available_at']),
+        ]
+
+
+# Sales rollups (see store/rollups.py). Reports read these small tables instead of aggregating every order item.
+# They are refreshed incrementally by the refresh_sales_rollups command
+
+
+class DailyProductSales(models.Model):
+    date = models.DateField()
+    product = models.ForeignKey(
+        Product, on_delete=models.CASCADE, related_name='daily_sales')
+    units = models.PositiveIntegerField(default=0)
+    revenue = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    orders = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = [('date', 'product')]
+        indexes = [
+            models.Index(fields=['product', 'date']),
+        ]
+
+
+class DailyCollectionSales(models.Model):
+    date = models.DateField()
+    collection = models.ForeignKey(
+        Collection, on_delete=models.CASCADE, related_name='daily_sales')
+    units = models.PositiveIntegerField(default=0)
+    revenue = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+
+    class Meta:
+        unique_together = [('date', 'collection')]
+        indexes = [
+            models.Index(fields=['collection', 'date']),
+        ]
+
+
+class RollupWatermark(models.Model):
+    # the id of the last order already added to the rollups
+    name = models.CharField(max_length=255, unique=True)
+    last_order_id = models.BigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
@@ -0,0 +1,99 @@
+import logging
+import random
+import traceback
+from datetime import timedelta
+from django.db import transaction
+from django.utils import timezone
+from .models import OutboxEvent
+from .signals import order_created
+
+logger = logging.getLogger(__name__)
+
+# Transactional outbox
+# 1. The request saves an OutboxEvent in the same transaction as the order (publish). That is one INSERT, the request
+#    doesn't wait for the emails, the ERP or anything else that listens to the event.
+# 2. The process_outbox command takes the pending events in batches and sends the signal (process_batch).
+#    Many workers can run at the same time: the rows are claimed with SELECT ... FOR UPDATE SKIP LOCKED and leased
+#    for a while, so two workers never take the same event.
+# 3. If a receiver fails the event is retried later with exponential backoff. If the worker dies the lease expires
+#    and another worker takes the event. This means an event can be delivered MORE THAN ONCE (at-least-once),
+#    so the receivers must be idempotent.
+#    Every event is marked as done as soon as it is delivered, and a worker stops its batch when the lease is over
+#    (slow receivers): the rest of the batch belongs to the next worker, it isn't delivered twice.
+
+# event name -> signal sent to the receivers. The payload is passed as keyword arguments
+SIGNALS = {
+    'order_created': order_created,
+}
+
+LEASE_SECONDS = 300
+BACKOFF_SECONDS = 5
+MAX_BACKOFF_SECONDS = 60 * 60
+MAX_ATTEMPTS = 10
+
+
+def publish(name, **payload):
+    """
+    Call it inside the transaction that saves the data the event is about.
+    """
+    return OutboxEvent.objects.create(name=name, payload=payload)
+
+
+def claim_batch(batch_size, lease_seconds=LEASE_SECONDS):
+    now = timezone.now()
+    with transaction.atomic():
+        events = list(
+            OutboxEvent.objects
+            .select_for_update(skip_locked=True)
+            .filter(status=OutboxEvent.STATUS_PENDING, available_at__lte=now)
+            .order_by('available_at', 'id')[:batch_size])
+        # nobody else sees these events until the lease expires
+        lease_until = now + timedelta(seconds=lease_seconds)
+        OutboxEvent.objects \
+            .filter(id__in=[event.id for event in events]) \
+            .update(available_at=lease_until)
+    for event in events:
+        event.available_at = lease_until
+    return events
+
+
+def backoff(attempts):
+    # 5s, 10s, 20s, 40s... with some jitter so failed events don't all come back at the same time
+    delay = min(BACKOFF_SECONDS * 2 ** (attempts - 1), MAX_BACKOFF_SECONDS)
+    return timedelta(seconds=delay * random.uniform(0.8, 1.2))
+
+
+def deliver(event):
+    signal = SIGNALS.get(event.name)
+    if signal is None:
+        raise LookupError(f'Unknown event: {event.name}')
+    for receiver, response in signal.send_robust(sender=OutboxEvent, event_id=event.id, **event.payload):
+        if isinstance(response, Exception):
+            raise response
+
+
+def process_batch(batch_size=100, max_attempts=MAX_ATTEMPTS, lease_seconds=LEASE_SECONDS):
+    """
+    Deliver one batch of events. Returns how many events were processed.
+    """
+    events = claim_batch(batch_size, lease_seconds)
+    processed = 0
+    for event in events:
+        if timezone.now() >= event.available_at:
+            logger.warning(f'The lease is over, {len(events) - processed} events are left to the next worker')
+            break
+        processed += 1
+        try:
+            deliver(event)
+            OutboxEvent.objects.filter(id=event.id).update(status=OutboxEvent.STATUS_DONE)
+        except Exception as error:
+            event.attempts += 1
+            event.last_error = ''.join(traceback.format_exception(error))
+            if event.attempts >= max_attempts:
+                logger.error(f'Giving up on {event} after {event.attempts} attempts')
+                event.status = OutboxEvent.STATUS_FAILED
+            else:
+                logger.warning(f'{event} failed, will retry ({error})')
+                event.available_at = timezone.now() + backoff(event.attempts)
+            event.save(update_fields=['attempts', 'last_error', 'status', 'available_at'])
+    return processed
@@ -1,5 +1,216 @@
-from rest_framework.pagination import PageNumberPagination
+import json
+from base64 import b64decode, b64encode
+from collections import OrderedDict, namedtuple
+from datetime import date
+
+from django.core.exceptions import FieldDoesNotExist, ValidationError
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination, PageNumberPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
 
 
 class DefaultPagination(PageNumberPagination):
     page_size = 10
+
+
+# A cursor remembers the ordering it was created for, the sort value and id of the row we stopped at
+# and whether we are walking backwards (previous link)
+Cursor = namedtuple('Cursor', ['ordering', 'value', 'pk', 'reverse'])
+
+
+class KeysetPagination(BasePagination):
+    """
+    Keyset (a.k.a. seek) pagination. Instead of OFFSET we remember the last row of the page and ask the database
+    for the rows AFTER it: WHERE (price, id) > (last_price, last_id). With an index on (price, id) page 10,000 is as
+    cheap as page 1. Ties on the ordering field are broken with the id so no row is skipped or repeated.
+    """
+    page_size = 10
+    cursor_query_param = 'cursor'
+    # ?count=false skips the COUNT(*). The count is the only part of a page that still scans the whole table
+    count_query_param = 'count'
+    include_count = True
+    # Used when the view has no OrderingFilter or the client didn't ask for an ordering
+    ordering = 'title'
+    invalid_cursor_message = 'Invalid cursor'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.base_url = request.build_absolute_uri()
+        self.ordering = self.get_ordering(request, queryset, view)
+
+        self.cursor = self.decode_cursor(request)
+        reverse = self.cursor.reverse if self.cursor else False
+
+        # we count BEFORE applying the cursor filter, otherwise the count would shrink on every page
+        self.count = queryset.count() if self.get_include_count(request) else None
+
+        field = self.ordering.lstrip('-')
+        descending = self.ordering.startswith('-')
+        # walking backwards means flipping the direction and reversing the rows afterwards
+        if reverse:
+            descending = not descending
+
+        queryset = queryset.order_by(*self.get_order_by(field, descending))
+        if self.cursor is not None:
+            value = self.clean_cursor_value(queryset, field, self.cursor.value)
+            queryset = queryset.filter(self.get_seek_filter(field, descending, value, self.cursor.pk))
+
+        # fetch one extra row to know if there is another page without running a COUNT
+        results = list(queryset[:self.page_size + 1])
+        has_more = len(results) > self.page_size
+        results = results[:self.page_size]
+
+        if reverse:
+            results.reverse()
+            self.has_next = True
+            self.has_previous = has_more
+        else:
+            self.has_next = has_more
+            self.has_previous = self.cursor is not None
+
+        self.page = results
+        return results
+
+    def get_paginated_response(self, data):
+        response = OrderedDict()
+        if self.count is not None:
+            response['count'] = self.count
+        response['next'] = self.get_next_link()
+        response['previous'] = self.get_previous_link()
+        response['results'] = data
+        return Response(response)
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        if not self.page:
+            # we walked backwards past the first row, the next page is the one we came from
+            return self.encode_cursor(Cursor(self.ordering, self.cursor.value, self.cursor.pk, False))
+        return self.encode_cursor(self.get_position(self.page[-1], reverse=False))
+
+    def get_previous_link(self):
+        if not self.has_previous:
+            return None
+        if not self.page:
+            return self.encode_cursor(Cursor(self.ordering, self.cursor.value, self.cursor.pk, True))
+        return self.encode_cursor(self.get_position(self.page[0], reverse=True))
+
+    def get_include_count(self, request):
+        value = request.query_params.get(self.count_query_param)
+        if value is None:
+            return self.include_count
+        return value.lower() not in ('0', 'false', 'no')
+
+    def get_ordering(self, request, queryset, view):
+        """
+        Reuse the OrderingFilter of the view so ?ordering=-price works the same way it does with page numbers.
+        Without ?ordering= we keep the order the filters gave the queryset (?search= sorts by -search_rank).
+        Only the first ordering field is used; the id is always added as the tie breaker.
+        """
+        ordering = None
+        for backend in getattr(view, 'filter_backends', []):
+            if hasattr(backend, 'get_ordering'):
+                ordering = backend().get_ordering(request, queryset, view)
+                break
+        if ordering:
+            return ordering[0]
+        # query.order_by only has the order_by() calls, not the Meta.ordering of the model
+        if queryset.query.order_by and isinstance(queryset.query.order_by[0], str):
+            return queryset.query.order_by[0]
+        return self.ordering
+
+    def get_order_by(self, field, descending):
+        prefix = '-' if descending else ''
+        if field in ('id', 'pk'):
+            return [prefix + 'id']
+        return [prefix + field, prefix + 'id']
+
+    def get_seek_filter(self, field, descending, value, pk):
+        lookup = 'lt' if descending else 'gt'
+        if field in ('id', 'pk'):
+            return Q(**{f'id__{lookup}': pk})
+        return Q(**{f'{field}__{lookup}': value}) | Q(**{field: value, f'id__{lookup}': pk})
+
+    def get_position(self, instance, reverse):
+        field = self.ordering.lstrip('-')
+        value = getattr(instance, field) if field not in ('id', 'pk') else None
+        # Decimals and datetimes go in the cursor as strings, the ORM converts them back when filtering.
+        # Floats (the search rank) stay floats, json keeps every digit
+        if isinstance(value, date):
+            value = value.isoformat()
+        elif value is not None and not isinstance(value, (str, int, float)):
+            value = str(value)
+        return Cursor(self.ordering, value, instance.pk, reverse)
+
+    def encode_cursor(self, cursor):
+        # The cursor is opaque for the client, it just passes it back to us
+        payload = json.dumps([cursor.ordering, cursor.value, cursor.pk, int(cursor.reverse)])
+        encoded = b64encode(payload.encode('utf-8')).decode('ascii')
+        return replace_query_param(self.base_url, self.cursor_query_param, encoded)
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None
+        try:
+            ordering, value, pk, reverse = json.loads(
+                b64decode(encoded.encode('ascii')).decode('utf-8'))
+            pk = int(pk)
+        except (TypeError, ValueError):
+            raise NotFound(self.invalid_cursor_message)
+        # a cursor created for ?ordering=price cannot be used to walk ?ordering=-title
+        if ordering != self.ordering:
+            raise NotFound(self.invalid_cursor_message)
+        return Cursor(ordering, value, pk, bool(reverse))
+
+    def clean_cursor_value(self, queryset, field, value):
+        """
+        The client can edit the cursor: a value the field can't take would only fail in the database (a 500).
+        """
+        if field in ('id', 'pk'):
+            return value
+        # ?ordering=last_update and the search_rank are annotations, not fields of the model
+        annotation = queryset.query.annotations.get(field)
+        try:
+            model_field = annotation.output_field if annotation is not None else queryset.model._meta.get_field(field)
+        except FieldDoesNotExist:
+            return value
+        if value is None and model_field.null:
+            return value
+        try:
+            value = model_field.to_python(value)
+        except (ValidationError, TypeError, ValueError):
+            raise NotFound(self.invalid_cursor_message)
+        if value is None:
+            raise NotFound(self.invalid_cursor_message)
+        return value
+
+    def get_schema_operation_parameters(self, view):
+        return [
+            {
+                'name': self.cursor_query_param,
+                'required': False,
+                'in': 'query',
+                'description': 'The pagination cursor value.',
+                'schema': {'type': 'string'},
+            },
+            {
+                'name': self.count_query_param,
+                'required': False,
+                'in': 'query',
+                'description': 'Set to false to skip the total count.',
+                'schema': {'type': 'boolean'},
+            },
+        ]
+
+
+class OrderPagination(KeysetPagination):
+    """
+    Orders are listed newest first. Counting all the orders of the store on every page is too expensive,
+    the client can still ask for it with ?count=true
+    """
+    page_size = 20
+    ordering = '-placed_at'
+    include_count = False
@@ -0,0 +1,147 @@
+from datetime import timedelta
+from django.db import transaction
+from django.db.models import Count, DecimalField, ExpressionWrapper, F, Sum
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+from .cache import bump_version, cached_queryset
+from .models import DailyCollectionSales, DailyProductSales, Order, OrderItem, RollupWatermark
+
+# Daily sales per product and per collection.
+# Aggregating all the order items every time somebody opens a report doesn't work with millions of rows. Instead
+# the refresh adds the orders placed since the last run (the watermark, an order id) to small daily tables.
+#
+# Order ids are given out when the order is inserted, but a transaction with a smaller id can commit a bit AFTER a
+# transaction with a bigger one. If the refresh already moved the watermark past it, that order would never be
+# counted. That is why we only take orders that were placed at least `lag` seconds ago.
+
+WATERMARK = 'daily_sales'
+LAG_SECONDS = 60
+BATCH_SIZE = 5000
+
+revenue = ExpressionWrapper(
+    F('unit_price') * F('quantity'), output_field=DecimalField(max_digits=14, decimal_places=2))
+
+
+def refresh(batch_size=BATCH_SIZE, lag_seconds=LAG_SECONDS):
+    """
+    Add the new orders to the rollups, batch_size orders per transaction. Returns the number of orders added.
+    """
+    total = 0
+    while True:
+        added = refresh_batch(batch_size, lag_seconds)
+        if not added:
+            return total
+        total += added
+
+
+def refresh_batch(batch_size, lag_seconds):
+    cutoff = timezone.now() - timedelta(seconds=lag_seconds)
+    with transaction.atomic():
+        # the lock makes two refreshes running at the same time wait for each other instead of counting twice
+        RollupWatermark.objects.get_or_create(name=WATERMARK)
+        watermark = RollupWatermark.objects.select_for_update().get(name=WATERMARK)
+
+        order_ids = list(Order.objects
+                         .filter(id__gt=watermark.last_order_id, placed_at__lte=cutoff)
+                         .order_by('id')
+                         .values_list('id', flat=True)[:batch_size])
+        if not order_ids:
+            return 0
+        last_order_id = order_ids[-1]
+
+        items = OrderItem.objects.filter(
+            order_id__gt=watermark.last_order_id, order_id__lte=last_order_id)
+        daily = items.annotate(date=TruncDate('order__placed_at'))
+
+        add_to_rollup(
+            DailyProductSales, 'product_id',
+            daily.values('date', 'product_id').annotate(
+                units=Sum('quantity'), revenue=Sum(revenue), orders=Count('order_id', distinct=True)),
+            ['units', 'revenue', 'orders'])
+        add_to_rollup(
+            DailyCollectionSales, 'collection_id',
+            daily.values('date', collection_id=F('product__collection_id')).annotate(
+                units=Sum('quantity'), revenue=Sum(revenue)),
+            ['units', 'revenue'])
+
+        watermark.last_order_id = last_order_id
+        watermark.save()
+        # the cached reports are built from the rollups
+        transaction.on_commit(bump_rollup_versions)
+        return len(order_ids)
+
+
+def add_to_rollup(model, key, rows, fields):
+    """
+    rows are the new totals per (date, key). The rows that already exist are incremented, the others are created.
+    """
+    rows = {(row['date'], row[key]): row for row in rows}
+    if not rows:
+        return
+
+    # we only read the rollup rows of the dates we are touching
+    existing = {
+        (rollup.date, getattr(rollup, key)): rollup
+        for rollup in model.objects.filter(date__in={date for date, _ in rows}, **{f'{key}__in': {k for _, k in rows}})
+    }
+    updated, created = [], []
+    for (date, value), row in rows.items():
+        rollup = existing.get((date, value))
+        if rollup is None:
+            created.append(model(date=date, **{key: value}, **{field: row[field] for field in fields}))
+        else:
+            for field in fields:
+                setattr(rollup, field, getattr(rollup, field) + row[field])
+            updated.append(rollup)
+
+    model.objects.bulk_update(updated, fields, batch_size=1000)
+    model.objects.bulk_create(created, batch_size=1000)
+
+
+def rebuild(batch_size=BATCH_SIZE, lag_seconds=LAG_SECONDS):
+    with transaction.atomic():
+        DailyProductSales.objects.all().delete()
+        DailyCollectionSales.objects.all().delete()
+        RollupWatermark.objects.filter(name=WATERMARK).delete()
+        transaction.on_commit(bump_rollup_versions)
+    return refresh(batch_size, lag_seconds)
+
+
+def bump_rollup_versions():
+    bump_version(DailyProductSales)
+    bump_version(DailyCollectionSales)
+
+
+# The reports are read by every admin dashboard refresh. They are cached until the next refresh of the rollups
+# (or 10 minutes, the date range moves at midnight)
+REPORT_TIMEOUT = 10 * 60
+
+
+@cached_queryset('reports', REPORT_TIMEOUT, models=[DailyProductSales])
+def top_products(days, limit):
+    since = timezone.now().date() - timedelta(days=days - 1)
+    return DailyProductSales.objects \
+        .filter(date__gte=since) \
+        .values('product_id', title=F('product__title')) \
+        .annotate(units=Sum('units'), revenue=Sum('revenue')) \
+        .order_by('-revenue')[:limit]
+
+
+@cached_queryset('reports', REPORT_TIMEOUT, models=[DailyCollectionSales])
+def top_collections(days, limit):
+    since = timezone.now().date() - timedelta(days=days - 1)
+    return DailyCollectionSales.objects \
+        .filter(date__gte=since) \
+        .values('collection_id', title=F('collection__title')) \
+        .annotate(units=Sum('units'), revenue=Sum('revenue')) \
+        .order_by('-revenue')[:limit]
+
+
+@cached_queryset('reports', REPORT_TIMEOUT, models=[DailyCollectionSales])
+def daily_revenue(days):
+    since = timezone.now().date() - timedelta(days=days - 1)
+    return DailyCollectionSales.objects \
+        .filter(date__gte=since) \
+        .values('date') \
+        .annotate(units=Sum('units'), revenue=Sum('revenue')) \
+        .order_by('date')
@@ -0,0 +1,113 @@
+import re
+from django.db import connection
+from django.db.models import FloatField, Q
+from django.db.models.expressions import RawSQL
+
+# Full-text search for products (title + description).
+# LIKE '%coffee%' cannot use an index, so every search scans the whole product table. Instead we use the full-text
+# engine of the database we are running on:
+#   - MySQL (production): a FULLTEXT index on store_product(title, description). MySQL keeps it up to date by itself.
+#   - SQLite (db.sqlite3): an FTS5 virtual table. SQLite does not know it belongs to store_product, so we keep it
+#     up to date from the post_save/post_delete signals in store/signals/handlers.py
+# Any other database falls back to icontains so the filter keeps working.
+
+FTS_TABLE = 'store_product_fts'
+FULLTEXT_INDEX = 'store_product_fulltext'
+
+
+def tokenize(query):
+    # We only keep the words. This way the user cannot send operators that break the MATCH syntax
+    return re.findall(r'\w+', query or '')
+
+
+def search_products(queryset, query):
+    """
+    Filter the queryset to the products matching every word of the query (the last letters can be missing, so
+    'cof mak' finds 'Coffee Maker') and annotate each product with a search_rank. Higher rank = better match.
+    Products with the same rank are sorted by -id, the same tie breaker as the cursor pagination, so the pages are
+    stable.
+    """
+    words = tokenize(query)
+    if not words:
+        return queryset
+
+    vendor = connection.vendor
+    if vendor == 'mysql':
+        # IN BOOLEAN MODE: + means the word is required, * means prefix match
+        against = ' '.join(f'+{word}*' for word in words)
+        rank = RawSQL(
+            'MATCH (store_product.title, store_product.description) AGAINST (%s IN BOOLEAN MODE)', [against],
+            output_field=FloatField())
+        return queryset.annotate(search_rank=rank).filter(search_rank__gt=0).order_by('-search_rank', '-id')
+
+    if vendor == 'sqlite':
+        match = ' '.join(f'"{word}"*' for word in words)
+        # bm25 rank in FTS5 is negative and lower is better, we flip it so both backends sort the same way
+        rank = RawSQL(
+            f'SELECT -rank FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s AND rowid = store_product.id', [match],
+            output_field=FloatField())
+        ids = RawSQL(f'SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s', [match])
+        return queryset.filter(id__in=ids).annotate(search_rank=rank).order_by('-search_rank', '-id')
+
+    condition = Q()
+    for word in words:
+        condition &= Q(title__icontains=word) | Q(description__icontains=word)
+    return queryset.filter(condition)
+
+
+def index_product(product):
+    """
+    Called every time a product is saved. Only SQLite needs it, the MySQL FULLTEXT index is part of the table.
+    """
+    if connection.vendor != 'sqlite':
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(f'DELETE FROM {FTS_TABLE} WHERE rowid = %s', [product.pk])
+        cursor.execute(
+            f'INSERT INTO {FTS_TABLE} (rowid, title, description) VALUES (%s, %s, %s)',
+            [product.pk, product.title, product.description or ''])
+
+
+def remove_product(product_id):
+    if connection.vendor != 'sqlite':
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(f'DELETE FROM {FTS_TABLE} WHERE rowid = %s', [product_id])
+
+
+def create_index(schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'mysql':
+        schema_editor.execute(
+            f'CREATE FULLTEXT INDEX {FULLTEXT_INDEX} ON store_product (title, description)')
+    elif vendor == 'sqlite':
+        schema_editor.execute(
+            f'CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5(title, description)')
+        schema_editor.execute(
+            f"INSERT INTO {FTS_TABLE} (rowid, title, description) "
+            f"SELECT id, title, COALESCE(description, '') FROM store_product")
+
+
+def drop_index(schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'mysql':
+        schema_editor.execute(f'DROP INDEX {FULLTEXT_INDEX} ON store_product')
+    elif vendor == 'sqlite':
+        schema_editor.execute(f'DROP TABLE IF EXISTS {FTS_TABLE}')
+
+
+def rebuild_index():
+    """
+    Rebuild the whole index. Needed after bulk_create/update() because those don't fire signals.
+    Returns the number of indexed products.
+    Only the SQLite table needs it: MySQL updates the FULLTEXT index with every write, bulk ones too. Dropping and
+    creating it again would lock the table and leave the search without an index while it is built.
+    """
+    with connection.cursor() as cursor:
+        if connection.vendor == 'sqlite':
+            cursor.execute(f'DELETE FROM {FTS_TABLE}')
+            cursor.execute(
+                f"INSERT INTO {FTS_TABLE} (rowid, title, description) "
+                f"SELECT id, title, COALESCE(description, '') FROM store_product")
+        cursor.execute('SELECT COUNT(*) FROM store_product')
+        return cursor.fetchone()[0]
@@ -1,8 +1,9 @@
 from decimal import Decimal
 from django.db import transaction
 from rest_framework import serializers
-from .signals import order_created
-from .models import Product, Collection, ProductImage, Review, Cart, CartItem, Customer, Order, OrderItem, ProductImage
+from .cache import bump_version
+from . import outbox, summaries
+from .models import OutOfStock, Product, Collection, ProductImage, Review, Cart, CartItem, Customer, Order, OrderItem, ProductImage
 
 
 # This is where you define how you product resource will look like, because just like in Java, the resource
@@ -36,6 +37,14 @@ class ProductSerializer(serializers.ModelSerializer):
     def get_price_with_tax(self, product: Product):
         return product.price * Decimal(1.1)
 
+    # the view puts the tags of the whole page in the context ({product_id: [tag, ...]}) when the client asks for them
+    def to_representation(self, product):
+        data = super().to_representation(product)
+        tags = self.context.get('tags')
+        if tags is not None:
+            data['tags'] = [{'id': tag.id, 'label': tag.label} for tag in tags[product.id]]
+        return data
+
     # we are overring the validate method to create a custom validation. The default validaiton uses the model validation
     # This method is called when you use serializer.is_valid(raise_exception=True)
     def validate(self, data):
@@ -98,7 +107,11 @@ class CartItemSerializer(serializers.ModelSerializer):
 
     # is import to use the naming convention expected by django: get_<field_name> so that the serializerMethodField can use it
     # also cart_item can have any name you want. it refers to the instance model of the current serializer. We annotate with :CartItem to have intellisense
+    # The views annotate total_price in the database (see cart_item_total_price in views.py). We only calculate it
+    # here for cart items that don't come from those querysets
     def get_total_price(self, cart_item: CartItem):
+        if hasattr(cart_item, 'total_price'):
+            return cart_item.total_price
         return cart_item.product.price * cart_item.quantity
 
     class Meta:
@@ -113,7 +126,10 @@ class CartSerializer(serializers.ModelSerializer):
     items = CartItemSerializer(many=True, read_only=True)
     total_price = serializers.SerializerMethodField()
 
+    # CartViewSet annotates the total with a SUM in the database. A cart that was just created has no annotation
     def get_total_price(self, cart: Cart):
+        if hasattr(cart, 'total_price'):
+            return cart.total_price
         return sum([item.quantity * item.product.price for item in cart.items.all()])
 
     class Meta:
@@ -123,6 +139,29 @@ class CartSerializer(serializers.ModelSerializer):
         fields = ['id', 'items', 'total_price']
 
 
+class AddCartItemListSerializer(serializers.ListSerializer):
+    """
+    Used when the client POSTs a list of items to carts/{id}/items/. All the products are checked with one query
+    and all the items are added with one upsert.
+    """
+
+    def validate(self, attrs):
+        product_ids = {item['product_id'] for item in attrs}
+        existing = set(Product.objects.filter(
+            pk__in=product_ids).values_list('id', flat=True))
+        missing = product_ids - existing
+        if missing:
+            raise serializers.ValidationError(
+                f'Products do not exist: {", ".join(str(id) for id in sorted(missing))}')
+        return attrs
+
+    def create(self, validated_data):
+        cart_id = self.context['cart_id']
+        return list(CartItem.objects.add_items(
+            cart_id,
+            [(item['product_id'], item['quantity']) for item in validated_data]))
+
+
 class AddCartItemSerializer(serializers.ModelSerializer):
     product_id = serializers.IntegerField()
 
@@ -130,39 +169,32 @@ class AddCartItemSerializer(serializers.ModelSerializer):
     # Naming convention here is very important: validate_<field_name>
     # You either raise a validation error or return the validated value
     def validate_product_id(self, value):
-        try:
-            Product.objects.get(pk=value)
-        except Product.DoesNotExist:
+        # in a batch the list serializer checks all the products with one query
+        if isinstance(self.parent, serializers.ListSerializer):
+            return value
+
+        if not Product.objects.filter(pk=value).exists():
             raise serializers.ValidationError('Product does not exist')
 
         return value
 
     # because we have some custom business logic to save the the cart item (cannot have duplicates products)
     # we cannot rely on the default implementation of the save method in ModelSerializer. We need to override it
-
+    # add_items is an upsert: it creates the cart item or increments its quantity in one statement (see models.py)
     def save(self, **kwargs):
         cart_id = self.context['cart_id']  # this is set in the view
         product_id = self.validated_data['product_id']
         quantity = self.validated_data['quantity']
         # in the serializer we don't have access to url paramters, we need to use a context object in the view and pass it to the serializer
-        try:
-            cart_item = CartItem.objects.get(
-                cart_id=cart_id, product_id=product_id)
-            # update existing cart item
-            cart_item.quantity += quantity
-            self.instance = cart_item.save()
-
-        except CartItem.DoesNotExist:
-            # create new cart item
-            # ** unpacks the kwargs dictionary into the keyword arguments. SHORTCUT to avoid doing product_id=product_id, quantity=quantity
-            self.instance = CartItem.objects.create(
-                cart_id=cart_id, **self.validated_data)
+        self.instance = CartItem.objects.add_items(
+            cart_id, [(product_id, quantity)]).get()
 
         return self.instance
 
     class Meta:
         model = CartItem
         fields = ['id', 'product_id', 'quantity']
+        list_serializer_class = AddCartItemListSerializer
 
 
 class UpdateCartItemSerializer(serializers.ModelSerializer):
@@ -174,10 +206,18 @@ class UpdateCartItemSerializer(serializers.ModelSerializer):
 class CustomerSerializer(serializers.ModelSerializer):
     # Because user_id is created dynamically, we still need to specify it in here
     user_id = serializers.IntegerField(read_only=True)
+    # These come from the precomputed CustomerSummary, select_related('summary') to avoid one query per customer
+    orders_count = serializers.IntegerField(
+        source='get_summary.orders_count', read_only=True)
+    lifetime_spend = serializers.DecimalField(
+        source='get_summary.lifetime_spend', max_digits=14, decimal_places=2, read_only=True)
+    last_order_at = serializers.DateTimeField(
+        source='get_summary.last_order_at', read_only=True)
 
     class Meta:
         model = Customer
-        fields = ['id', 'user_id', 'phone', 'birth_date', 'membership']
+        fields = ['id', 'user_id', 'phone', 'birth_date', 'membership',
+                  'orders_count', 'lifetime_spend', 'last_order_at']
 
 
 class OrderItemSerializer(serializers.ModelSerializer):
@@ -190,17 +230,30 @@ class OrderItemSerializer(serializers.ModelSerializer):
 
 class OrderSerializer(serializers.ModelSerializer):
     items = OrderItemSerializer(many=True)
+    total_price = serializers.SerializerMethodField()
     # Because when we are creating an order we only pass the id, we need a different serializer
 
+    # OrderViewSet annotates the total with a SUM in the database. An order that was just created has no annotation
+    def get_total_price(self, order: Order):
+        if hasattr(order, 'total_price'):
+            return order.total_price
+        return sum([item.quantity * item.unit_price for item in order.items.all()])
+
     class Meta:
         model = Order
         fields = ['id', 'customer', 'placed_at',
-                  'payment_status', 'items']
+                  'payment_status', 'items', 'total_price']
 
 
 # Because when we update an order, we only want to update certain fields, we create a new serializer and using it for PATCH requests
 # Another solution will be to make the fields read only in the OrderSerializer, but this will make the serializer more complicated
 class UpdateOrderSerializer(serializers.ModelSerializer):
+    # failed orders don't count towards the lifetime spend of the customer. The post_save signal of Order updates the
+    # summary (see store/signals/handlers.py), in the transaction of the order
+    def update(self, instance, validated_data):
+        with transaction.atomic():
+            return super().update(instance, validated_data)
+
     class Meta:
         model = Order
         fields = ['payment_status']
@@ -225,42 +278,66 @@ class CreateOrderSerializer(serializers.Serializer):
 
     # because our logic to save an order is different than the default one, we need to override the save method
     def save(self, **kwargs):
-        with transaction.atomic():
-            cart_id = self.validated_data['cart_id']
-            print(cart_id)
-            # we don't have access to the user because we are in a serializer, we need to set a context object in the view to pass the user id here
-            print(self.context['user_id'])
-
-            # remember that get_or_create returns a tuple with the object and a boolean. The boolean is True if the object was created
-            # BECAUSE we are using signals now, we don't need to create the customer here
-            customer = Customer.objects.get(
-                user_id=self.context['user_id'])
-            # we only need to pass the customer because the other values are auto-generated or have a default value
-            order = Order.objects.create(customer=customer)
-
-            # VERY IMPORTANT that we use select_related('product') to eager load the product field, otherwise django will make a db call per cart item iteration
-            cart_items = CartItem.objects.select_related(
-                'product').filter(cart_id=cart_id)
-
-            # we use a list comprehension to create a list of OrderItem objects
-            order_items = [
-                OrderItem(
-                    order=order,
-                    product=item.product,
-                    unit_price=item.product.price,
-                    quantity=item.quantity
-                )
-                for item in cart_items
-            ]
-
-            # we use bulk_create to create the order items in one query
-            OrderItem.objects.bulk_create(order_items)
-
-            # now we need to delete the cart
-            Cart.objects.filter(pk=cart_id).delete()
-
-            # we are returning the order object so that we can use it in the view override method create, in order to return to the client
-            return order
+        cart_id = self.validated_data['cart_id']
+        try:
+            with transaction.atomic():
+                # remember that get_or_create returns a tuple with the object and a boolean. The boolean is True if the object was created
+                # BECAUSE we are using signals now, we don't need to create the customer here
+                # we don't have access to the request because we are in a serializer, the view passes the customer id
+                # (from the token) in the context
+                customer_id = self.context.get('customer_id') or Customer.objects.values_list(
+                    'id', flat=True).get(user_id=self.context['user_id'])
+
+                # VERY IMPORTANT that we use select_related('product') to eager load the product field, otherwise django will make a db call per cart item iteration
+                cart_items = list(CartItem.objects.select_related(
+                    'product').filter(cart_id=cart_id))
+
+                # Reserve the inventory FIRST. It is one UPDATE for all the lines and it raises OutOfStock if any line
+                # is short. The exception rolls back the whole transaction so nothing is reserved and no order is created
+                Product.objects.reserve_inventory(
+                    {item.product_id: item.quantity for item in cart_items})
+
+                # we only need to pass the customer because the other values are auto-generated or have a default value
+                order = Order.objects.create(customer_id=customer_id)
+
+                # we use a list comprehension to create a list of OrderItem objects
+                order_items = [
+                    OrderItem(
+                        order=order,
+                        product=item.product,
+                        unit_price=item.product.price,
+                        quantity=item.quantity
+                    )
+                    for item in cart_items
+                ]
+
+                # we use bulk_create to create the order items in one query
+                OrderItem.objects.bulk_create(order_items)
+
+                # keep the order count and lifetime spend of the customer up to date (see summaries.py)
+                summaries.record_order(
+                    customer_id,
+                    sum(item.unit_price * item.quantity for item in order_items),
+                    order.placed_at)
+
+                # now we need to delete the cart
+                Cart.objects.filter(pk=cart_id).delete()
+
+                # order_created is sent by the process_outbox worker, not here. The event is saved in this transaction
+                # so it exists if and only if the order does, and the checkout doesn't wait for the receivers
+                outbox.publish('order_created', order_id=order.id)
+
+                # update() doesn't fire post_save, so we invalidate the cached product responses ourselves
+                transaction.on_commit(lambda: bump_version(Product))
+        except OutOfStock:
+            # the transaction was rolled back, so now we can see which products are short
+            short = [item.product.title for item in CartItem.objects.select_related('product').filter(cart_id=cart_id)
+                     if item.quantity > item.product.inventory]
+            message = f'Not enough inventory for: {", ".join(short)}' if short else 'Not enough inventory'
+            raise serializers.ValidationError({'cart_id': [message]})
+
+        # we are returning the order object so that we can use it in the view override method create, in order to return to the client
+        return order
 
 
 class ProductImageSerializer(serializers.ModelSerializer):
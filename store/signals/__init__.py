@@ -2,6 +2,8 @@ from django.dispatch import Signal
 
 # Here is where you created custom signals
 
+# Sent by the process_outbox worker (see store/outbox.py), not inside the request. Receivers get order_id and
+# event_id keyword arguments. They can be called more than once for the same order, so make them idempotent
 order_created = Signal()
 
 # If you want MULTIPLE APPS to listen to a specific signal (event), you need to import that event in that app and so something
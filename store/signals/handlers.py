@@ -1,9 +1,13 @@
 # Signals allows us to decouple our apps using pre_save (fire before a model is saved) and post_save (fire after a model is saved)
 # pre_delete (fire before a model is deleted) and post_delete (fire after a model is deleted)
 from django.conf import settings
-from django.db.models.signals import post_save
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete, pre_save
 from django.dispatch import receiver
-from store.models import Customer
+from store.models import Customer, Order, Product, Collection
+from store import search, summaries
+from store.cache import bump_version
+from tags.models import TaggedItem
 
 # we specify a sender because we don't want to fire this signal for every post_save for all models
 # we use settings.AUTH_USER_MODEL instead of directly accessing the User model to avoid adding a dependency of the Core app in the Store app.
@@ -20,3 +24,52 @@ def create_customer_for_new_user(sender, **kwargs):
     """
     if kwargs['created']:
         Customer.objects.create(user=kwargs['instance'])
+
+
+# SQLite has no FULLTEXT index on the product table, the FTS5 table has to be kept up to date by us
+@receiver(post_save, sender=Product)
+def index_product(sender, **kwargs):
+    search.index_product(kwargs['instance'])
+
+
+@receiver(post_delete, sender=Product)
+def remove_product_from_index(sender, **kwargs):
+    search.remove_product(kwargs['instance'].pk)
+
+
+# Failed orders don't count towards the lifetime spend of the customer (see store/summaries.py). The checkout records
+# new orders itself, here we follow the payment status of every save of an existing order (the API, the admin, the
+# shell) and the deletes
+@receiver(pre_save, sender=Order)
+def remember_payment_status(sender, instance, **kwargs):
+    if instance.pk is not None and not instance._state.adding:
+        instance._old_payment_status = sender.objects.filter(pk=instance.pk) \
+            .values_list('payment_status', flat=True).first()
+
+
+@receiver(post_save, sender=Order)
+def update_summary_payment_status(sender, instance, created, **kwargs):
+    old_status = getattr(instance, '_old_payment_status', None)
+    if created or old_status is None:
+        return
+    with transaction.atomic():
+        summaries.record_status_change(instance, old_status)
+    instance._old_payment_status = instance.payment_status
+
+
+@receiver(post_delete, sender=Order)
+def update_summary_deleted_order(sender, instance, **kwargs):
+    summaries.record_order_deleted(instance)
+
+
+# Bumping the version invalidates every cached catalog response built from that model (see store/cache.py).
+# Only after the commit: a request between the bump and the commit would read the old rows and cache them under the
+# new version
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+@receiver(post_save, sender=Collection)
+@receiver(post_delete, sender=Collection)
+@receiver(post_save, sender=TaggedItem)
+@receiver(post_delete, sender=TaggedItem)
+def invalidate_catalog_cache(sender, **kwargs):
+    transaction.on_commit(lambda: bump_version(sender))
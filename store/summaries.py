@@ -0,0 +1,122 @@
+from django.db import connection, transaction
+from django.db.models import Count, DecimalField, ExpressionWrapper, F, Max, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce, Greatest
+from .models import Customer, CustomerSummary, Order, OrderItem
+
+# Customer summaries: order count, lifetime spend and last order time.
+# Instead of counting the orders of a customer every time we show it (admin list, /customers/me) we keep the
+# numbers in CustomerSummary and update them with F() expressions when something changes:
+#   - the checkout adds the new order (record_order)
+#   - an order goes to or from Failed: failed orders don't count towards the spend (record_status_change, called
+#     from the pre_save/post_save signals of Order, so the API and any other order.save() keep it up to date)
+#   - an order is deleted (record_order_deleted, from the post_delete signal)
+# The recompute_customer_summaries command rebuilds everything from the orders, in chunks of customers. It can run
+# while customers check out. Run it after changes that skip the signals: Order.objects.update(), raw SQL, deleting
+# order items.
+
+CHUNK_SIZE = 1000
+
+order_total = ExpressionWrapper(
+    F('unit_price') * F('quantity'), output_field=DecimalField(max_digits=14, decimal_places=2))
+
+
+def record_order(customer_id, total, placed_at):
+    """
+    Call it in the transaction that creates the order.
+    """
+    CustomerSummary.objects.get_or_create(customer_id=customer_id)
+    # F() makes the database do the increment, so two orders of the same customer at the same time are both counted
+    CustomerSummary.objects.filter(customer_id=customer_id).update(
+        orders_count=F('orders_count') + 1,
+        lifetime_spend=F('lifetime_spend') + total,
+        last_order_at=Greatest(Coalesce(F('last_order_at'), Value(placed_at)), Value(placed_at)))
+
+
+def record_status_change(order, old_status):
+    failed = Order.PAYMENT_STATUS_FAILED
+    if (old_status == failed) == (order.payment_status == failed):
+        return
+    total = OrderItem.objects.filter(order=order).aggregate(total=Sum(order_total))['total'] or 0
+    change = -total if order.payment_status == failed else total
+    CustomerSummary.objects.get_or_create(customer_id=order.customer_id)
+    CustomerSummary.objects.filter(customer_id=order.customer_id).update(
+        lifetime_spend=F('lifetime_spend') + change)
+
+
+def record_order_deleted(order):
+    """
+    Call it in the transaction that deletes the order. The items of an order are PROTECT: when the order can be
+    deleted it has none, so it adds nothing to the spend.
+    """
+    last_order_at = Order.objects \
+        .filter(customer_id=OuterRef('customer_id')) \
+        .order_by('-placed_at') \
+        .values('placed_at')[:1]
+    CustomerSummary.objects.filter(customer_id=order.customer_id).update(
+        orders_count=F('orders_count') - 1,
+        last_order_at=Subquery(last_order_at))
+
+
+def recompute(chunk_size=CHUNK_SIZE):
+    """
+    Rebuild the summaries of every customer, one chunk of customers per transaction. Returns the number of customers.
+    """
+    total = 0
+    last_id = 0
+    while True:
+        ids = list(Customer.objects
+                   .filter(id__gt=last_id)
+                   .order_by('id')
+                   .values_list('id', flat=True)[:chunk_size])
+        if not ids:
+            return total
+        recompute_chunk(ids[0], ids[-1])
+        total += len(ids)
+        last_id = ids[-1]
+
+
+def recompute_chunk(first_id, last_id):
+    """
+    The checkouts and the status changes of these customers wait until the chunk is written:
+      - a new order locks its customer (foreign key check), so the customers are locked first. A checkout that
+        already created its order commits before the lock is ours, and its order is counted below.
+      - record_status_change updates the summary after the order: it waits for the lock on the summary and then adds
+        its change on top of the recomputed numbers, which didn't see its uncommitted order.
+    The rows are upserted, not deleted and created again: record_order can create a summary at any time.
+    """
+    with transaction.atomic():
+        list(Customer.objects.select_for_update()
+             .filter(id__gte=first_id, id__lte=last_id).values_list('id', flat=True))
+        list(CustomerSummary.objects.select_for_update()
+             .filter(customer_id__gte=first_id, customer_id__lte=last_id).values_list('customer_id', flat=True))
+        orders = Order.objects \
+            .filter(customer_id__gte=first_id, customer_id__lte=last_id) \
+            .values('customer_id') \
+            .annotate(orders_count=Count('id'), last_order_at=Max('placed_at'))
+        spend = dict(
+            OrderItem.objects
+            .filter(order__customer_id__gte=first_id, order__customer_id__lte=last_id)
+            .exclude(order__payment_status=Order.PAYMENT_STATUS_FAILED)
+            .values('order__customer_id')
+            .annotate(spend=Sum(order_total))
+            .values_list('order__customer_id', 'spend'))
+
+        summaries = [
+            CustomerSummary(
+                customer_id=row['customer_id'],
+                orders_count=row['orders_count'],
+                lifetime_spend=spend.get(row['customer_id']) or 0,
+                last_order_at=row['last_order_at'])
+            for row in orders
+        ]
+        # MySQL (ON DUPLICATE KEY UPDATE) doesn't take the unique fields, the primary key is the conflict. The column
+        # name and not the field name: Django 4.1 writes them in the ON CONFLICT clause as they are
+        unique_fields = ['customer_id'] if connection.features.supports_update_conflicts_with_target else None
+        CustomerSummary.objects.bulk_create(
+            summaries, update_conflicts=True, unique_fields=unique_fields,
+            update_fields=['orders_count', 'lifetime_spend', 'last_order_at'])
+        # the customers whose orders are all gone
+        CustomerSummary.objects \
+            .filter(customer_id__gte=first_id, customer_id__lte=last_id) \
+            .exclude(customer_id__in=[summary.customer_id for summary in summaries]) \
+            .update(orders_count=0, lifetime_spend=0, last_order_at=None)
@@ -1,3 +1,1050 @@
-from django.test import TestCase
+import io
+import json
+import os
+import tempfile
+import threading
+import time
+from base64 import b64encode
+from datetime import timedelta
+from decimal import Decimal
+from unittest import mock
+from django.contrib.admin.models import CHANGE, LogEntry
+from django.contrib.auth import get_user_model
+from django.contrib.contenttypes.models import ContentType
+from django.core.management import CommandError, call_command
+from django.db import OperationalError, connection
+from django.db.models import Count, Sum
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken, RefreshToken
+from likes.models import LikedItem
+from tags.models import Tag, TaggedItem
+from . import outbox, rollups, summaries
+from . import cache as store_cache
+from .management.commands.benchmark import compare as compare_benchmarks
+from .management.commands.generate_dataset import reserve_ids
+from .checks import check_shared_cache
+from .cache import cached_queryset, cached_serializer, clear as clear_cache, get_or_compute, get_stats, get_tier_stats
+from .models import Cart, CartItem, Collection, Customer, CustomerSummary, DailyProductSales, Order, OrderItem, OutboxEvent, Product
+from .serializers import CollectionSerializer
+from .search import search_products
+from .signals import order_created
+
+User = get_user_model()
 
 # Create your tests here.
+
+
+class KeysetPaginationTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        collection = Collection.objects.create(title='Beverages')
+        # only 3 different prices so most rows tie on the ordering field and the id has to break the tie
+        Product.objects.bulk_create([
+            Product(title=f'Product {i:02}', price=Decimal(10 + i % 3), inventory=10, collection=collection)
+            for i in range(25)
+        ])
+
+    def setUp(self):
+        clear_cache()
+        self.client = APIClient()
+
+    def walk(self, url):
+        ids = []
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            ids += [product['id'] for product in response.data['results']]
+            url = response.data['next']
+        return ids
+
+    def test_walks_every_product_once_with_ties(self):
+        for ordering in ['price', '-price', 'title', '-last_update']:
+            ids = self.walk(
+                f'/store/products/?pagination=cursor&ordering={ordering}')
+            self.assertEqual(len(ids), 25)
+            self.assertEqual(len(set(ids)), 25)
+
+    def test_previous_link_returns_the_same_page(self):
+        first = self.client.get('/store/products/?pagination=cursor&ordering=price')
+        second = self.client.get(first.data['next'])
+        back = self.client.get(second.data['previous'])
+        self.assertEqual(back.data['results'], first.data['results'])
+        self.assertIsNone(back.data['previous'])
+
+    def test_deep_pages_seek_instead_of_offset(self):
+        first = self.client.get('/store/products/?pagination=cursor&count=false')
+        self.assertNotIn('count', first.data)
+
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(first.data['next'])
+
+        # the page seeks to the cursor instead of scanning an OFFSET
+        pages = [query['sql'] for query in queries if 'LIMIT' in query['sql']]
+        self.assertEqual(len(pages), 1)
+        self.assertNotIn('OFFSET', pages[0])
+
+    def test_invalid_cursor(self):
+        response = self.client.get('/store/products/?pagination=cursor&cursor=nonsense')
+        self.assertEqual(response.status_code, 404)
+
+    def test_tampered_cursor_value(self):
+        for ordering, value in [('price', 'abc'), ('-last_update', 'yesterday'), ('price', None), ('price', [1])]:
+            cursor = b64encode(json.dumps([ordering, value, 1, 0]).encode()).decode()
+            response = self.client.get('/store/products/', {'pagination': 'cursor', 'ordering': ordering,
+                                                            'cursor': cursor})
+            self.assertEqual(response.status_code, 404, (ordering, value))
+
+    def test_page_numbers_still_work(self):
+        response = self.client.get('/store/products/?page=2')
+        self.assertEqual(response.data['count'], 25)
+        self.assertEqual(len(response.data['results']), 10)
+
+
+class ProductSearchTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        collection = Collection.objects.create(title='Kitchen')
+        # created one by one so the post_save signal indexes them
+        for title, description in [
+            ('Coffee Maker', 'Makes great coffee'),
+            ('Coffee Beans', None),
+            ('Tea Kettle', 'Not for coffee lovers'),
+            ('Toaster', 'Bread goes in, toast comes out'),
+        ]:
+            Product.objects.create(title=title, description=description,
+                                   price=10, inventory=10, collection=collection)
+
+    def setUp(self):
+        clear_cache()
+
+    def search(self, query):
+        response = APIClient().get('/store/products/', {'search': query})
+        return [product['title'] for product in response.data['results']]
+
+    def test_prefix_matching_on_every_word(self):
+        self.assertEqual(self.search('cof mak'), ['Coffee Maker'])
+        self.assertEqual(self.search('toast'), ['Toaster'])
+
+    def test_ranked_by_relevance(self):
+        titles = self.search('coffee')
+        self.assertEqual(set(titles), {'Coffee Maker', 'Coffee Beans', 'Tea Kettle'})
+        # the word appears twice in the coffee maker and only in the description of the kettle
+        self.assertEqual(titles[0], 'Coffee Maker')
+        self.assertEqual(titles[-1], 'Tea Kettle')
+
+    def test_index_follows_saves_and_deletes(self):
+        product = Product.objects.get(title='Toaster')
+        product.title = 'Sandwich Toaster'
+        product.save()
+        self.assertEqual(self.search('sandwich'), ['Sandwich Toaster'])
+
+        product.delete()
+        self.assertEqual(self.search('toast'), [])
+
+    def test_same_rank_is_sorted_by_id(self):
+        collection = Collection.objects.get()
+        ids = [Product.objects.create(title='Mug', price=10, inventory=10, collection=collection).id
+               for _ in range(3)]
+        response = APIClient().get('/store/products/', {'search': 'mug'})
+        self.assertEqual([product['id'] for product in response.data['results']], ids[::-1])
+
+    def test_operators_are_ignored(self):
+        self.assertEqual(self.search('"coffee*" -('), self.search('coffee'))
+
+    def test_cursor_pages_keep_the_relevance_order(self):
+        collection = Collection.objects.get()
+        for i in range(1, 13):
+            Product.objects.create(title=f'Mug {i}', description=' '.join(['coffee'] * i),
+                                   price=10, inventory=10, collection=collection)
+        expected = list(search_products(Product.objects.all(), 'coffee')
+                        .order_by('-search_rank', '-id').values_list('id', flat=True))
+
+        client = APIClient()
+        first = client.get('/store/products/', {'search': 'coffee', 'pagination': 'cursor'})
+        second = client.get(first.data['next'])
+        ids = [product['id'] for product in first.data['results'] + second.data['results']]
+        self.assertEqual(ids, expected)
+        self.assertIsNone(second.data['next'])
+        self.assertEqual(client.get(second.data['previous']).data['results'], first.data['results'])
+
+
+class ResponseCacheTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.collection = Collection.objects.create(title='Beverages')
+        cls.product = Product.objects.create(
+            title='Coffee', price=10, inventory=10, collection=cls.collection)
+
+    def setUp(self):
+        clear_cache()
+        self.client = APIClient()
+        # ProductDetail is only available to authenticated users
+        user = User.objects.create_user(username='john', email='john@domain.com', password='x')
+        self.client.force_authenticate(user)
+
+    def test_second_request_is_served_from_the_cache(self):
+        self.client.get('/store/products/?page=1&ordering=price')
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/store/products/?ordering=price&page=1')
+        self.assertEqual(response['X-Cache'], 'HIT')
+        self.assertEqual(len(queries), 0)
+        self.assertEqual(get_stats('ProductView'), {'hits': 1, 'misses': 1})
+
+    def test_unknown_query_params_share_the_cached_response(self):
+        self.client.get('/store/products/?ordering=price')
+        for junk in ['?ordering=price&random=1', '?random=2&ordering=price']:
+            self.assertEqual(self.client.get(f'/store/products/{junk}')['X-Cache'], 'HIT')
+        self.assertEqual(self.client.get('/store/products/?ordering=-price')['X-Cache'], 'MISS')
+
+    def test_process_local_cache_fails_the_deploy_check(self):
+        self.assertEqual([error.id for error in check_shared_cache(None)], ['store.E001'])
+        with override_settings(CACHES={'default': {
+                'BACKEND': 'django.core.cache.backends.redis.RedisCache', 'LOCATION': 'redis://localhost'}}):
+            self.assertEqual(check_shared_cache(None), [])
+
+    def test_saving_a_product_invalidates_products_and_collections(self):
+        self.client.get(f'/store/products/{self.product.id}/')
+        self.client.get(f'/store/collections/{self.collection.id}/')
+
+        self.product.title = 'Espresso'
+        with self.captureOnCommitCallbacks(execute=True):
+            self.product.save()
+
+        response = self.client.get(f'/store/products/{self.product.id}/')
+        self.assertEqual(response['X-Cache'], 'MISS')
+        self.assertEqual(response.data['title'], 'Espresso')
+        response = self.client.get(f'/store/collections/{self.collection.id}/')
+        self.assertEqual(response['X-Cache'], 'MISS')
+
+    def test_version_is_bumped_after_the_commit(self):
+        self.client.get(f'/store/products/{self.product.id}/')
+        with self.captureOnCommitCallbacks() as callbacks:
+            self.product.title = 'Espresso'
+            self.product.save()
+            # a request before the commit still gets the cached response, not the old rows under a new version
+            self.assertEqual(self.client.get(f'/store/products/{self.product.id}/')['X-Cache'], 'HIT')
+        self.assertTrue(callbacks)
+
+        for callback in callbacks:
+            callback()
+        response = self.client.get(f'/store/products/{self.product.id}/')
+        self.assertEqual(response['X-Cache'], 'MISS')
+        self.assertEqual(response.data['title'], 'Espresso')
+
+
+class ConditionalGetTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        collection = Collection.objects.create(title='Beverages')
+        cls.product = Product.objects.create(
+            title='Coffee', price=10, inventory=10, collection=collection)
+        Product.objects.create(title='Tea', price=5, inventory=10, collection=collection)
+
+    def setUp(self):
+        clear_cache()
+        self.client = APIClient()
+        user = User.objects.create_user(username='john', email='john@domain.com', password='x')
+        self.client.force_authenticate(user)
+
+    def test_unchanged_list_page_costs_one_query(self):
+        response = self.client.get('/store/products/?ordering=price')
+        etag = response['ETag']
+
+        # not cached: one aggregate query for the validators and nothing else
+        clear_cache()
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/store/products/?ordering=price', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(len(queries), 1)
+
+        # cached: the validators are cached with the response
+        self.client.get('/store/products/?ordering=price')
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/store/products/?ordering=price', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(len(queries), 0)
+
+        # a different page is a different response
+        response = self.client.get('/store/products/?ordering=-price', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+    def test_deleting_a_product_changes_the_list_etag(self):
+        etag = self.client.get('/store/products/')['ETag']
+        with self.captureOnCommitCallbacks(execute=True):
+            Product.objects.get(title='Tea').delete()
+        response = self.client.get('/store/products/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+    def test_detail_validators(self):
+        url = f'/store/products/{self.product.id}/'
+        response = self.client.get(url)
+        etag, last_modified = response['ETag'], response['Last-Modified']
+
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        self.assertEqual(self.client.get(url, HTTP_IF_MODIFIED_SINCE=last_modified).status_code, 304)
+
+        self.product.price = 12
+        with self.captureOnCommitCallbacks(execute=True):
+            self.product.save()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['price'], 12)
+
+
+class CartTotalTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        collection = Collection.objects.create(title='Beverages')
+        cls.cart = Cart.objects.create()
+        CartItem.objects.bulk_create([
+            CartItem(cart=cls.cart, quantity=i + 1, product=Product.objects.create(
+                title=f'Product {i}', price=Decimal('1.25') * (i + 1), inventory=10, collection=collection))
+            for i in range(20)
+        ])
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(User(id=1))
+
+    def test_totals_are_calculated_by_the_database(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(f'/store/carts/{self.cart.id}/')
+
+        # the cart with its total and the items with their products, no matter how many items there are
+        self.assertEqual(len(queries), 2)
+        items = response.data['items']
+        self.assertEqual(len(items), 20)
+        for item in items:
+            self.assertEqual(item['total_price'], item['product']['price'] * item['quantity'])
+        self.assertEqual(response.data['total_price'], sum(item['total_price'] for item in items))
+
+    def test_empty_cart(self):
+        cart = Cart.objects.create()
+        response = self.client.get(f'/store/carts/{cart.id}/')
+        self.assertEqual(response.data['total_price'], 0)
+
+
+class AddCartItemTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        collection = Collection.objects.create(title='Beverages')
+        cls.coffee = Product.objects.create(title='Coffee', price=10, inventory=10, collection=collection)
+        cls.tea = Product.objects.create(title='Tea', price=5, inventory=10, collection=collection)
+
+    def setUp(self):
+        self.cart = Cart.objects.create()
+        self.url = f'/store/carts/{self.cart.id}/items/'
+        self.client = APIClient()
+        self.client.force_authenticate(User(id=1))
+
+    def test_adding_the_same_product_increments_the_quantity(self):
+        self.client.post(self.url, {'product_id': self.coffee.id, 'quantity': 2})
+        response = self.client.post(self.url, {'product_id': self.coffee.id, 'quantity': 3})
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data['quantity'], 5)
+        self.assertEqual(CartItem.objects.get(cart=self.cart).quantity, 5)
+
+    def test_batch(self):
+        self.client.post(self.url, {'product_id': self.tea.id, 'quantity': 1})
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(self.url, [
+                {'product_id': self.coffee.id, 'quantity': 2},
+                {'product_id': self.tea.id, 'quantity': 1},
+                {'product_id': self.coffee.id, 'quantity': 1},
+            ], format='json')
+
+        self.assertEqual(response.status_code, 201)
+        # check the products, the upsert and read the items back
+        self.assertEqual(len(queries), 3)
+        quantities = dict(CartItem.objects.filter(cart=self.cart).values_list('product_id', 'quantity'))
+        self.assertEqual(quantities, {self.coffee.id: 3, self.tea.id: 2})
+
+    def test_batch_with_unknown_products(self):
+        response = self.client.post(self.url, [
+            {'product_id': self.coffee.id, 'quantity': 2},
+            {'product_id': 9999, 'quantity': 1},
+        ], format='json')
+
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(CartItem.objects.filter(cart=self.cart).exists())
+
+
+class CheckoutInventoryTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        collection = Collection.objects.create(title='Beverages')
+        cls.coffee = Product.objects.create(title='Coffee', price=10, inventory=5, collection=collection)
+        cls.tea = Product.objects.create(title='Tea', price=5, inventory=1, collection=collection)
+        cls.user = User.objects.create_user(username='john', email='john@domain.com', password='x')
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def checkout(self, coffee, tea):
+        cart = Cart.objects.create()
+        CartItem.objects.add_items(cart.id, [(self.coffee.id, coffee), (self.tea.id, tea)])
+        return self.client.post('/store/orders/', {'cart_id': cart.id})
+
+    def test_checkout_reserves_the_inventory(self):
+        response = self.checkout(coffee=2, tea=1)
+
+        self.assertEqual(response.status_code, 200)
+        self.coffee.refresh_from_db()
+        self.tea.refresh_from_db()
+        self.assertEqual((self.coffee.inventory, self.tea.inventory), (3, 0))
+
+    def test_short_line_rejects_the_whole_order(self):
+        response = self.checkout(coffee=2, tea=2)
+
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('Tea', response.data['cart_id'][0])
+        self.assertNotIn('Coffee', response.data['cart_id'][0])
+        # nothing was reserved and no order was created
+        self.coffee.refresh_from_db()
+        self.assertEqual(self.coffee.inventory, 5)
+        self.assertFalse(Order.objects.exists())
+
+
+class OrderListTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        collection = Collection.objects.create(title='Beverages')
+        products = [Product.objects.create(title=f'Product {i}', price=i + 1, inventory=10, collection=collection)
+                    for i in range(3)]
+        cls.staff = User.objects.create_user(username='staff', email='staff@domain.com', is_staff=True)
+        cls.john = User.objects.create_user(username='john', email='john@domain.com')
+        cls.mary = User.objects.create_user(username='mary', email='mary@domain.com')
+        for user, count in [(cls.john, 30), (cls.mary, 5)]:
+            for i in range(count):
+                order = Order.objects.create(customer=Customer.objects.get(user=user))
+                OrderItem.objects.bulk_create([
+                    OrderItem(order=order, product=product, quantity=2, unit_price=product.price)
+                    for product in products])
+
+    def list_orders(self, user, url='/store/orders/'):
+        client = APIClient()
+        client.force_authenticate(user)
+        ids = []
+        while url:
+            with CaptureQueriesContext(connection) as queries:
+                response = client.get(url)
+            # the page of orders with their totals, and their items with the products
+            self.assertEqual(len(queries), 2)
+            ids += [order['id'] for order in response.data['results']]
+            for order in response.data['results']:
+                self.assertEqual(order['total_price'], 12)
+            url = response.data['next']
+        return ids
+
+    def test_staff_walk_every_order_with_a_fixed_number_of_queries(self):
+        ids = self.list_orders(self.staff)
+        self.assertEqual(len(ids), 35)
+        # newest first
+        self.assertEqual(ids, sorted(ids, reverse=True))
+
+    def test_customers_only_see_their_orders(self):
+        ids = self.list_orders(self.mary)
+        self.assertEqual(set(ids), set(Order.objects.filter(customer__user=self.mary).values_list('id', flat=True)))
+
+
+class OutboxTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        collection = Collection.objects.create(title='Beverages')
+        cls.coffee = Product.objects.create(title='Coffee', price=10, inventory=5, collection=collection)
+        cls.user = User.objects.create_user(username='john', email='john@domain.com')
+
+    def setUp(self):
+        self.received = []
+        order_created.connect(self.receiver)
+        self.addCleanup(order_created.disconnect, self.receiver)
+
+    def receiver(self, sender, order_id, **kwargs):
+        self.received.append(order_id)
+
+    def checkout(self):
+        cart = Cart.objects.create()
+        CartItem.objects.add_items(cart.id, [(self.coffee.id, 1)])
+        client = APIClient()
+        client.force_authenticate(self.user)
+        return client.post('/store/orders/', {'cart_id': cart.id}).data['id']
+
+    def test_the_checkout_saves_the_event_and_the_worker_sends_it(self):
+        order_id = self.checkout()
+        # nothing is sent inside the request
+        self.assertEqual(self.received, [])
+
+        self.assertEqual(outbox.process_batch(), 1)
+        self.assertEqual(self.received, [order_id])
+        self.assertEqual(OutboxEvent.objects.get().status, OutboxEvent.STATUS_DONE)
+        self.assertEqual(outbox.process_batch(), 0)
+
+    def test_failed_events_are_retried_with_backoff(self):
+        def broken(sender, **kwargs):
+            raise ConnectionError('ERP is down')
+        order_created.connect(broken)
+        self.addCleanup(order_created.disconnect, broken)
+
+        self.checkout()
+        outbox.process_batch(max_attempts=2)
+        event = OutboxEvent.objects.get()
+        self.assertEqual((event.status, event.attempts), (OutboxEvent.STATUS_PENDING, 1))
+        self.assertIn('ERP is down', event.last_error)
+        # not available again until the backoff is over
+        self.assertEqual(outbox.process_batch(), 0)
+
+        OutboxEvent.objects.update(available_at=timezone.now())
+        outbox.process_batch(max_attempts=2)
+        self.assertEqual(OutboxEvent.objects.get().status, OutboxEvent.STATUS_FAILED)
+
+    def test_events_are_done_one_by_one_and_the_lease_stops_the_batch(self):
+        self.checkout()
+        self.checkout()
+
+        # the lease is over when the second event comes
+        now = timezone.now()
+        with mock.patch.object(outbox, 'timezone') as clock:
+            clock.now.side_effect = [now, now, now + timedelta(seconds=outbox.LEASE_SECONDS + 1)]
+            self.assertEqual(outbox.process_batch(), 1)
+        first, second = OutboxEvent.objects.order_by('id')
+        self.assertEqual(first.status, OutboxEvent.STATUS_DONE)
+        self.assertEqual(second.status, OutboxEvent.STATUS_PENDING)
+        self.assertEqual(len(self.received), 1)
+
+    def test_worker_survives_database_errors(self):
+        with mock.patch.object(outbox, 'process_batch', side_effect=[OperationalError('gone away'), 1, 0]), \
+                mock.patch('store.management.commands.process_outbox.time.sleep') as sleep, \
+                self.assertLogs('store.management.commands.process_outbox', 'ERROR'):
+            call_command('process_outbox', '--once', stdout=io.StringIO())
+        sleep.assert_called_once_with(1)
+
+
+class SalesRollupTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.beverages = Collection.objects.create(title='Beverages')
+        cls.coffee = Product.objects.create(title='Coffee', price=10, inventory=10, collection=cls.beverages)
+        cls.tea = Product.objects.create(title='Tea', price=5, inventory=10, collection=cls.beverages)
+        cls.customer = User.objects.create_user(username='john', email='john@domain.com').customer
+        cls.staff = User.objects.create_user(username='staff', email='staff@domain.com', is_staff=True)
+
+    def setUp(self):
+        clear_cache()
+
+    def place_order(self, lines):
+        order = Order.objects.create(customer=self.customer)
+        OrderItem.objects.bulk_create([
+            OrderItem(order=order, product=product, quantity=quantity, unit_price=product.price)
+            for product, quantity in lines])
+
+    def reports(self, name):
+        client = APIClient()
+        client.force_authenticate(self.staff)
+        return client.get(f'/store/reports/{name}/').data
+
+    def test_refresh_only_adds_new_orders(self):
+        self.place_order([(self.coffee, 1), (self.tea, 2)])
+        self.place_order([(self.coffee, 2)])
+        self.assertEqual(rollups.refresh(batch_size=1, lag_seconds=0), 2)
+        self.assertEqual(rollups.refresh(lag_seconds=0), 0)
+
+        self.place_order([(self.tea, 10)])
+        self.assertEqual(rollups.refresh(lag_seconds=0), 1)
+
+        top = self.reports('top-products')
+        self.assertEqual([(row['title'], row['units'], row['revenue']) for row in top],
+                         [(self.tea.title, 12, 60), (self.coffee.title, 3, 30)])
+        self.assertEqual(DailyProductSales.objects.get(product=self.coffee).orders, 2)
+
+        revenue = self.reports('revenue')
+        self.assertEqual(len(revenue), 1)
+        self.assertEqual(revenue[0]['revenue'], 90)
+        self.assertEqual(self.reports('top-collections')[0]['units'], 15)
+
+    def test_recent_orders_wait_for_the_lag(self):
+        self.place_order([(self.coffee, 1)])
+        self.assertEqual(rollups.refresh(lag_seconds=60), 0)
+        self.assertEqual(rollups.rebuild(lag_seconds=0), 1)
+
+    def test_reports_with_the_same_arguments_dont_share_a_cache_key(self):
+        self.place_order([(self.coffee, 1)])
+        rollups.refresh(lag_seconds=0)
+        with self.captureOnCommitCallbacks(execute=True):
+            rollups.bump_rollup_versions()
+
+        products = rollups.top_products(30, 10)
+        collections = rollups.top_collections(30, 10)
+        self.assertEqual([row['product_id'] for row in products], [self.coffee.id])
+        self.assertEqual([row['collection_id'] for row in collections], [self.beverages.id])
+
+
+class CustomerSummaryTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        collection = Collection.objects.create(title='Beverages')
+        cls.coffee = Product.objects.create(title='Coffee', price=10, inventory=100, collection=collection)
+        cls.user = User.objects.create_user(username='john', email='john@domain.com')
+        cls.staff = User.objects.create_user(username='staff', email='staff@domain.com', is_staff=True)
+
+    def checkout(self, quantity):
+        cart = Cart.objects.create()
+        CartItem.objects.add_items(cart.id, [(self.coffee.id, quantity)])
+        client = APIClient()
+        client.force_authenticate(self.user)
+        return client.post('/store/orders/', {'cart_id': cart.id}).data['id']
+
+    def me(self):
+        client = APIClient()
+        client.force_authenticate(self.user)
+        return client.get('/store/customers/me/').data
+
+    def test_summary_follows_checkouts_and_failed_payments(self):
+        self.assertEqual(self.me()['orders_count'], 0)
+        self.checkout(2)
+        order_id = self.checkout(3)
+
+        me = self.me()
+        self.assertEqual((me['orders_count'], me['lifetime_spend']), (2, 50))
+
+        client = APIClient()
+        client.force_authenticate(self.staff)
+        client.patch(f'/store/orders/{order_id}/', {'payment_status': Order.PAYMENT_STATUS_FAILED})
+        self.assertEqual(self.me()['lifetime_spend'], 20)
+
+        # the full recompute gets the same numbers
+        before = CustomerSummary.objects.values().get()
+        self.assertEqual(summaries.recompute(chunk_size=1), 2)
+        self.assertEqual(CustomerSummary.objects.values().get(), before)
+
+    def test_saves_outside_the_api_and_deletes(self):
+        first_id = self.checkout(2)
+        second_id = self.checkout(3)
+
+        # e.g. the admin or the shell
+        order = Order.objects.get(id=second_id)
+        order.payment_status = Order.PAYMENT_STATUS_FAILED
+        order.save()
+        order.save()
+        self.assertEqual(self.me()['lifetime_spend'], 20)
+
+        # an order can only be deleted without its items
+        first = Order.objects.get(id=first_id)
+        OrderItem.objects.filter(order=order).delete()
+        order.delete()
+        me = self.me()
+        self.assertEqual((me['orders_count'], me['lifetime_spend']), (1, 20))
+        self.assertEqual(CustomerSummary.objects.get().last_order_at, first.placed_at)
+
+    def test_recompute_updates_the_summaries_in_place(self):
+        self.checkout(2)
+        customer = Customer.objects.get(user=self.user)
+        other = Customer.objects.get(user=self.staff)
+        # a summary that is wrong and one of a customer without orders
+        CustomerSummary.objects.filter(customer=customer).update(orders_count=5)
+        CustomerSummary.objects.create(customer=other, orders_count=1, lifetime_spend=10)
+
+        summaries.recompute()
+        self.assertEqual(
+            list(CustomerSummary.objects.order_by('customer_id').values_list('orders_count', 'lifetime_spend')),
+            [(1, 20), (0, 0)])
+
+
+class AdminChangelistTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        collection = Collection.objects.create(title='Beverages')
+        cls.products = [Product.objects.create(title=f'Product {i}', price=10, inventory=10, collection=collection)
+                        for i in range(5)]
+        cls.admin = User.objects.create_superuser(username='admin', email='admin@domain.com', password='x')
+        for i in range(20):
+            User.objects.create_user(username=f'user{i}', email=f'user{i}@domain.com')
+
+    def setUp(self):
+        self.client.force_login(self.admin)
+
+    def test_changelists_dont_run_a_query_per_row(self):
+        for url in ['/admin/store/customer/', '/admin/store/product/', '/admin/store/collection/']:
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            # session, user, count, the page and a few queries of the admin itself. Not one per row
+            self.assertLess(len(queries), 10, url)
+
+    def test_price_edits_are_saved_in_bulk(self):
+        data = {'form-TOTAL_FORMS': 5, 'form-INITIAL_FORMS': 5, '_save': 'Save'}
+        for i, product in enumerate(self.products):
+            data[f'form-{i}-id'] = product.id
+            data[f'form-{i}-price'] = 20 + i
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post('/admin/store/product/', data)
+        self.assertEqual(response.status_code, 302)
+
+        self.assertEqual(sorted(Product.objects.values_list('price', flat=True)), [20, 21, 22, 23, 24])
+        self.assertEqual(LogEntry.objects.filter(action_flag=CHANGE).count(), 5)
+        updates = [query for query in queries if query['sql'].startswith('UPDATE "store_product"')]
+        self.assertEqual(len(updates), 1)
+
+
+class TokenClaimsTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        collection = Collection.objects.create(title='Beverages')
+        cls.coffee = Product.objects.create(title='Coffee', price=10, inventory=5, collection=collection)
+        cls.user = User.objects.create_user(username='john', email='john@domain.com', password='secret')
+        cls.customer = Customer.objects.get(user=cls.user)
+        order = Order.objects.create(customer=cls.customer)
+        OrderItem.objects.create(order=order, product=cls.coffee, quantity=1, unit_price=10)
+
+    def login(self):
+        client = APIClient()
+        response = client.post('/auth/jwt/create/', {'username': 'john', 'password': 'secret'})
+        self.assertEqual(response.status_code, 200)
+        client.credentials(HTTP_AUTHORIZATION=f'JWT {response.data["access"]}')
+        return client
+
+    def test_token_carries_customer_id_and_is_staff(self):
+        client = APIClient()
+        response = client.post('/auth/jwt/create/', {'username': 'john', 'password': 'secret'})
+        token = AccessToken(response.data['access'])
+        self.assertEqual(token['customer_id'], self.customer.id)
+        self.assertFalse(token['is_staff'])
+
+    def test_order_history_does_not_load_the_user_or_the_customer(self):
+        client = self.login()
+        with CaptureQueriesContext(connection) as queries:
+            response = client.get('/store/orders/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data['results']), 1)
+        # the orders, and their items with the products
+        self.assertEqual(len(queries), 2)
+        self.assertNotIn('core_user', ' '.join(query['sql'] for query in queries))
+
+    def test_me_is_one_query(self):
+        client = self.login()
+        with CaptureQueriesContext(connection) as queries:
+            response = client.get('/store/customers/me/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['id'], self.customer.id)
+        self.assertEqual(len(queries), 1)
+
+    def test_writes_still_load_the_user(self):
+        client = self.login()
+        self.user.is_active = False
+        self.user.save()
+        response = client.put('/store/customers/me/', {'phone': '555', 'membership': 'B'}, format='json')
+        self.assertEqual(response.status_code, 401)
+
+    def test_checkout_uses_the_customer_from_the_token(self):
+        client = self.login()
+        cart = Cart.objects.create()
+        CartItem.objects.add_items(cart.id, [(self.coffee.id, 1)])
+        response = client.post('/store/orders/', {'cart_id': str(cart.id)})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(Order.objects.get(pk=response.data['id']).customer_id, self.customer.id)
+
+    def test_staff_rights_are_checked_on_the_user(self):
+        staff = User.objects.create_user(username='staff', email='staff@domain.com', password='secret', is_staff=True)
+        client = APIClient()
+        response = client.post('/auth/jwt/create/', {'username': 'staff', 'password': 'secret'})
+        client.credentials(HTTP_AUTHORIZATION=f'JWT {response.data["access"]}')
+        # staff see every order
+        self.assertEqual(len(client.get('/store/orders/').data['results']), 1)
+
+        # the token still says is_staff
+        staff.is_staff = False
+        staff.save()
+        self.assertEqual(len(client.get('/store/orders/').data['results']), 0)
+
+    def test_old_tokens_without_the_claim_still_work(self):
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=f'JWT {RefreshToken.for_user(self.user).access_token}')
+        response = client.get('/store/orders/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data['results']), 1)
+
+
+class GenericRelationBulkTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        collection = Collection.objects.create(title='Beverages')
+        cls.products = [Product.objects.create(title=f'Product {i}', price=1, inventory=10, collection=collection)
+                        for i in range(8)]
+        cls.hot, cls.new = Tag.objects.create(label='hot'), Tag.objects.create(label='new')
+        product_type = ContentType.objects.get_for_model(Product)
+        for product in cls.products[:5]:
+            TaggedItem.objects.create(tag=cls.hot, content_type=product_type, object_id=product.id)
+        TaggedItem.objects.create(tag=cls.new, content_type=product_type, object_id=cls.products[0].id)
+        cls.user = User.objects.create_user(username='john', email='john@domain.com')
+        LikedItem.objects.create(user=cls.user, content_type=product_type, object_id=cls.products[1].id)
+
+    def setUp(self):
+        clear_cache()
+
+    def test_tags_of_many_objects_in_one_query(self):
+        # the content type is cached after the first lookup
+        ContentType.objects.get_for_model(Product)
+        for objects in [Product.objects.all(), self.products, [product.id for product in self.products]]:
+            with self.assertNumQueries(1):
+                tags = TaggedItem.objects.get_for_objects(Product, objects)
+            self.assertEqual({tag.label for tag in tags[self.products[0].id]}, {'hot', 'new'})
+            self.assertEqual(tags[self.products[7].id], [])
+
+    def test_likes_of_many_objects_in_one_query(self):
+        ContentType.objects.get_for_model(Product)
+        with self.assertNumQueries(1):
+            likes = LikedItem.objects.get_for_objects(Product, self.products)
+        self.assertEqual([like.user_id for like in likes[self.products[1].id]], [self.user.id])
+        self.assertEqual(likes[self.products[0].id], [])
+
+    def test_product_list_embeds_tags_with_a_fixed_number_of_queries(self):
+        client = APIClient()
+        with CaptureQueriesContext(connection) as queries:
+            response = client.get('/store/products/?expand=tags&ordering=title')
+        self.assertEqual(response.status_code, 200)
+        # validators, count, page and the tags of the whole page
+        self.assertEqual(len([q for q in queries if 'django_content_type' not in q['sql']]), 4)
+        results = {product['title']: product for product in response.data['results']}
+        self.assertEqual(sorted(tag['label'] for tag in results['Product 0']['tags']), ['hot', 'new'])
+        self.assertEqual(results['Product 7']['tags'], [])
+
+        # without expand there are no tags
+        response = client.get('/store/products/')
+        self.assertNotIn('tags', response.data['results'][0])
+
+    def test_tagging_invalidates_the_cached_list(self):
+        client = APIClient()
+        response = client.get('/store/products/?expand=tags&ordering=title')
+        etag = response['ETag']
+        with self.captureOnCommitCallbacks(execute=True):
+            TaggedItem.objects.create(
+                tag=self.new, content_type=ContentType.objects.get_for_model(Product), object_id=self.products[7].id)
+        response = client.get('/store/products/?expand=tags&ordering=title', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        results = {product['title']: product for product in response.data['results']}
+        self.assertEqual([tag['label'] for tag in results['Product 7']['tags']], ['new'])
+
+
+class AsyncEndpointTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        collection = Collection.objects.create(title='Beverages')
+        cls.products = [Product.objects.create(title=f'Product {i:02}', price=Decimal('1.5') * (i + 1), inventory=10,
+                                               collection=collection) for i in range(15)]
+        cls.cart = Cart.objects.create()
+        CartItem.objects.add_items(cls.cart.id, [(product.id, 2) for product in cls.products[:3]])
+        cls.user = User.objects.create_user(username='john', email='john@domain.com')
+        cls.token = str(RefreshToken.for_user(cls.user).access_token)
+
+    def setUp(self):
+        clear_cache()
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f'JWT {self.token}')
+
+    def assertSameJson(self, sync_url, async_url):
+        expected = self.client.get(sync_url)
+        response = self.client.get(async_url)
+        self.assertEqual(response.status_code, expected.status_code)
+        # the pagination links point to the async urls
+        content = response.content.replace(b'/store/async/', b'/store/')
+        self.assertEqual(json.loads(content), json.loads(expected.content))
+
+    def test_same_json_as_the_sync_endpoints(self):
+        self.assertSameJson('/store/products/?ordering=-price', '/store/async/products/?ordering=-price')
+        self.assertSameJson('/store/products/?ordering=title&page=2', '/store/async/products/?ordering=title&page=2')
+        self.assertSameJson(f'/store/products/{self.products[0].id}/',
+                            f'/store/async/products/{self.products[0].id}/')
+        self.assertSameJson('/store/collections/', '/store/async/collections/')
+        self.assertSameJson(f'/store/carts/{self.cart.id}/', f'/store/async/carts/{self.cart.id}/')
+
+    def test_same_default_ordering_filters_and_search(self):
+        # the last id, but the first title
+        Product.objects.create(title='Almonds', price=3, inventory=10, collection=self.products[0].collection)
+        for query in ['', '?page=2', '?search=product 1', '?search=almonds&ordering=-price',
+                      '?title__icontains=0&ordering=price,title', '?ordering=unknown']:
+            self.assertSameJson(f'/store/products/{query}', f'/store/async/products/{query}')
+
+    def test_errors(self):
+        self.assertEqual(self.client.get('/store/async/products/?page=5').status_code, 404)
+        self.assertEqual(self.client.get('/store/async/products/?pagination=cursor').status_code, 400)
+        self.assertEqual(self.client.get('/store/async/products/?expand=tags').status_code, 400)
+        self.assertEqual(self.client.get('/store/async/collections/999/').status_code, 404)
+        self.assertEqual(self.client.post('/store/async/collections/').status_code, 405)
+        self.client.credentials()
+        self.assertEqual(self.client.get(f'/store/async/carts/{self.cart.id}/').status_code, 401)
+
+    def test_cart_is_two_queries(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(f'/store/async/carts/{self.cart.id}/')
+        self.assertEqual(len(queries), 2)
+
+
+class TieredCacheTests(TestCase):
+    def setUp(self):
+        clear_cache()
+        self.calls = 0
+
+    def compute(self):
+        self.calls += 1
+        return self.calls
+
+    def test_local_tier_then_shared_tier(self):
+        self.assertEqual(get_or_compute('k', self.compute, 60, prefix='test'), (1, 'miss'))
+        self.assertEqual(get_or_compute('k', self.compute, 60, prefix='test'), (1, 'local'))
+        # another process only finds it in the shared cache
+        store_cache.local_cache.clear()
+        self.assertEqual(get_or_compute('k', self.compute, 60, prefix='test'), (1, 'shared'))
+        self.assertEqual(get_tier_stats()['test'], {'miss': 1, 'local': 1, 'shared': 1, 'hit_rate': 0.667})
+
+    def test_ttl_has_jitter(self):
+        expirations = set()
+        for i in range(20):
+            get_or_compute(f'k{i}', self.compute, 100)
+            expirations.add(round(store_cache.local_cache.get(f'k{i}').fresh_until - time.time()))
+        self.assertGreater(len(expirations), 1)
+        self.assertTrue(all(89 <= expiration <= 110 for expiration in expirations))
+
+    def test_cold_key_is_computed_once_per_process(self):
+        def slow():
+            time.sleep(0.2)
+            return self.compute()
+
+        sources = []
+        threads = [threading.Thread(target=lambda: sources.append(get_or_compute('cold', slow, 60)))
+                   for _ in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.calls, 1)
+        self.assertEqual({value for value, source in sources}, {1})
+        self.assertEqual(sorted(source for value, source in sources), ['miss'] + ['wait'] * 9)
+
+    def test_stale_while_revalidate(self):
+        get_or_compute('k', self.compute, 0.01, stale_ttl=60)
+        time.sleep(0.05)
+        # the old value comes back immediately and a thread computes the new one
+        self.assertEqual(get_or_compute('k', self.compute, 60, stale_ttl=60), (1, 'stale'))
+        for _ in range(100):
+            if store_cache.local_cache.get('k').value == 2:
+                break
+            time.sleep(0.01)
+        self.assertEqual(get_or_compute('k', self.compute, 60, stale_ttl=60), (2, 'local'))
+
+    def test_decorators_are_invalidated_by_the_models(self):
+        collection = Collection.objects.create(title='Beverages')
+
+        @cached_queryset('collections', 60, models=[Collection])
+        def titles():
+            return Collection.objects.values_list('title', flat=True)
+
+        @cached_serializer('collections', 60, models=[Collection])
+        def serialized(pk):
+            return CollectionSerializer(Collection.objects.annotate(products_count=Count('products')).get(pk=pk))
+
+        self.assertEqual(titles(), ['Beverages'])
+        self.assertEqual(serialized(collection.id)['title'], 'Beverages')
+        with self.assertNumQueries(0):
+            self.assertEqual(titles(), ['Beverages'])
+            self.assertEqual(serialized(collection.id)['title'], 'Beverages')
+
+        # the post_save signal bumps the version of Collection when the transaction commits
+        collection.title = 'Drinks'
+        with self.captureOnCommitCallbacks(execute=True):
+            collection.save()
+        self.assertEqual(titles(), ['Drinks'])
+        self.assertEqual(serialized(collection.id)['title'], 'Drinks')
+
+
+# the server inside the command is reached at 127.0.0.1, like LiveServerTestCase does
+@override_settings(ALLOWED_HOSTS=['127.0.0.1'])
+class BenchmarkTests(TransactionTestCase):
+    def setUp(self):
+        clear_cache()
+
+    def test_runs_the_scenarios_and_cleans_up(self):
+        output = os.path.join(tempfile.mkdtemp(), 'results.json')
+        call_command('benchmark', scenarios='product_detail,cart_create,cart_add,checkout', concurrency='1', requests=4,
+                     warmup=1, products=3, output=output, allow_writes=True, stdout=io.StringIO())
+
+        with open(output) as f:
+            results = json.load(f)['results']
+        self.assertEqual(set(results), {'product_detail', 'cart_create', 'cart_add', 'checkout'})
+        self.assertEqual(results['product_detail']['1']['ok'], 4)
+        self.assertEqual(results['cart_add']['1']['ok'], 4)
+        self.assertEqual(results['checkout']['1']['ok'], 4)
+        # the data of the benchmark is gone
+        self.assertFalse(Product.objects.exists())
+        self.assertFalse(Order.objects.exists())
+        self.assertFalse(Cart.objects.exists())
+        self.assertFalse(User.objects.exists())
+
+    def test_regression_check(self):
+        baseline = {'product_list': {'8': {'rps': 100, 'p95': 50, 'errors': 0}}}
+        self.assertEqual(compare_benchmarks(baseline, {'product_list': {'8': {'rps': 90, 'p95': 55, 'errors': 0}}}, 0.2),
+                         [])
+        self.assertEqual(len(compare_benchmarks(
+            baseline, {'product_list': {'8': {'rps': 70, 'p95': 80, 'errors': 1}}}, 0.2)), 3)
+        # scenarios that are not in the baseline can't regress
+        self.assertEqual(compare_benchmarks(baseline, {'checkout': {'8': {'rps': 1, 'p95': 900, 'errors': 9}}}, 0.2), [])
+
+    def test_unknown_scenario(self):
+        with self.assertRaises(CommandError):
+            call_command('benchmark', scenarios='nope', stdout=io.StringIO())
+
+    def test_refuses_to_write_without_debug(self):
+        with self.assertRaisesMessage(CommandError, '--allow-writes'):
+            call_command('benchmark', stdout=io.StringIO())
+        self.assertFalse(Product.objects.exists())
+
+
+class GenerateDatasetTests(TestCase):
+    COUNTS = {'promotions': 2, 'collections': 3, 'tags': 5, 'products': 20, 'customers': 15, 'orders': 40,
+              'carts': 5, 'reviews': 10, 'likes': 30}
+
+    def generate(self, seed=1):
+        first_product = (Product.objects.order_by('-id').values_list('id', flat=True).first() or 0) + 1
+        first_order = (Order.objects.order_by('-id').values_list('id', flat=True).first() or 0) + 1
+        call_command('generate_dataset', seed=seed, batch_size=7, stdout=io.StringIO(),
+                     **{name: count for name, count in self.COUNTS.items()})
+        # the same data whatever the ids: the products of every order, relative to the first new product
+        return [(item.order_id - first_order, item.product_id - first_product, item.quantity)
+                for item in OrderItem.objects.filter(order_id__gte=first_order).order_by('order_id', 'product_id')]
+
+    def test_generates_every_table(self):
+        self.generate()
+        self.assertEqual(Product.objects.count(), 20)
+        self.assertEqual(Order.objects.count(), 40)
+        self.assertEqual(Cart.objects.count(), 5)
+        # the customers were inserted with their users, not by the post_save signal
+        self.assertEqual(User.objects.count(), 15)
+        self.assertEqual(Customer.objects.count(), 15)
+        self.assertTrue(OrderItem.objects.exists())
+        self.assertTrue(TaggedItem.objects.exists())
+        self.assertTrue(LikedItem.objects.exists())
+
+        # the derived tables were rebuilt
+        self.assertEqual(CustomerSummary.objects.aggregate(orders=Sum('orders_count'))['orders'], 40)
+        self.assertTrue(DailyProductSales.objects.exists())
+
+        # the orders go back in time and their ids grow with placed_at
+        dates = list(Order.objects.order_by('id').values_list('placed_at', flat=True))
+        self.assertEqual(dates, sorted(dates))
+        self.assertGreater(dates[-1] - dates[0], timedelta(days=30))
+
+    def test_inserts_of_the_site_get_ids_after_the_reserved_ones(self):
+        collection = Collection.objects.create(title='Beverages')
+        first_id = reserve_ids(Product, 10)
+        product = Product.objects.create(title='Coffee', price=1, inventory=1, collection=collection)
+        self.assertEqual(product.id, first_id + 10)
+        self.assertEqual(reserve_ids(Product, 5), product.id + 1)
+
+    def test_the_same_seed_gives_the_same_data(self):
+        first = self.generate(seed=7)
+        self.assertEqual(self.generate(seed=7), first)
+        self.assertNotEqual(self.generate(seed=8), first)
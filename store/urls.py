@@ -1,7 +1,7 @@
 from django.urls import path, include
 from rest_framework.routers import SimpleRouter, DefaultRouter
 from rest_framework_nested import routers
-from . import views
+from . import async_views, views
 
 # django looks for the name urlpatterns
 
@@ -13,6 +13,7 @@ router.register('customers', views.CustomerViewSet)
 # generated based on the queryset attribute of the viewset, if it has one. Note that if the viewset does not include a
 # queryset attribute then you must set basename when registering the viewset.
 router.register('orders', views.OrderViewSet, basename='orders')
+router.register('reports', views.SalesReportViewSet, basename='reports')
 
 # because we have a nested route for cart/eqwewqeqwe/items, we need a nested router
 carts_router = routers.NestedDefaultRouter(router, 'carts', lookup='cart')
@@ -25,6 +26,13 @@ urlpatterns = [
     path('products/<int:pk>/', views.ProductDetail.as_view()),
     path('collections/', views.CollectionList.as_view()),
     path('collections/<int:pk>/', views.CollectionDetail.as_view()),
+    path('cache-stats/', views.CacheStatsView.as_view()),
+    # async versions of the read endpoints, serve them with an async worker (see async_views.py)
+    path('async/products/', async_views.product_list),
+    path('async/products/<int:pk>/', async_views.product_detail),
+    path('async/collections/', async_views.collection_list),
+    path('async/collections/<int:pk>/', async_views.collection_detail),
+    path('async/carts/<uuid:pk>/', async_views.cart_detail),
     path('', include(router.urls)),
     path('', include(carts_router.urls))
 ]
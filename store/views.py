@@ -1,10 +1,12 @@
 from django.shortcuts import render, get_object_or_404
 from django.http import HttpResponse
-from django.db.models import Count
+from django.db.models import Count, DecimalField, ExpressionWrapper, F, Prefetch, Sum
+from django.db.models.functions import Coalesce
 from django_filters.rest_framework import DjangoFilterBackend
 from rest_framework.decorators import action
 from rest_framework.generics import ListCreateAPIView, RetrieveUpdateDestroyAPIView
 from rest_framework.decorators import api_view
+from rest_framework.exceptions import ValidationError
 from rest_framework.response import Response
 from rest_framework.filters import OrderingFilter
 from rest_framework import status, viewsets
@@ -13,12 +15,17 @@ from rest_framework.permissions import IsAuthenticated, AllowAny, IsAdminUser
 # this is used to create your own custom viewset
 from rest_framework.mixins import CreateModelMixin, RetrieveModelMixin, DestroyModelMixin, UpdateModelMixin
 from rest_framework.views import APIView
+from core.authentication import ReadOnlyClaimsAuthentication
+from tags.models import TaggedItem
 
 from .permissions import IsAdminOrReadOnly
-from .models import Product, Collection, Review, Cart, CartItem, Customer, Order, ProductImage
+from .models import Product, Collection, Review, Cart, CartItem, Customer, Order, OrderItem, ProductImage
 from .serializers import CollectionSerializer, OrderSerializer, ProductSerializer, ReviewSerializer, CartSerializer, CartItemSerializer, AddCartItemSerializer, UpdateCartItemSerializer, CustomerSerializer, OrderSerializer, CreateOrderSerializer, UpdateOrderSerializer, ProductImageSerializer
 from .filters import ProductFilter
-from .pagination import DefaultPagination
+from . import rollups
+from .pagination import DefaultPagination, KeysetPagination, OrderPagination
+from .cache import CachedResponseMixin, get_stats, get_tier_stats, get_versions
+from .conditional import ConditionalGetMixin, get_list_validators, make_etag
 
 # Create your views here.
 
@@ -27,8 +34,12 @@ from .pagination import DefaultPagination
 # When you you this decorator, it converts the django request object to a rest framework request object.
 
 
-class ProductView(ListCreateAPIView):
+class ProductView(CachedResponseMixin, ConditionalGetMixin, ListCreateAPIView):
     permission_classes = [IsAdminOrReadOnly]
+    # GET requests read from a replica (see core/dbrouter.py)
+    read_from_replica = True
+    # GET responses are cached until a product (or a tag, for ?expand=tags) changes (see cache.py)
+    cache_models = [Product, TaggedItem]
     # if you don't have business logic to create queryset like depending on the use role, you can just use the field:
     #queryset = Product.objects.select_related('collection').all()
     #serializer_class = ProductSerializer
@@ -39,14 +50,47 @@ class ProductView(ListCreateAPIView):
     #filterset_fields = ['title']
     # YOU CAN ONLY IMPORT SEARCHFILTER which similar to ProductFilter
     filterset_class = ProductFilter
+    ordering_fields = ['title', 'price', 'last_update']
+    # the parameters of the filters, the ordering, both paginations and ?expand=, the rest don't change the response
+    cache_query_params = ['search', 'title__icontains', 'ordering', 'page', 'pagination', 'cursor', 'count', 'expand']
+
     # If you want pagination in ALL your views, you can remove this line and configure the pagination in the settings.py file.
     # IN the DefaultPagination is where you configure page size and the number of pages to be displayed.
-    pagination_class = DefaultPagination
-    ordering_fields = ['price', 'last_update']
+    # ?pagination=cursor switches to keyset pagination. Page numbers need an OFFSET scan that gets slower on deep pages,
+    # cursors don't. The next/previous links keep the parameter so the client stays in cursor mode
+    @property
+    def pagination_class(self):
+        if self.request.query_params.get('pagination') == 'cursor':
+            return KeysetPagination
+        return DefaultPagination
 
     # override the get_queryset method to return a queryset of all products
     def get_queryset(self):
-        return Product.objects.select_related('collection').all()
+        # the model field is called last_udpate (typo in the model), we expose it to the ordering filter as last_update
+        return Product.objects.select_related('collection') \
+            .annotate(last_update=F('last_udpate')) \
+            .all()
+
+    # Answer 304 Not Modified when the page didn't change (see conditional.py). It runs the same filters as the list
+    def get_validators(self, request, *args, **kwargs):
+        etag, last_modified = get_list_validators(
+            self.filter_queryset(self.get_queryset()), request, self.cache_query_params)
+        # tagging a product doesn't touch its last_udpate, the tags version goes into the ETag instead
+        if self.expand_tags():
+            etag = make_etag(etag, *get_versions([TaggedItem]))
+        return etag, last_modified
+
+    # ?expand=tags embeds the tags of every product. They are loaded for the whole page in one query
+    def expand_tags(self):
+        return 'tags' in self.request.query_params.get('expand', '').split(',')
+
+    def get_serializer(self, *args, **kwargs):
+        if kwargs.get('many') and self.expand_tags():
+            kwargs['context'] = {
+                **self.get_serializer_context(),
+                'tags': TaggedItem.objects.get_for_objects(Product, args[0]),
+            }
+        return super().get_serializer(*args, **kwargs)
 
     # override the get_serializer_class method to return a serializer class
     # You use this method when you have business logic that needs to be executed before the serializer is created.
@@ -76,9 +120,19 @@ class ProductView(ListCreateAPIView):
         # return Response(serializer.data, status=status.HTTP_201_CREATED)
 
 
-class ProductDetail(RetrieveUpdateDestroyAPIView):
+class ProductDetail(CachedResponseMixin, ConditionalGetMixin, RetrieveUpdateDestroyAPIView):
     queryset = Product.objects.all()
     serializer_class = ProductSerializer
+    cache_models = [Product]
+
+    def get_validators(self, request, *args, **kwargs):
+        last_update = Product.objects.filter(pk=kwargs['pk']) \
+            .values_list('last_udpate', flat=True) \
+            .first()
+        # the product doesn't exist, let the normal get() return the 404
+        if last_update is None:
+            return None, None
+        return make_etag('product', kwargs['pk'], last_update.isoformat()), last_update
 
     # We don't need to override this method because we are using the default implementation
     """ def get(self, request, id):
@@ -110,11 +164,14 @@ class ProductDetail(RetrieveUpdateDestroyAPIView):
 # This is where you see the power of viewset. Do you see how you are repeating serializer, queryset and permissions in CollectionDetail
 
 
-class CollectionList(ListCreateAPIView):
+class CollectionList(CachedResponseMixin, ListCreateAPIView):
     queryset = Collection.objects.annotate(
         products_count=Count('products')).all()
     serializer_class = CollectionSerializer
     permission_classes = [IsAdminOrReadOnly]
+    read_from_replica = True
+    # products_count changes when a product is added or removed, so products invalidate collections too
+    cache_models = [Collection, Product]
 
 
 """ @api_view(['GET', 'POST'])
@@ -132,11 +189,12 @@ def collection_list(request):
         return Response(serializer.data, status=status.HTTP_201_CREATED) """
 
 
-class CollectionDetail(RetrieveUpdateDestroyAPIView):
+class CollectionDetail(CachedResponseMixin, RetrieveUpdateDestroyAPIView):
     queryset = Collection.objects.annotate(
         products_count=Count('products')).all()
     serializer_class = CollectionSerializer
     permission_classes = [IsAdminOrReadOnly]
+    cache_models = [Collection, Product]
 
     def delete(self, request, pk):
         collection = get_object_or_404(Collection, pk=pk)
@@ -175,6 +233,8 @@ class ReviewViewSet(viewsets.ModelViewSet):
     # Since we need access to the product id in the url, we need to override the get_queryset method
     #queryset = Review.objects.all()
     serializer_class = ReviewSerializer
+    # GET requests read from a replica (see core/dbrouter.py)
+    read_from_replica = True
 
     def get_queryset(self):
         return Review.objects.filter(product_id=self.kwargs['pk'])
@@ -183,12 +243,31 @@ class ReviewViewSet(viewsets.ModelViewSet):
 # we DO NOT inherit from ModelViewSet because that class provides list, retrieve, update, and destroy methods,
 # and for Cart we don't have a list (GET request). We only support create, getting a cart, and deleting a cart
 # BECAUSE I ADDED THE RETRIEVEMODELMIXIN I AM NOW ABLE TO FETCH CARTS BY ID!!!!
+def cart_item_total_price(prefix=''):
+    # price * quantity calculated by the database. We need the ExpressionWrapper because Django doesn't know
+    # what type you get when you multiply a decimal by an integer
+    return ExpressionWrapper(
+        F(f'{prefix}product__price') * F(f'{prefix}quantity'),
+        output_field=DecimalField(max_digits=12, decimal_places=2))
+
+
 class CartViewSet(CreateModelMixin,  # just by adding this mixing, I can create a cart. LOTS OF DJANGO MAGIC
                   RetrieveModelMixin,  # just by adding this mixin, I can fetch by uuid
                   DestroyModelMixin,  # just by adding this mixin, now I can delete carts
                   viewsets.GenericViewSet):
     # prefetch_related is EXTREMELY IMPORTANT to avoid running multiple queries behind the scenes
-    queryset = Cart.objects.prefetch_related('items__product').all()
+    # The totals are calculated by the database (SUM and price * quantity), the serializers just read them.
+    # This is 2 queries no matter how many items the cart has: the cart with its total, and the items with their products
+    queryset = Cart.objects \
+        .prefetch_related(Prefetch(
+            'items',
+            queryset=CartItem.objects
+            .select_related('product')
+            .annotate(total_price=cart_item_total_price()))) \
+        .annotate(total_price=Coalesce(
+            Sum(cart_item_total_price('items__')),
+            0,
+            output_field=DecimalField(max_digits=12, decimal_places=2)))
     serializer_class = CartSerializer
 
 
@@ -212,6 +291,12 @@ class CartItemViewSet(viewsets.ModelViewSet):
             return UpdateCartItemSerializer
         return CartItemSerializer
 
+    # POST a list of {product_id, quantity} to add many items at once (see AddCartItemListSerializer)
+    def get_serializer(self, *args, **kwargs):
+        if isinstance(kwargs.get('data'), list):
+            kwargs['many'] = True
+        return super().get_serializer(*args, **kwargs)
+
     # we do this so that we can have access to the cart id in the serializer
     # we are reading cart_pk from the url
     def get_serializer_context(self):
@@ -224,7 +309,8 @@ class CartItemViewSet(viewsets.ModelViewSet):
         # without this what django does is one query to get the cartitems, and one query per cartitem to get the product which is TERRIBLE
         return CartItem.objects \
             .filter(cart_id=self.kwargs['cart_pk']) \
-            .select_related('product')
+            .select_related('product') \
+            .annotate(total_price=cart_item_total_price())
 
 # We DO NOT want to inherit from ModelViewSet because there are some operations we don't want to support, like deleting a customer
 # so I need to create a custom viewset by adding different mixins
@@ -234,11 +320,23 @@ class CartItemViewSet(viewsets.ModelViewSet):
 # Because you are extending ModelViewSet, you can do all operations. However, we are going to restrict access based on user
 
 
+def get_customer_id(request):
+    """
+    The customer_id claim of the token (see core/serializers.py). Returns None for tokens issued before we added it
+    (and for the test client's force_authenticate), the caller goes through the user_id like before.
+    """
+    if request.auth is None:
+        return None
+    return request.auth.get('customer_id')
+
+
 class CustomerViewSet(viewsets.ModelViewSet):
-    queryset = Customer.objects.all()
+    queryset = Customer.objects.select_related('summary').all()
     serializer_class = CustomerSerializer
     # What we are doing here is: Only admins can access this viewset. However, we override the me function to allow authenticated users (non-admins)
     permission_classes = [IsAdminUser]
+    # GET /customers/me doesn't need the user row, the token has the customer_id
+    authentication_classes = [ReadOnlyClaimsAuthentication]
 
     # If you want to specify permisions base on request method, you need to override get_permissions
     # Notice how in here we return actual objects, not classes
@@ -254,8 +352,9 @@ class CustomerViewSet(viewsets.ModelViewSet):
         # get_or_create returns a tuple with the customer object and a boolean indicating if the object was created
         # we are unpacking the tuple
         # Because we are using signals, we need to don't need to use get_or_create method anymore
-        customer = Customer.objects.get(
-            user_id=request.user.id)
+        customer_id = get_customer_id(request)
+        customers = Customer.objects.select_related('summary')
+        customer = customers.get(pk=customer_id) if customer_id else customers.get(user_id=request.user.id)
 
         if request.method == 'GET':
             # We can access the user from the request because the authentication middleware found the JWT in the request, fetch the user from the db and attached it to the request
@@ -273,6 +372,10 @@ class OrderViewSet(viewsets.ModelViewSet):
     # if you want to specify which http methods are allowed for this viewset
     # Notice how for this particular method, you have to use lowercase
     http_method_names = ['post', 'get', 'patch', 'delete', 'head', 'options']
+    # newest orders first, paginated with a cursor on placed_at. Staff can have millions of orders
+    pagination_class = OrderPagination
+    # listing orders doesn't load the user or the customer, both come from the token
+    authentication_classes = [ReadOnlyClaimsAuthentication]
 
     # because we are using more than one serializer, we don't hardcode here. we instead override the get_serializer_class method
     #serializer_class = OrderSerializer
@@ -292,7 +395,8 @@ class OrderViewSet(viewsets.ModelViewSet):
     def create(self, request, *args, **kwargs):
         serializer = CreateOrderSerializer(
             data=request.data,
-            context={'user_id': self.request.user.id}
+            context={'user_id': self.request.user.id,
+                     'customer_id': get_customer_id(self.request)}
         )
         serializer.is_valid(raise_exception=True)
         order = serializer.save()
@@ -316,8 +420,21 @@ class OrderViewSet(viewsets.ModelViewSet):
         # Remember that the authentication middleware adds the user to the request object. The user is obtained from the jwt token
         user = self.request.user
 
+        # The total is calculated by the database and the items are loaded with their products in ONE extra query,
+        # so a page of orders is always 2 queries no matter how many orders or items it has
+        queryset = Order.objects \
+            .prefetch_related(Prefetch(
+                'items',
+                queryset=OrderItem.objects.select_related('product'))) \
+            .annotate(total_price=Coalesce(
+                Sum(ExpressionWrapper(
+                    F('items__unit_price') * F('items__quantity'),
+                    output_field=DecimalField(max_digits=12, decimal_places=2))),
+                0,
+                output_field=DecimalField(max_digits=12, decimal_places=2)))
+
         if user.is_staff:
-            return Order.objects.all()
+            return queryset
 
         # The get method expects one record in the database. If we get no record or multiple records, it will throw an exception
         # this is just like JPA's findOne()
@@ -327,11 +444,47 @@ class OrderViewSet(viewsets.ModelViewSet):
 
         # Because we are using signals now, we don't need to create a customer here
         # (customer_id, created) = Customer.objects.only(
-         #   'id').get_or_create(user_id=user.id)
+        #   'id').get_or_create(user_id=user.id)
+
+        # the customer_id comes from the token, so we don't need to fetch the customer or join with it
+        customer_id = get_customer_id(self.request)
+        if customer_id:
+            return queryset.filter(customer_id=customer_id)
+        # we filter through the customer relationship instead of fetching the customer first. That is one query less
+        return queryset.filter(customer__user_id=user.id)
+
 
-        customer_id = Customer.objects.only('id').get(user_id=user.id)
+class SalesReportViewSet(viewsets.ViewSet):
+    """
+    Top sellers and revenue read from the daily rollup tables (see rollups.py), not from the order items.
+    The numbers are as fresh as the last run of the refresh_sales_rollups command.
+    """
+    permission_classes = [IsAdminUser]
+
+    def get_number(self, request, name, default, maximum):
+        try:
+            value = int(request.query_params.get(name, default))
+        except ValueError:
+            raise ValidationError({name: 'A valid integer is required.'})
+        return min(max(value, 1), maximum)
+
+    def get_days(self, request):
+        return self.get_number(request, 'days', 30, 3660)
+
+    def get_limit(self, request):
+        return self.get_number(request, 'limit', 10, 100)
+
+    @action(detail=False, url_path='top-products')
+    def top_products(self, request):
+        return Response(rollups.top_products(self.get_days(request), self.get_limit(request)))
 
-        return Order.objects.filter(customer_id=customer_id)
+    @action(detail=False, url_path='top-collections')
+    def top_collections(self, request):
+        return Response(rollups.top_collections(self.get_days(request), self.get_limit(request)))
+
+    @action(detail=False)
+    def revenue(self, request):
+        return Response(rollups.daily_revenue(self.get_days(request)))
 
 
 class ProductImageViewSet(viewsets.ModelViewSet):
@@ -346,3 +499,17 @@ class ProductImageViewSet(viewsets.ModelViewSet):
         # by default django follows the following naming convention: /products/1/images/1 will become
         # /products/1(product_pk)/images/1(pk)
         return ProductImage.objects.filter(product_id=self.kwargs['product_pk'])
+
+
+class CacheStatsView(APIView):
+    """
+    Hit/miss counters of the response cache per view, so we can see if the cache is doing its job.
+    tiers has the hit rate per key prefix of the two-tier cache, for the process that answers this request.
+    """
+    permission_classes = [IsAdminUser]
+
+    def get(self, request):
+        views = [ProductView, ProductDetail, CollectionList, CollectionDetail]
+        stats = {view.__name__: get_stats(view.__name__) for view in views}
+        stats['tiers'] = get_tier_stats()
+        return Response(stats)
@@ -42,10 +42,19 @@ INSTALLED_APPS = [
 # if it returns a response, the next middleware function is not executed
 # These functions are run IN ORDER every we make a request
 MIDDLEWARE = [
+    # gives every request an id for the log lines (see core/logs.py)
+    'core.logs.RequestContextMiddleware',
+    # SQL/serializer timings per request, off unless REQUEST_INSTRUMENTATION is enabled (see core/instrumentation.py)
+    'core.instrumentation.QueryInstrumentationMiddleware',
+    # request counters and latency histograms per route, off unless METRICS is enabled (see core/metrics.py)
+    'core.metrics.MetricsMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     # whitenoise is needed to serve static files in production
+    # NOTE: WhiteNoise 6 is a sync only middleware: under ASGI the middlewares above it (the core ones too) run in a
+    # thread per request. The core middlewares work in both modes (see core/middleware.py), with a static files server
+    # in front (or WhiteNoise out of this list) the chain of an async worker stays async up to the async views.
     'whitenoise.middleware.WhiteNoiseMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -54,6 +63,10 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    # catalog reads go to the replicas (see core/dbrouter.py)
+    'core.dbrouter.ReplicaRoutingMiddleware',
+    # samples some requests of the routes in PROFILING, it has to be the last one (see core/profiling.py)
+    'core.profiling.ProfilingMiddleware',
 ]
 
 # This is needed when using react app in development mode
@@ -143,6 +156,61 @@ MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
+# Views with read_from_replica = True read from these databases (alias: weight). The aliases must be in DATABASES,
+# see dev.py. Empty means everything uses the default database
+DATABASE_ROUTERS = ['core.dbrouter.ReplicaRouter']
+DATABASE_REPLICAS = {}
+# seconds a replica can be behind the primary. For this long after a change the response cache reads the primary
+DATABASE_REPLICA_MAX_LAG = 10
+
+# The shared tier of store/cache.py. With REDIS_URL every worker sees the same cache, without it (development, tests)
+# every process has its own. check --deploy fails with a cache inside the process (store/checks.py), prod.py
+# requires REDIS_URL
+if os.environ.get('REDIS_URL'):
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': os.environ['REDIS_URL'],
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+    }
+# entries kept inside every process, in front of CACHES['default']
+STORE_LOCAL_CACHE_ENTRIES = 1000
+
+# Server-Timing header, a json log line per request and N+1 warnings. It is off by default, turn it on with
+# INSTRUMENT_REQUESTS=1
+REQUEST_INSTRUMENTATION = {
+    'ENABLED': os.environ.get('INSTRUMENT_REQUESTS') == '1',
+    # the same query more than this many times in one request is reported as a likely N+1
+    'N_PLUS_ONE_THRESHOLD': 5,
+}
+
+# Profile a fraction of the requests of some routes, e.g. PROFILING_ROUTES='store/orders/=0.05,store/carts/<uuid:pk>/=0.1'
+# python manage.py dump_profiles writes one flame graph file per route
+PROFILING = {
+    'ENABLED': bool(os.environ.get('PROFILING_ROUTES')),
+    'ROUTES': {
+        route: float(rate)
+        for route, rate in (item.rsplit('=', 1) for item in os.environ.get('PROFILING_ROUTES', '').split(',') if item)
+    },
+    'DIRECTORY': os.path.join(BASE_DIR, 'profiles'),
+}
+
+# Request counters and latency/query histograms per route for Prometheus, served at /metrics (see core/metrics.py).
+# Off by default, turn it on with METRICS_ENABLED=1
+METRICS = {
+    'ENABLED': os.environ.get('METRICS_ENABLED') == '1',
+    # shared by the gunicorn workers, empty it when you deploy
+    'DIRECTORY': os.environ.get('METRICS_DIRECTORY', os.path.join(BASE_DIR, 'metrics')),
+    # Prometheus sends it as a bearer token. Without it /metrics is only open with DEBUG on
+    'TOKEN': os.environ.get('METRICS_TOKEN'),
+}
+
 REST_FRAMEWORK = {
     'COERCE_DECIMAL_TO_STRING': False,
     # If you want pagination in all your view, you can specify the default pagination here
@@ -182,25 +250,52 @@ SIMPLE_JWT = {
     'ACCESS_TOKEN_LIFETIME': timedelta(days=1),
 }
 
+# Outbound HTTP calls go through core/outbound.py. Timeouts are (connect, read) in seconds
+OUTBOUND_HTTP = {
+    'TIMEOUT': (3.05, 10),
+    'POOL_SIZE': 10,
+    'FAILURE_THRESHOLD': 5,
+    'RESET_TIMEOUT': 30,
+}
+# the playground calls httpbin, the tests point it to a local server
+HTTPBIN_URL = os.environ.get('HTTPBIN_URL', 'https://httpbin.org')
+
 LOGGING = {
     'version': 1,
     'disable_existing_loggers': False,
+    # filters run in the thread that logs, before the record goes to the queue
+    'filters': {
+        # at most LOG_SAMPLING_RATE INFO records per second from the same line of code
+        'sampling': {
+            '()': 'core.logs.SamplingFilter',
+            'rate': int(os.environ.get('LOG_SAMPLING_RATE', 20)),
+            'per': 1,
+        },
+        # the request id and the time since the request started (see RequestContextMiddleware)
+        'request': {
+            '()': 'core.logs.RequestContextFilter',
+        },
+    },
     # with handlers you define where you want the logs to be ouputted
     'handlers': {
-        'console': {
-            'class': 'logging.StreamHandler',
+        # Logging only puts the record in a queue, a thread writes it to the console and, as json lines, to the file.
+        # The file is rotated every max_bytes (see core/logs.py). {pid} gives every gunicorn worker a file of its own,
+        # workers rotating the same file lose lines. The files of the processes that are gone are removed when a
+        # process starts
+        'queue': {
+            '()': 'core.logs.QueueHandler',
+            'filename': os.environ.get('LOG_FILE', os.path.join(BASE_DIR, 'logs', 'general.{pid}.log')),
+            'max_bytes': 50 * 1024 * 1024,
+            'backup_count': 5,
+            'filters': ['sampling', 'request'],
+            # the format of the console, the file has json lines
             'formatter': 'verbose',
         },
-        'file': {
-            'class': 'logging.FileHandler',
-            'filename': 'general.log',
-            'formatter': 'verbose',
-        }
     },
     'loggers': {
         # an empty string means one loggers for all apps. We don't want to have a specific logger for each app. That's too much
         '': {
-            'handlers': ['console', 'file'],
+            'handlers': ['queue'],
             # DEBUG, INFO, WARNING, ERROR, CRITICAL (I don't think we have CRITICAL in Java)
             # we read the log level from an environment variable. It is not defined, we use the second parameter: INFO
             # Where do we set the environment variables when developing
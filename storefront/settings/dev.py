@@ -16,3 +16,8 @@ DATABASES = {
         'PASSWORD': 'root',
     }
 }
+
+# To try the read replicas locally add a second connection (a MySQL replica, or a copy of the database) and give it a
+# weight. Reads of the catalog views will go there
+# DATABASES['replica'] = {**DATABASES['default'], 'HOST': 'replica-host'}
+# DATABASE_REPLICAS = {'replica': 1}
@@ -21,3 +21,12 @@ ALLOWED_HOSTS = ['store-edelgado-prod.herokuapp.com']
 
 # in the DATABASE_URL provided by Heroku, the username and password are included in the database url and it is encrypted
 # In Datagrip, you need to change from default to url only so that you don't have to enter username and password
+
+# The cache versions of store/cache.py must be the same for every worker, the admin and the management commands:
+# production needs a shared cache
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': os.environ['REDIS_URL'],
+    }
+}
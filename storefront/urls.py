@@ -18,6 +18,7 @@ from django.conf.urls.static import static
 from django.contrib import admin
 from django.urls import path, include
 from django.views.generic import TemplateView
+from core.views import CustomerTokenObtainPairView
 
 # Change the header of the admin dashboard
 admin.site.site_header = 'Storefront Admin'
@@ -36,6 +37,8 @@ urlpatterns = [
     path('playground/', include('playground.urls')),
     path('store/', include('store.urls')),
     path('auth/', include('djoser.urls')),
+    # it has to be before djoser.urls.jwt so our view answers /auth/jwt/create
+    path('auth/jwt/create/', CustomerTokenObtainPairView.as_view(), name='jwt-create'),
     path('auth/', include('djoser.urls.jwt')),
 ] + static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
 
@@ -1,3 +1,4 @@
+from collections import defaultdict
 from django.db import models
 # This is provided by django to create generic relationships
 from django.contrib.contenttypes.models import ContentType
@@ -21,6 +22,23 @@ class TaggedItemManager(models.Manager):
             )
         return queryset
 
+    def get_for_objects(self, obj_type, objects):
+        """
+            Get the tags of many objects of the same model in ONE query. objects can be a queryset, a list of
+            model instances or a list of ids. Returns {object_id: [tag, ...]}, objects without tags get an empty list.
+        """
+        content_type = ContentType.objects.get_for_model(obj_type)
+        if isinstance(objects, models.QuerySet):
+            # a subquery, the ids never come to python
+            object_ids = objects.values('pk')
+        else:
+            object_ids = [getattr(obj, 'pk', obj) for obj in objects]
+
+        tags = defaultdict(list)
+        for item in self.select_related('tag').filter(content_type=content_type, object_id__in=object_ids):
+            tags[item.object_id].append(item.tag)
+        return tags
+
 # Create your models here.
 
 
@@ -37,3 +55,12 @@ class TaggedItem(models.Model):
     # This is needed so that we can point to the primary key of the generic object
     object_id = models.PositiveIntegerField()
     content_object = GenericForeignKey()
+
+    # TaggedItem.objects.get_by_model(...), TaggedItem.objects.get_for_objects(...)
+    objects = TaggedItemManager()
+
+    class Meta:
+        # every lookup filters on both columns ("the tags of this object"), so they share one index
+        indexes = [
+            models.Index(fields=['content_type', 'object_id']),
+        ]